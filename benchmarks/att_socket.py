@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ AttTransport against simulated devices over socketpairs.
+
+ Each connect hands AttTransport one end of a SOCK_SEQPACKET socketpair; a
+ thread serves the other end as the device's ATT server, from the GATT
+ table of a SimulatedDevice and through its write handler. The link drops
+ (the socket closes) when the device reboots or loses it. Runs full
+ transfers with the default and the largest payload the negotiated MTU
+ allows, checks the firmware on the device and reports packets per second
+ and the PDUs exchanged. Finally the codec is fed random and truncated
+ PDUs, which must decode or raise CodecError.
+
+   python benchmarks/att_socket.py [--image-size N] [--runs N] [--mtu N]
+------------------------------------------------------------------------------
+"""
+import argparse
+import collections
+import errno
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from soak import init_packet
+
+from ota_dfu_python import att, resources
+from ota_dfu_python.att import AttErrors, AttOpcodes, AttTransport
+from ota_dfu_python.codec import CodecError
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.simulator import (SimulatedAir, SimulatedDevice, UUID_BUTTONLESS, UUID_CONTROL_POINT,
+                                      UUID_PACKET, UUID_DEVICE_NAME, UUID_FIRMWARE_REVISION,
+                                      UUID_HARDWARE_REVISION, UUID_MODEL_NUMBER)
+
+PROPERTIES = {
+    UUID_BUTTONLESS: att.PROP_WRITE | att.PROP_INDICATE,
+    UUID_CONTROL_POINT: att.PROP_WRITE | att.PROP_NOTIFY,
+    UUID_PACKET: att.PROP_WRITE_WITHOUT_RESPONSE,
+}
+
+# Readable by UUID in application mode
+INFO_UUIDS = (UUID_DEVICE_NAME, UUID_MODEL_NUMBER, UUID_HARDWARE_REVISION, UUID_FIRMWARE_REVISION)
+
+
+class SimulatedAttServer(object):
+    """The ATT server of a connected SimulatedDevice, on one end of a socketpair"""
+
+    def __init__(self, device, sock, mtu, counts):
+        self.device = device
+        self.sock = sock
+        self.local_mtu = mtu
+        self.mtu = att.DEFAULT_MTU
+        self.counts = counts
+        self.subscribed = set()
+
+        # Declaration, value and CCCD handles of the table in effect now
+        self.characteristics = sorted((handles[0], uuid, handles) for uuid, handles in device.characteristics.items())
+        self.thread = threading.Thread(target=self._serve, name="att-server", daemon=True)
+        self.thread.start()
+
+    def _send(self, pdu):
+        self.counts["server " + AttOpcodes.to_string(pdu[0])] += 1
+        try:
+            self.sock.send(pdu)
+        except OSError:
+            pass
+
+    def _serve(self):
+        try:
+            while self.device.connected:
+                try:
+                    pdu = self.sock.recv(self.local_mtu)
+                except OSError:
+                    break
+                if not pdu:
+                    break
+                self.counts["client " + AttOpcodes.to_string(pdu[0])] += 1
+                self._handle(pdu)
+        finally:
+            self.device.connected = False
+            self.sock.close()
+
+    def _handle(self, pdu):
+        opcode = pdu[0]
+        if opcode == AttOpcodes.EXCHANGE_MTU_REQ:
+            self.mtu = max(att.DEFAULT_MTU, min(self.local_mtu, att.decode_mtu(pdu)))
+            self._send(att.encode_exchange_mtu_rsp(self.local_mtu))
+        elif opcode == AttOpcodes.READ_BY_TYPE_REQ:
+            self._read_by_type(pdu)
+        elif opcode == AttOpcodes.FIND_INFORMATION_REQ:
+            (start, end, _) = att.decode_range(pdu)
+            entries = [(handles[2], att.UUID_CCCD) for (_, uuid, handles) in self.characteristics
+                       if PROPERTIES[uuid] & (att.PROP_NOTIFY | att.PROP_INDICATE) and start <= handles[2] <= end]
+            if entries:
+                self._send(att.encode_find_information_rsp(entries))
+            else:
+                self._send(att.encode_error_rsp(opcode, start, AttErrors.ATTRIBUTE_NOT_FOUND))
+        elif opcode in (AttOpcodes.WRITE_REQ, AttOpcodes.WRITE_CMD):
+            self._write(opcode, *att.decode_handle_value(pdu))
+        elif opcode == AttOpcodes.HANDLE_VALUE_CFM or opcode & AttOpcodes.COMMAND_FLAG:
+            pass
+        else:
+            self._send(att.encode_error_rsp(opcode, 0x0000, AttErrors.REQUEST_NOT_SUPPORTED))
+
+    def _read_by_type(self, pdu):
+        (start, end, uuid) = att.decode_range(pdu)
+        if uuid == att.uuid_from_bytes(att.uuid_to_bytes(att.UUID_CHARACTERISTIC)):
+            entries = [(handle, att.encode_characteristic(PROPERTIES[uuid], handles[1], uuid))
+                       for (handle, uuid, handles) in self.characteristics if start <= handle <= end]
+            # One response holds declarations of one length only
+            entries = [entry for entry in entries if len(entry[1]) == len(entries[0][1])] if entries else []
+            room = (self.mtu - 2) // (len(entries[0][1]) + 2) if entries else 0
+            if entries:
+                self._send(att.encode_read_by_type_rsp(entries[:room]))
+                return
+        elif uuid in INFO_UUIDS:
+            value = self.device.read(uuid)
+            if value is not None:
+                self._send(att.encode_read_by_type_rsp([(0x0030 + INFO_UUIDS.index(uuid) * 2,
+                                                         value[:self.mtu - 4])]))
+                return
+        self._send(att.encode_error_rsp(pdu[0], start, AttErrors.ATTRIBUTE_NOT_FOUND))
+
+    def _write(self, opcode, handle, value):
+        control_point = self.device.characteristics.get(UUID_CONTROL_POINT)
+        cccds = {handles[2]: handles[1] for (_, uuid, handles) in self.characteristics
+                 if PROPERTIES[uuid] & (att.PROP_NOTIFY | att.PROP_INDICATE)}
+
+        if handle in cccds:
+            if any(value):
+                self.subscribed.add(cccds[handle])
+            else:
+                self.subscribed.discard(cccds[handle])
+            values = []
+        else:
+            values = self.device.write(handle, value)
+
+        if opcode == AttOpcodes.WRITE_REQ:
+            self._send(att.encode_write_rsp())
+        if control_point is not None and control_point[1] in self.subscribed:
+            for value in values:
+                self._send(att.encode_notification(control_point[1], value))
+        if not self.device.connected:
+            # Rebooted or lost the link: the socket closes
+            self.sock.shutdown(socket.SHUT_RDWR)
+
+
+class Connector(object):
+    """Connects AttTransport to simulated devices through socketpairs"""
+
+    def __init__(self, air, mtu):
+        self.air = air
+        self.mtu = mtu
+        self.counts = collections.Counter()
+        self.servers = []
+
+    def __call__(self, address, timeout):
+        device = self.air.find(address)
+        if device is None:
+            raise OSError(errno.EHOSTUNREACH, "No simulated device at %s" % address)
+        device.connected = True
+        (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.servers.append(SimulatedAttServer(device, theirs, self.mtu, self.counts))
+        return ours
+
+
+def run(image, init, mtu, payload_size, address="AA:BB:CC:DD:EE:00"):
+    air = SimulatedAir()
+    device = air.add(SimulatedDevice(address))
+    connector = Connector(air, mtu)
+
+    directory = tempfile.mkdtemp(prefix="ota_dfu_att_")
+    binfile = os.path.join(directory, "app.bin")
+    datfile = os.path.join(directory, "app.dat")
+    with open(binfile, 'wb') as f:
+        f.write(image)
+    with open(datfile, 'wb') as f:
+        f.write(init)
+
+    try:
+        start = time.perf_counter()
+        with SecureDfu(address, binfile, datfile, AttTransport(address, mtu=mtu, connector=connector),
+                       scan_timeout=0.05, reboot_min_delay=0.0, reboot_delay=0.0,
+                       pkt_payload_size=payload_size) as dfu:
+            dfu.perform_dfu()
+        seconds = time.perf_counter() - start
+    finally:
+        for name in (binfile, datfile):
+            os.remove(name)
+        os.rmdir(directory)
+
+    for server in connector.servers:
+        server.thread.join(2)
+    if device.firmware != image:
+        raise Exception("Firmware on the device differs from the image")
+    return seconds, device.packets, connector.counts
+
+
+def fuzz(iterations, seed=1):
+    """Random and truncated PDUs decode or raise CodecError. Returns how many were rejected."""
+    rng = random.Random(seed)
+    decoders = [att.decode_error_rsp, att.decode_mtu, att.decode_find_information_rsp, att.decode_read_by_type_rsp,
+                att.decode_handle_value, att.decode_range, att.decode_read_req, att.decode_characteristic]
+    valid = [att.encode_error_rsp(0x12, 0x0010, 0x03), att.encode_exchange_mtu_rsp(247),
+             att.encode_find_information_rsp([(0x0010, att.UUID_CCCD)]),
+             att.encode_read_by_type_rsp([(0x000e, att.encode_characteristic(0x18, 0x000f, UUID_CONTROL_POINT))]),
+             att.encode_notification(0x000f, b'\x60\x03\x01'), att.encode_read_by_type_req(1, 0xffff, UUID_PACKET)]
+
+    rejected = 0
+    for _ in range(iterations):
+        if rng.random() < 0.5:
+            pdu = bytes(rng.getrandbits(8) for _ in range(rng.randrange(0, 24)))
+        else:
+            pdu = rng.choice(valid)
+            pdu = pdu[:rng.randrange(0, len(pdu) + 1)]
+        for decode in decoders:
+            try:
+                decode(pdu)
+            except CodecError:
+                rejected += 1
+    return rejected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transfers over AttTransport with simulated ATT servers.")
+    parser.add_argument('--image-size', type=int, default=65536, help='Firmware image size in bytes.')
+    parser.add_argument('--runs', type=int, default=3, help='Transfers per payload size.')
+    parser.add_argument('--mtu', type=int, default=247, help='ATT MTU of both sides.')
+    parser.add_argument('--fuzz', type=int, default=20000, help='Random PDUs to decode.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(args.image_size))
+    init = init_packet(image)
+
+    print("%-8s %8s %8s %10s" % ("payload", "seconds", "packets", "packets/s"))
+    for payload_size in (20, args.mtu - 3):
+        for _ in range(args.runs):
+            (seconds, packets, counts) = run(image, init, args.mtu, payload_size)
+            print("%-8d %8.3f %8d %10.0f" % (payload_size, seconds, packets, packets / seconds))
+        print("  PDUs: " + ", ".join("%s %d" % item for item in sorted(counts.items())))
+
+    print("fuzz: %d PDUs, %d decodes rejected with CodecError" % (args.fuzz, fuzz(args.fuzz)))
+    open_sockets = resources.live().get("ATT socket", 0)
+    print("ATT sockets left open: %d" % open_sockets)
+    return 1 if open_sockets else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ BluezTransport against a stand-in for bluetoothd.
+
+ FakeBluez answers BluezTransport's D-Bus calls for simulated devices and
+ hands out socketpair ends for AcquireWrite and AcquireNotify; a thread
+ serves the other ends like bluetoothd does, passing writes to the device
+ and its notifications back. Runs full transfers, checks the firmware on
+ the device and reports packets per second and D-Bus calls per transfer,
+ with the acquired sockets and with every packet sent through WriteValue
+ (--no-acquire alone). Method calls are answered after --call-latency, the
+ time a round trip to bluetoothd takes.
+
+   python benchmarks/bluez_fds.py [--image-size N] [--runs N] [--no-acquire] [--call-latency S]
+------------------------------------------------------------------------------
+"""
+import argparse
+import collections
+import logging
+import os
+import random
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from soak import init_packet
+
+from ota_dfu_python.bluez import (BluezError, BluezTransport, ADAPTER_INTERFACE, CHARACTERISTIC_INTERFACE,
+                                  DESCRIPTOR_INTERFACE, DEVICE_INTERFACE, UUID_CCCD)
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.simulator import (SimulatedAir, SimulatedDevice, UUID_BUTTONLESS, UUID_CONTROL_POINT,
+                                      UUID_PACKET)
+
+ADAPTER_PATH = "/org/bluez/hci0"
+
+FLAGS = {
+    UUID_BUTTONLESS: ["write", "indicate"],
+    UUID_CONTROL_POINT: ["write", "notify"],
+    UUID_PACKET: ["write-without-response"],
+}
+
+
+class FakeBluez(object):
+    """The D-Bus side of bluetoothd for the devices in a SimulatedAir (see ota_dfu_python.bluez.BluezBus)"""
+
+    def __init__(self, air, mtu=247, acquire=True, call_latency=0.0):
+        self.air = air
+        self.mtu = mtu
+        self.acquire = acquire
+        self.call_latency = call_latency
+        self.calls = 0
+        self.methods = collections.Counter()
+        self.socket_writes = 0
+
+        self._lock = threading.RLock()
+        self._signals = collections.deque()
+        self._watched = []
+        (self._wake_out, self._wake_in) = socket.socketpair()
+        self._peers = {}        # write peer -> (device, value handle)
+        self._notifiers = {}    # (address, path) -> notify peer
+        self._started = set()   # (address, path) notifying through signals
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, name="fake-bluetoothd", daemon=True)
+        self._thread.start()
+
+    # Object paths -------------------------------------------------------------
+
+    def _device_path(self, device):
+        return "%s/dev_%s" % (ADAPTER_PATH, device.advertised_address.replace(':', '_'))
+
+    def _device(self, path):
+        for device in self.air.devices:
+            if path == self._device_path(device) or path.startswith(self._device_path(device) + "/"):
+                return device
+        raise BluezError("org.freedesktop.DBus.Error.UnknownObject", path)
+
+    def _gatt(self, device):
+        """{path: (uuid, handles)} of the device's characteristics"""
+        base = self._device_path(device) + "/service0001"
+        return {"%s/char%04x" % (base, handles[0]): (uuid, handles) for uuid, handles in device.characteristics.items()}
+
+    def _characteristic(self, path):
+        device = self._device(path)
+        if path not in self._gatt(device):
+            raise BluezError("org.freedesktop.DBus.Error.UnknownObject", path)
+        return device, self._gatt(device)[path]
+
+    # BluezBus -----------------------------------------------------------------
+
+    def managed_objects(self):
+        self.calls += 1
+        self.methods['GetManagedObjects'] += 1
+        objects = {ADAPTER_PATH: {ADAPTER_INTERFACE: {"Address": "00:00:00:00:00:00"}}}
+        with self._lock:
+            for device in self.air.devices:
+                path = self._device_path(device)
+                objects[path] = {DEVICE_INTERFACE: {"Address": device.advertised_address, "RSSI": device.rssi,
+                                                    "Connected": device.connected,
+                                                    "ServicesResolved": device.connected}}
+                if not device.connected:
+                    continue
+                for char_path, (uuid, handles) in self._gatt(device).items():
+                    objects[char_path] = {CHARACTERISTIC_INTERFACE: {"UUID": uuid, "Flags": FLAGS[uuid]}}
+                    if "notify" in FLAGS[uuid] or "indicate" in FLAGS[uuid]:
+                        objects["%s/desc%04x" % (char_path, handles[2])] = {
+                            DESCRIPTOR_INTERFACE: {"UUID": UUID_CCCD, "Characteristic": char_path}}
+        return objects
+
+    def get(self, path, interface, name):
+        self.calls += 1
+        self.methods['Get'] += 1
+        with self._lock:
+            device = self._device(path)
+            return {"Connected": device.connected, "ServicesResolved": device.connected}[name]
+
+    def watch(self, path):
+        self.calls += 1
+        self.methods['AddMatch'] += 1
+        self._watched.append(path)
+
+    def call(self, path, interface, method, signature=None, body=(), timeout=10):
+        self.calls += 1
+        self.methods[method] += 1
+        if self.call_latency:
+            # The round trip to bluetoothd and back
+            time.sleep(self.call_latency)
+        with self._lock:
+            if interface == ADAPTER_INTERFACE:
+                return ()
+            if interface == DEVICE_INTERFACE:
+                return self._device_call(path, method)
+            return self._characteristic_call(path, method, body)
+
+    def _device_call(self, path, method):
+        device = self._device(path)
+        if method == 'Connect':
+            device.connected = True
+        elif method == 'Disconnect' and device.connected:
+            self._drop(device, path)
+        return ()
+
+    def _characteristic_call(self, path, method, body):
+        (device, (uuid, handles)) = self._characteristic(path)
+        if not device.connected:
+            raise BluezError("org.bluez.Error.NotConnected")
+        key = (device.address, path)
+
+        if method == 'ReadValue':
+            return (device.read(uuid) or b'',)
+
+        if method == 'WriteValue':
+            self._write(device, handles[1], body[0])
+            return ()
+
+        if method == 'AcquireWrite':
+            if not self.acquire or "write-without-response" not in FLAGS[uuid]:
+                raise BluezError("org.bluez.Error.NotSupported")
+            (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self._peers[ours] = (device, handles[1])
+            self._wake()
+            return (theirs.detach(), self.mtu - 3)
+
+        if method == 'AcquireNotify':
+            if not self.acquire or "notify" not in FLAGS[uuid]:
+                raise BluezError("org.bluez.Error.NotSupported")
+            (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self._notifiers[key] = ours
+            return (theirs.detach(), self.mtu)
+
+        if method == 'StartNotify':
+            self._started.add(key)
+        elif method == 'StopNotify':
+            self._started.discard(key)
+        return ()
+
+    def _write(self, device, handle, data):
+        # The address changes when the device reboots into the bootloader
+        device_path = self._device_path(device)
+        control_point = "%s/service0001/char%04x" % (
+            device_path, SimulatedDevice.BOOTLOADER_CHARACTERISTICS[UUID_CONTROL_POINT][0])
+        for value in device.write(handle, data):
+            notifier = self._notifiers.get((device.address, control_point))
+            if notifier is not None:
+                notifier.send(value)
+            elif (device.address, control_point) in self._started:
+                self._signal(control_point, CHARACTERISTIC_INTERFACE, {"Value": value})
+        if not device.connected:
+            self._drop(device, device_path)
+
+    def _drop(self, device, device_path):
+        """The link is gone: close our socket ends and report Connected false"""
+        device.connected = False
+        for peer, (owner, _) in list(self._peers.items()):
+            if owner is device:
+                del self._peers[peer]
+                peer.close()
+        for key in [key for key in self._notifiers if key[0] == device.address]:
+            self._notifiers.pop(key).close()
+        self._started = {key for key in self._started if key[0] != device.address}
+        self._signal(device_path, DEVICE_INTERFACE, {"Connected": False})
+        self._wake()
+
+    def _signal(self, path, interface, changed):
+        if any(path == watched or path.startswith(watched + "/") for watched in self._watched):
+            self._signals.append((path, interface, changed))
+            self._wake_in.send(b'x')
+
+    def _wake(self):
+        self._wake_in.send(b'w')
+
+    def poll(self, timeout=0):
+        (ready, _, _) = select.select([self._wake_out], [], [], timeout)
+        if ready:
+            self._wake_out.recv(4096)
+        with self._lock:
+            signals = list(self._signals)
+            self._signals.clear()
+        return signals
+
+    def fileno(self):
+        return self._wake_out.fileno()
+
+    def close(self):
+        self._closed = True
+        self._wake()
+
+    # The bluetoothd end of the write sockets ----------------------------------
+
+    def _serve(self):
+        while not self._closed:
+            with self._lock:
+                peers = list(self._peers)
+            try:
+                (ready, _, _) = select.select(peers, [], [], 0.05)
+            except (OSError, ValueError):
+                continue    # a peer closed meanwhile
+            for peer in ready:
+                # Read and handled under the lock, so a request never
+                # overtakes a write already taken from the socket
+                with self._lock:
+                    if peer not in self._peers:
+                        continue
+                    (device, handle) = self._peers[peer]
+                    try:
+                        data = peer.recv(self.mtu)
+                    except OSError:
+                        continue
+                    if data:
+                        self.socket_writes += 1
+                        self._write(device, handle, data)
+
+
+def run(image, init, acquire, call_latency, address="AA:BB:CC:DD:EE:00"):
+    air = SimulatedAir()
+    device = air.add(SimulatedDevice(address))
+    bus = FakeBluez(air, acquire=acquire, call_latency=call_latency)
+
+    directory = tempfile.mkdtemp(prefix="ota_dfu_bluez_")
+    binfile = os.path.join(directory, "app.bin")
+    datfile = os.path.join(directory, "app.dat")
+    with open(binfile, 'wb') as f:
+        f.write(image)
+    with open(datfile, 'wb') as f:
+        f.write(init)
+
+    try:
+        start = time.perf_counter()
+        with SecureDfu(address, binfile, datfile, BluezTransport(address, bus=bus),
+                       scan_timeout=0.05, reboot_min_delay=0.0, reboot_delay=0.0) as dfu:
+            dfu.perform_dfu()
+        seconds = time.perf_counter() - start
+    finally:
+        bus.close()
+        for name in (binfile, datfile):
+            os.remove(name)
+        os.rmdir(directory)
+
+    if device.firmware != image:
+        raise Exception("Firmware on the device differs from the image")
+    return seconds, device.packets, bus
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transfers over BluezTransport with a fake bluetoothd.")
+    parser.add_argument('--image-size', type=int, default=65536, help='Firmware image size in bytes.')
+    parser.add_argument('--runs', type=int, default=3, help='Transfers per mode.')
+    parser.add_argument('--no-acquire', action='store_true', help='Only the WriteValue mode.')
+    parser.add_argument('--call-latency', type=float, default=0.0003,
+                        help='Seconds a D-Bus method call takes to be answered.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(args.image_size))
+    init = init_packet(image)
+
+    modes = [False] if args.no_acquire else [True, False]
+    print("%-12s %8s %8s %10s %10s %14s" % ("mode", "seconds", "packets", "packets/s", "bus calls", "socket writes"))
+    for acquire in modes:
+        for _ in range(args.runs):
+            (seconds, packets, bus) = run(image, init, acquire, args.call_latency)
+            print("%-12s %8.3f %8d %10.0f %10d %14d" % ("acquired" if acquire else "WriteValue", seconds, packets,
+                                                         packets / seconds, bus.calls, bus.socket_writes))
+        print("  calls: " + ", ".join("%s %d" % item for item in sorted(bus.methods.items())))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Control point codec microbenchmark and fuzz pass.
+
+ Times decoding of Packet Receipt Notifications (the hot path of an image
+ transfer) and SELECT responses with the codec, against the previous
+ hex-string parsing, then feeds random and mutated notifications to the
+ decoder: it may only return a Response or raise CodecError.
+
+   python benchmarks/codec.py [--number N] [--fuzz N] [--seed S]
+------------------------------------------------------------------------------
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ota_dfu_python.codec import (Procedures, Results, Response, CodecError, decode_response, encode_create,
+                                  encode_set_prn, encode_select, encode_ping, encode_firmware_version)
+
+PRN = bytes([Procedures.RESPONSE, Procedures.CALC_CHECKSUM, Results.SUCCESS]) + struct.pack('<II', 4000, 0xdeadbeef)
+SELECT = bytes([Procedures.RESPONSE, Procedures.SELECT, Results.SUCCESS]) + struct.pack('<III', 4096, 0, 0)
+EXT_ERROR = bytes([Procedures.RESPONSE, Procedures.EXECUTE, Results.EXT_ERROR, 0x07])
+
+
+def _bytes_to_uint32_le(data):
+    return (int(data[3], 16) << 24) | (int(data[2], 16) << 16) | (int(data[1], 16) << 8) | (int(data[0], 16) << 0)
+
+
+def legacy_parse(value):
+    """Parsing as done before the codec: hex strings, then int(x, 16) per byte"""
+    notify = ['%02x' % x for x in value]
+    if int(notify[0], 16) != Procedures.RESPONSE:
+        return None
+    procedure = int(notify[1], 16)
+    result = int(notify[2], 16)
+    if procedure == Procedures.CALC_CHECKSUM and result == Results.SUCCESS:
+        return (procedure, result, _bytes_to_uint32_le(notify[3:7]), _bytes_to_uint32_le(notify[7:11]))
+    if procedure == Procedures.SELECT and result == Results.SUCCESS:
+        return (procedure, result, _bytes_to_uint32_le(notify[3:7]), _bytes_to_uint32_le(notify[7:11]),
+                _bytes_to_uint32_le(notify[11:15]))
+    return (procedure, result)
+
+
+def bench(number):
+    print("%-28s %10s %10s %8s" % ("", "legacy us", "codec us", "speedup"))
+    for name, value in (("PRN / CALC_CHECKSUM", PRN), ("SELECT", SELECT)):
+        legacy = min(timeit.repeat(lambda: legacy_parse(value), number=number, repeat=3)) / number * 1e6
+        codec = min(timeit.repeat(lambda: decode_response(value), number=number, repeat=3)) / number * 1e6
+        print("%-28s %10.2f %10.2f %7.1fx" % (name, legacy, codec, legacy / codec))
+
+    encode = min(timeit.repeat(lambda: encode_create(Procedures.PARAM_DATA, 4096), number=number, repeat=3))
+    print("%-28s %10s %10.2f" % ("encode CREATE", "", encode / number * 1e6))
+
+
+def fuzz(iterations, seed):
+    rng = random.Random(seed)
+    seeds = [PRN, SELECT, EXT_ERROR, encode_create(1, 512), encode_set_prn(10), encode_select(2),
+             encode_ping(7), encode_firmware_version(1)]
+    decoded = rejected = 0
+
+    for i in range(iterations):
+        if i % 2:
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randrange(0, 32)))
+        else:
+            # Mutate a valid notification: flip, truncate or extend
+            data = bytearray(rng.choice(seeds))
+            if data and rng.random() < 0.5:
+                data[0] = Procedures.RESPONSE
+            for _ in range(rng.randrange(1, 4)):
+                choice = rng.random()
+                if choice < 0.4 and data:
+                    data[rng.randrange(len(data))] = rng.getrandbits(8)
+                elif choice < 0.7:
+                    del data[rng.randrange(len(data) + 1):]
+                else:
+                    data += bytes(rng.getrandbits(8) for _ in range(rng.randrange(1, 8)))
+            data = bytes(data)
+
+        try:
+            response = decode_response(data)
+        except CodecError:
+            rejected += 1
+            continue
+
+        if not isinstance(response, Response):
+            raise AssertionError("decode_response({!r}) returned {!r}".format(data, response))
+        # Every decoded response must describe itself, whatever its codes
+        repr(response)
+        decoded += 1
+
+    print("fuzz: %d inputs, %d decoded, %d rejected, no other exceptions" % (iterations, decoded, rejected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000, help='Calls per timing run.')
+    parser.add_argument('--fuzz', type=int, default=100000, help='Fuzz inputs, 0 to skip.')
+    parser.add_argument('--seed', type=int, default=0, help='Fuzz seed.')
+    args = parser.parse_args()
+
+    assert decode_response(EXT_ERROR).error_string() == "EXTENDED_ERROR (SD_VERSION_FAILURE)"
+    assert legacy_parse(PRN)[2:] == (4000, 0xdeadbeef)
+    response = decode_response(PRN)
+    assert (response.offset, response.crc32) == (4000, 0xdeadbeef)
+
+    bench(args.number)
+    if args.fuzz:
+        fuzz(args.fuzz, args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
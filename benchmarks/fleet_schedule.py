@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Fleet scheduling against a simulated fleet with a spread of signal.
+
+ Strong devices take the image cleanly, weak ones lose packets (and some
+ their link), and an adapter with more than --capacity links loses packets
+ on all of them. The same fleet is updated oldest job first at a fixed
+ concurrency, then by a FleetScheduler with AdaptiveConcurrency, and again
+ with the device history learned in that run. Sessions sleep for
+ --time-scale of their simulated time, so they overlap like real ones;
+ times are reported in simulated seconds. Reports devices updated, devices
+ per hour, when a quarter and half of the fleet were done, and the
+ concurrency changes made, for each of --runs fleets (seeds 1 to N) and
+ their mean: thread timing makes single runs of a small fleet noisy.
+
+   python benchmarks/fleet_schedule.py [--devices N] [-j N] [--capacity N] [--runs N] [--time-scale F]
+------------------------------------------------------------------------------
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from soak import addresses, init_packet
+
+from ota_dfu_python.jobs import JobStore, JobWorker, JobStates
+from ota_dfu_python.metrics import Registry
+from ota_dfu_python.retry import RetryPolicy
+from ota_dfu_python.scheduler import AdaptiveConcurrency, DeviceHistory, FleetScheduler
+from ota_dfu_python.simulator import SimulatedAir, SimulatedDevice, SimulatedTransport
+
+
+def fleet(count, weak_share, capacity, congestion_loss, seed=1):
+    """A SimulatedAir with `count` devices, a `weak_share` of them at the edge of range"""
+    rng = random.Random(seed)
+    air = SimulatedAir(capacity=capacity, congestion_loss=congestion_loss, seed=seed)
+    for address in addresses(count):
+        if rng.random() < weak_share:
+            rssi = rng.randint(-92, -80)
+            # Loss grows towards the edge; some links drop now and then
+            loss = 0.001 + (-80 - rssi) * 0.0004
+            losses = range(rng.randint(200, 600), 100000, 700) if rng.random() < 0.3 else ()
+            air.add(SimulatedDevice(address, rssi=rssi, packet_loss=loss, link_losses=losses))
+        else:
+            air.add(SimulatedDevice(address, rssi=rng.randint(-70, -45)))
+    return air
+
+
+def run(args, binfile, datfile, mode, seed, history=None):
+    air = fleet(args.devices, args.weak_share, args.capacity, args.congestion_loss, seed)
+    store = JobStore(":memory:")
+    scheduler = None
+    if mode != "fifo":
+        scheduler = FleetScheduler(history, AdaptiveConcurrency(args.concurrency, window=args.window),
+                                   scan_timeout=0.5)
+    try:
+        for address in addresses(args.devices):
+            store.add(address, binfile, datfile)
+        worker = JobWorker(store, concurrency=args.concurrency, max_attempts=1,
+                           transport_factory=lambda address: SimulatedTransport(address, air,
+                                                                                time_scale=args.time_scale),
+                           metrics_registry=Registry(), retry=RetryPolicy(attempts=3, base_delay=0.5),
+                           scheduler=scheduler)
+        start = time.time()
+        worker.run()
+        elapsed = (time.time() - start) / args.time_scale
+        finished = sorted((job.finished - start) / args.time_scale for job in store.jobs(JobStates.DONE))
+    finally:
+        store.close()
+
+    def fraction(share):
+        index = int(share * args.devices) - 1
+        return finished[index] if 0 <= index < len(finished) else None
+
+    changes = ", ".join("%d@%.2f" % (limit, rate) for (_, limit, rate) in scheduler.concurrency.changes) \
+        if scheduler is not None else ""
+    row = (len(finished), elapsed, len(finished) * 3600.0 / elapsed, fraction(0.25), fraction(0.5))
+    report("%s #%d" % (mode, seed), row, changes)
+    return row, scheduler.history if scheduler is not None else None
+
+
+def report(name, row, changes=""):
+    (done, elapsed, rate, quarter, half) = row
+    print("%-22s %6.1f %8.0f %8.1f %8s %8s  %s" % (name, done, elapsed, rate,
+                                                   "-" if quarter is None else "%.0f" % quarter,
+                                                   "-" if half is None else "%.0f" % half, changes or "-"))
+
+
+def mean(rows):
+    """Column means; the fraction columns over the runs that got that far"""
+    columns = []
+    for column in zip(*rows):
+        values = [value for value in column if value is not None]
+        columns.append(sum(values) / len(values) if values else None)
+    return columns
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare fleet scheduling on a simulated fleet.")
+    parser.add_argument('--devices', type=int, default=40, help='Devices in the fleet.')
+    parser.add_argument('--weak-share', type=float, default=0.4, help='Share of devices with a weak signal.')
+    parser.add_argument('-j', '--concurrency', type=int, default=6, help='(Maximum) concurrent sessions.')
+    parser.add_argument('--capacity', type=int, default=3, help='Links the adapter serves without loss.')
+    parser.add_argument('--congestion-loss', type=float, default=0.002,
+                        help='Packet loss added per link beyond the capacity.')
+    parser.add_argument('--window', type=int, default=4, help='Sessions per concurrency decision.')
+    parser.add_argument('--image-size', type=int, default=32768, help='Firmware image size in bytes.')
+    parser.add_argument('--runs', type=int, default=3, help='Fleets to run, each with its own seed.')
+    parser.add_argument('--time-scale', type=float, default=0.02, help='Real seconds per simulated second.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(args.image_size))
+    directory = tempfile.mkdtemp(prefix="ota_dfu_fleet_")
+    binfile = os.path.join(directory, "app.bin")
+    datfile = os.path.join(directory, "app.dat")
+    with open(binfile, 'wb') as f:
+        f.write(image)
+    with open(datfile, 'wb') as f:
+        f.write(init_packet(image))
+
+    try:
+        print("%-22s %6s %8s %8s %8s %8s  %s" % ("mode", "done", "seconds", "dev/h", "25% at", "50% at",
+                                                 "concurrency changes (limit@rate)"))
+        rows = {"fifo": [], "scheduled": [], "scheduled+history": []}
+        for seed in range(1, args.runs + 1):
+            rows["fifo"].append(run(args, binfile, datfile, "fifo", seed)[0])
+            (row, history) = run(args, binfile, datfile, "scheduled", seed, DeviceHistory())
+            rows["scheduled"].append(row)
+            rows["scheduled+history"].append(run(args, binfile, datfile, "scheduled+history", seed, history)[0])
+        for mode, mode_rows in rows.items():
+            report("%s mean" % mode, mean(mode_rows))
+    finally:
+        for name in (binfile, datfile):
+            os.remove(name)
+        os.rmdir(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
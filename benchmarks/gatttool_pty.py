@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ GatttoolTransport against a fake gatttool.
+
+ The fake speaks gatttool's interactive protocol on its terminal for a
+ simulated device in its bootloader: it echoes every command line after
+ the prompt like readline does, answers connect, characteristics and
+ writes, and prints the device's notifications. Runs full transfers with
+ every write command sent to the terminal on its own and unbounded expect
+ searches, then with batched writes and the bounded search window, checks
+ the firmware the fake received and reports CPU time and read/write
+ syscalls (of the thread running the session) per packet.
+
+   python benchmarks/gatttool_pty.py [--image-size N] [--runs N] [--prn N]
+------------------------------------------------------------------------------
+"""
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from soak import FAKE_HCITOOL, init_packet
+
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.transport import GatttoolTransport
+
+FAKE_GATTTOOL = """#!%s
+import hashlib, os, sys, termios
+sys.path.insert(0, %r)
+from ota_dfu_python.simulator import SimulatedDevice
+
+# readline echoes input itself, with the terminal's echo off
+attributes = termios.tcgetattr(0)
+attributes[3] &= ~termios.ECHO
+termios.tcsetattr(0, termios.TCSANOW, attributes)
+
+address = sys.argv[sys.argv.index("-b") + 1]
+device = SimulatedDevice(address, app_mode=False)
+out = sys.stdout.buffer
+prompt = b"[   ][" + address.encode() + b"][LE]> "
+firmware = None
+
+def notify(values):
+    handle = SimulatedDevice.BOOTLOADER_CHARACTERISTICS["8ec90001-f315-4f60-9fb8-838830daea50"][1]
+    for value in values:
+        out.write(b"Notification handle = 0x%%04x value: %%s \\n" %% (handle, value.hex(" ").encode()))
+
+out.write(prompt)
+out.flush()
+for line in sys.stdin.buffer:
+    out.write(line)
+    words = line.split()
+    if not words:
+        pass
+    elif words[0] == b"exit":
+        break
+    elif words[0] == b"connect":
+        device.connected = True
+        prompt = prompt.replace(b"[   ]", b"[CON]")
+        out.write(b"Attempting to connect to " + address.encode() + b"\\nConnection successful\\n")
+    elif words[0] == b"characteristics":
+        for uuid, handles in sorted(device.characteristics.items(), key=lambda item: item[1]):
+            out.write(b"handle: 0x%%04x, char properties: 0x1c, char value handle: 0x%%04x, uuid: %%s\\n"
+                      %% (handles[0], handles[1], uuid.encode()))
+    elif words[0] == b"char-read-uuid":
+        out.write(b"Read characteristics by UUID failed: No attribute found within the given range\\n")
+    elif words[0] in (b"char-write-req", b"char-write-cmd"):
+        values = device.write(int(words[1], 16), bytes.fromhex(words[2].decode()))
+        if words[0] == b"char-write-req":
+            out.write(b"Characteristic value was written successfully\\n")
+        notify(values)
+        if device.firmware is not None and device.firmware != firmware:
+            firmware = device.firmware
+            with open(os.environ["FAKE_GATTTOOL_RESULT"], "w") as f:
+                f.write(hashlib.sha256(firmware).hexdigest())
+    out.write(prompt)
+    out.flush()
+""" % (sys.executable, SRC)
+
+
+def syscalls():
+    """(read, write) syscalls made by this thread so far. Those of the whole process also count its reaped
+    children, the fake gatttool among them."""
+    with open('/proc/thread-self/io') as f:
+        counters = dict(line.split(': ') for line in f.read().splitlines())
+    return int(counters['syscr']), int(counters['syscw'])
+
+
+def run(binfile, datfile, digest, prn, batch, address="AA:BB:CC:DD:EE:00"):
+    options = {} if batch else {"write_batch_size": 0, "search_window": None}
+    transport = GatttoolTransport(address, **options)
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    (reads, writes) = syscalls()
+    with SecureDfu(address, binfile, datfile, transport, scan_timeout=0.05, reboot_min_delay=0.0,
+                   reboot_delay=0.0, pkt_receipt_interval=prn) as dfu:
+        dfu.perform_dfu()
+        packets = dfu.ble_dfu.stats.bytes_committed // dfu.ble_dfu.pkt_payload_size
+    cpu = time.process_time() - cpu
+    seconds = time.perf_counter() - start
+    (reads, writes) = [after - before for after, before in zip(syscalls(), (reads, writes))]
+
+    result = os.environ["FAKE_GATTTOOL_RESULT"]
+    with open(result) as f:
+        if f.read() != digest:
+            raise Exception("Firmware received by the fake gatttool differs from the image")
+    os.remove(result)
+    return seconds, packets, cpu, reads, writes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transfers over GatttoolTransport with a fake gatttool.")
+    parser.add_argument('--image-size', type=int, default=16384, help='Firmware image size in bytes.')
+    parser.add_argument('--runs', type=int, default=3, help='Transfers per mode.')
+    parser.add_argument('--prn', type=int, default=10, help='Packet receipt notification interval.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(args.image_size))
+    directory = tempfile.mkdtemp(prefix="ota_dfu_gatttool_")
+    binfile = os.path.join(directory, "app.bin")
+    datfile = os.path.join(directory, "app.dat")
+    with open(binfile, 'wb') as f:
+        f.write(image)
+    with open(datfile, 'wb') as f:
+        f.write(init_packet(image))
+    for name, script in (("gatttool", FAKE_GATTTOOL), ("hcitool", FAKE_HCITOOL)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_GATTTOOL_RESULT"] = os.path.join(directory, "result")
+
+    try:
+        print("%-11s %8s %8s %10s %14s %16s" % ("mode", "seconds", "packets", "packets/s", "CPU us/packet",
+                                                "syscalls/packet"))
+        for batch in (False, True):
+            for _ in range(args.runs):
+                (seconds, packets, cpu, reads, writes) = run(binfile, datfile, hashlib.sha256(image).hexdigest(),
+                                                             args.prn, batch)
+                print("%-11s %8.3f %8d %10.0f %14.1f %16s" % (
+                    "batched" if batch else "per packet", seconds, packets, packets / seconds,
+                    cpu * 1e6 / packets, "%.2f (%.2f w)" % ((reads + writes) / float(packets), writes / float(packets))))
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
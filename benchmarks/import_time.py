@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Import time budget.
+
+ Imports each entry point in a fresh interpreter with `-X importtime`, takes
+ the best of several runs and fails if the import time on top of `logging`
+ (which any caller has loaded anyway) exceeds its budget, or if a module that
+ should only be loaded on first use (transports, HEX parser, interactive
+ pieces) is imported eagerly. Budgets are multiples of the time `logging`
+ itself takes to import, so they hold on slow and fast machines alike.
+
+   python benchmarks/import_time.py [--runs N] [--scale F]
+------------------------------------------------------------------------------
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+BASELINE = "logging"
+
+# module -> (budget over the baseline in baseline units, modules that must not be imported)
+BUDGETS = {
+    "ota_dfu_python.dfu": (1.5, ["pexpect", "asyncio", "subprocess", "intelhex", "sqlite3", "bleak", "jeepney",
+                           "PyInquirer"]),
+    "ota_dfu_python.cli": (3.0, ["pexpect", "asyncio", "intelhex", "bleak", "jeepney", "PyInquirer"]),
+}
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def measure(module):
+    """Returns (cumulative import time in us, set of imported module names)"""
+    env = dict(os.environ, PYTHONPATH=SRC + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         stderr=subprocess.PIPE, universal_newlines=True, env=env, check=True)
+
+    cumulative = None
+    modules = set()
+    for line in res.stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        name = match.group(4)
+        modules.add(name.split('.')[0])
+        if name == module:
+            cumulative = int(match.group(2))
+
+    return cumulative, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='Runs per module, the best one counts.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply budgets, for slow machines.')
+    args = parser.parse_args()
+
+    baseline = min(measure(BASELINE)[0] for _ in range(args.runs)) / 1000.0
+    print("%-24s %7.1f ms (baseline)" % (BASELINE, baseline))
+
+    failed = False
+    for module, (budget_units, forbidden) in BUDGETS.items():
+        results = [measure(module) for _ in range(args.runs)]
+        best = min(cumulative for cumulative, _ in results) / 1000.0 - baseline
+        imported = results[0][1]
+
+        budget = budget_units * baseline * args.scale
+        eager = sorted(name for name in forbidden if name in imported)
+        ok = best <= budget and not eager
+        failed |= not ok
+
+        print("%-24s %+7.1f ms (budget %.0f ms) %s" % (module, best, budget, "ok" if ok else "FAIL"))
+        if eager:
+            print("    imported eagerly: " + ", ".join(eager))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
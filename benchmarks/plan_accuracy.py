@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Accuracy of the campaign planner on a simulated fleet.
+
+ A first campaign with a FleetScheduler updates part of a simulated fleet
+ (see fleet_schedule.py) and records each device's history. The planner
+ then predicts a second campaign with a larger image: the whole fleet,
+ so also devices never updated, which are estimated from their model.
+ That campaign is then run. Reports the predicted and actual durations and
+ devices updated for each concurrency. Failures are random in both, so
+ devices updated differ by a few.
+
+   python benchmarks/plan_accuracy.py [--devices N] [-j N] [--time-scale F]
+------------------------------------------------------------------------------
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fleet_schedule import fleet
+from soak import addresses, init_packet
+
+from ota_dfu_python.jobs import JobStore, JobWorker, JobStates
+from ota_dfu_python.metrics import Registry
+from ota_dfu_python.planner import CampaignPlanner
+from ota_dfu_python.retry import RetryPolicy
+from ota_dfu_python.scheduler import AdaptiveConcurrency, DeviceHistory, FleetScheduler
+from ota_dfu_python.simulator import SimulatedTransport
+
+MODELS = ("SNS-1", "SNS-2")
+
+
+def package(directory, size):
+    image = bytes(random.Random(size).getrandbits(8) for _ in range(size))
+    binfile = os.path.join(directory, "app%d.bin" % size)
+    datfile = os.path.join(directory, "app%d.dat" % size)
+    with open(binfile, 'wb') as f:
+        f.write(image)
+    with open(datfile, 'wb') as f:
+        f.write(init_packet(image))
+    return binfile, datfile
+
+
+def campaign(args, targets, files, concurrency, history):
+    """Updates targets. Returns (simulated seconds, devices updated)."""
+    air = fleet(args.devices, args.weak_share, None, 0.0)
+    store = JobStore(":memory:")
+    try:
+        for address in targets:
+            store.add(address, *files)
+        worker = JobWorker(store, max_attempts=1,
+                           transport_factory=lambda address: SimulatedTransport(address, air,
+                                                                                time_scale=args.time_scale),
+                           metrics_registry=Registry(), retry=RetryPolicy(attempts=3, base_delay=0.5),
+                           scheduler=FleetScheduler(history, AdaptiveConcurrency(concurrency), scan_timeout=0.5))
+        start = time.time()
+        worker.run()
+        return (time.time() - start) / args.time_scale, len(store.jobs(JobStates.DONE))
+    finally:
+        store.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare planned and simulated campaign durations.")
+    parser.add_argument('--devices', type=int, default=30, help='Devices in the fleet.')
+    parser.add_argument('--learned', type=float, default=0.5, help='Share of the fleet in the first campaign.')
+    parser.add_argument('--weak-share', type=float, default=0.3, help='Share of devices with a weak signal.')
+    parser.add_argument('-j', '--concurrency', type=int, default=4, help='Maximum concurrent sessions.')
+    parser.add_argument('--image-size', type=int, default=16384, help='Image size of the first campaign.')
+    parser.add_argument('--time-scale', type=float, default=0.1,
+                        help='Real seconds per simulated second. The CPU time of sessions counts as simulated '
+                             'time divided by this, so small scales inflate the actual durations.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    targets = addresses(args.devices)
+    models = {address: MODELS[i % len(MODELS)] for i, address in enumerate(targets)}
+    directory = tempfile.mkdtemp(prefix="ota_dfu_plan_")
+    try:
+        history = DeviceHistory()
+        learned = targets[:int(args.learned * len(targets))]
+        campaign(args, learned, package(directory, args.image_size), args.concurrency, history)
+
+        # Last RSSI as a site survey would give it, for every device
+        air = fleet(args.devices, args.weak_share, None, 0.0)
+        devices = [{"address": address, "rssi": air.find(address).rssi, "model": models[address]}
+                   for address in targets]
+        image_size = args.image_size * 2
+        files = package(directory, image_size)
+        plan = CampaignPlanner(devices, image_size, history, models).plan(args.concurrency, runs=20)
+
+        print("%4s %12s %12s %10s %10s" % ("-j", "planned s", "actual s", "planned", "updated"))
+        for result in plan["results"]:
+            (seconds, updated) = campaign(args, targets, files, result["concurrency"], DeviceHistory())
+            print("%4d %12.0f %12.0f %10.1f %10d" % (result["concurrency"], result["mean_duration"], seconds,
+                                                     result["mean_updated"], updated))
+        print("recommended: -j %d" % plan["recommended"])
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Resource soak test.
+
+ Runs thousands of simulated DFU sessions through JobWorker, in batches that
+ each unpack the package afresh, with a share of sessions failing (link
+ lost beyond the retries, device missing). Sessions over gatttool are run
+ against a fake gatttool whose link drops on connect, and some are dropped
+ without being closed, to exercise the finalizers. After a warm-up batch,
+ open file descriptors, child processes (zombies included), threads, temp
+ directories and tracked resources must stay flat, and memory may only grow
+ by a little. Python objects may only grow by what the init packet caches
+ hold: each batch unpacks to new paths, so the caches fill up over the first
+ 16 batches and stay full.
+
+   python benchmarks/soak.py [--sessions N] [--batch N] [-j N] [--gatttool N]
+------------------------------------------------------------------------------
+"""
+import argparse
+import gc
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ota_dfu_python import resources
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.jobs import JobStore, JobWorker, JobStates
+from ota_dfu_python.metrics import Registry
+from ota_dfu_python.retry import RetryPolicy
+from ota_dfu_python.simulator import SimulatedAir, SimulatedDevice, SimulatedTransport
+from ota_dfu_python.unpacker import Unpacker
+
+PACKAGE_NAME = "soakpkg"
+
+FAKE_GATTTOOL = """#!%s
+import sys
+sys.stdout.write("[LE]> ")
+sys.stdout.flush()
+for line in sys.stdin:
+    command = line.strip()
+    if command == "exit":
+        break
+    if command == "connect":
+        # The link drops: gatttool goes away
+        sys.exit(1)
+    sys.stdout.write("[LE]> ")
+    sys.stdout.flush()
+""" % sys.executable
+
+FAKE_HCITOOL = """#!/bin/sh
+echo "Operation not permitted" >&2
+exit 1
+"""
+
+
+def _varint(value):
+    out = b''
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out += bytes([byte | 0x80])
+        else:
+            return out + bytes([byte])
+
+
+def _field(number, wire_type, payload):
+    key = _varint(number << 3 | wire_type)
+    if wire_type == 0:
+        return key + _varint(payload)
+    return key + _varint(len(payload)) + payload
+
+
+def init_packet(image, hw_version=52, sd_version=0xB7):
+    """A signed application init packet for image (the signature is not checked)"""
+    digest = hashlib.sha256(image).digest()[::-1]
+    init = (_field(1, 0, 1) + _field(2, 0, hw_version) + _field(3, 2, _varint(sd_version)) + _field(4, 0, 0)
+            + _field(7, 0, len(image)) + _field(8, 2, _field(1, 0, 3) + _field(2, 2, digest)))
+    command = _field(1, 0, 1) + _field(2, 2, init)
+    return _field(2, 2, _field(1, 2, command) + _field(2, 0, 0) + _field(3, 2, b'\x11' * 64))
+
+
+def make_package(directory, image_size):
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(image_size))
+    path = os.path.join(directory, PACKAGE_NAME + ".zip")
+    with zipfile.ZipFile(path, 'w') as package:
+        package.writestr("app.bin", image)
+        package.writestr("app.dat", init_packet(image))
+    return path
+
+
+def make_fake_tools(directory):
+    for name, script in (("gatttool", FAKE_GATTTOOL), ("hcitool", FAKE_HCITOOL)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+
+def children():
+    """Processes whose parent is this one, zombies included"""
+    count = 0
+    me = os.getpid()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command may contain spaces, the fields after it do not
+        if int(stat.rsplit(')', 1)[1].split()[1]) == me:
+            count += 1
+    return count
+
+
+def sample():
+    gc.collect()
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    temp_dirs = [name for name in os.listdir(tempfile.gettempdir()) if name.startswith(PACKAGE_NAME + "_")]
+    return {
+        "fds": len(os.listdir('/proc/self/fd')),
+        "children": children(),
+        "threads": threading.active_count(),
+        "temp_dirs": len(temp_dirs),
+        "resources": sum(resources.live().values()),
+        "objects": len(gc.get_objects()),
+        "rss_mb": rss / 1e6,
+    }
+
+
+def addresses(count):
+    # Spaced out, so that no bootloader address (+1) is another device's
+    return ["AA:BB:CC:%02X:%02X:00" % (i >> 8, i & 0xff) for i in range(count)]
+
+
+def simulated_batch(package, count, concurrency, registry):
+    """Returns the job states of one batch"""
+    air = SimulatedAir()
+    targets = addresses(count)
+    for i, address in enumerate(targets):
+        if i % 15 == 7:
+            continue    # never found
+        # Every tenth device drops the link more often than the retries allow
+        losses = range(1, 10000, 40) if i % 10 == 3 else ()
+        air.add(SimulatedDevice(address, link_losses=losses))
+
+    with Unpacker() as unpacker:
+        binfile, datfile = unpacker.unpack_zipfile(package)
+        store = JobStore(":memory:")
+        try:
+            for address in targets:
+                store.add(address, binfile, datfile)
+            worker = JobWorker(store, concurrency=concurrency, max_attempts=1,
+                               transport_factory=lambda address: SimulatedTransport(address, air),
+                               metrics_registry=registry, retry=RetryPolicy(attempts=2, base_delay=0.0))
+            worker.run()
+            return store.summary()["states"]
+        finally:
+            store.close()
+
+
+def gatttool_batch(package, count):
+    """Sessions over the fake gatttool. Every other one is dropped unused, without close(), as after an
+    exception between creating a session and running it. Returns failures."""
+    from ota_dfu_python.transport import GatttoolTransport
+
+    failures = 0
+    with Unpacker() as unpacker:
+        binfile, datfile = unpacker.unpack_zipfile(package)
+        for i, address in enumerate(addresses(count)):
+            dfu = SecureDfu(address, binfile, datfile, GatttoolTransport(address),
+                            retry=RetryPolicy(attempts=2, base_delay=0.0), scan_timeout=0.05,
+                            reboot_min_delay=0.0, reboot_delay=0.0)
+            if i % 2 == 0:
+                with dfu:
+                    try:
+                        dfu.perform_dfu()
+                    except Exception:
+                        failures += 1
+            # The gatttool of a dropped one is reaped by its finalizer
+            del dfu
+            gc.collect()
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check that DFU sessions leave no resources behind.")
+    parser.add_argument('--sessions', type=int, default=2000, help='Simulated sessions in total.')
+    parser.add_argument('--batch', type=int, default=100, help='Sessions per batch (one package unpack).')
+    parser.add_argument('-j', '--concurrency', type=int, default=4, help='Concurrent sessions.')
+    parser.add_argument('--gatttool', type=int, default=20, help='Sessions over a fake gatttool per batch.')
+    parser.add_argument('--image-size', type=int, default=16384, help='Firmware image size in bytes.')
+    parser.add_argument('--max-growth-mb', type=float, default=8.0, help='Allowed RSS growth after warm-up.')
+    parser.add_argument('--max-object-growth', type=int, default=200,
+                        help='Allowed growth of the number of Python objects after warm-up, as the bounded '
+                             'init packet caches fill.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix="ota_dfu_soak_")
+    path = os.environ.get("PATH", "")
+    try:
+        package = make_package(workdir, args.image_size)
+        make_fake_tools(workdir)
+        os.environ["PATH"] = workdir + os.pathsep + path
+
+        registry = Registry()
+        batches = max(1, args.sessions // args.batch)
+        columns = ("fds", "children", "threads", "temp_dirs", "resources", "objects", "rss_mb")
+        print("%5s %6s %6s %8s " % ("batch", "done", "failed", "seconds") + " ".join("%9s" % c for c in columns))
+
+        baseline = None
+        sessions = 0
+        for batch in range(batches + 1):
+            start = time.time()
+            states = simulated_batch(package, args.batch, args.concurrency, registry)
+            failed = gatttool_batch(package, args.gatttool) if args.gatttool else 0
+            sessions += args.batch + args.gatttool
+            now = sample()
+            print("%5s %6d %6d %8.1f " % ("warm" if batch == 0 else batch, states[JobStates.DONE],
+                                          states[JobStates.FAILED] + failed, time.time() - start)
+                  + " ".join("%9s" % ("%.1f" % now[c] if c == "rss_mb" else now[c]) for c in columns))
+            if baseline is None:
+                baseline = now
+    finally:
+        os.environ["PATH"] = path
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    problems = []
+    for name in ("fds", "children", "threads", "temp_dirs", "resources"):
+        if now[name] > baseline[name]:
+            problems.append("%s grew from %d to %d" % (name, baseline[name], now[name]))
+    if now["objects"] - baseline["objects"] > args.max_object_growth:
+        problems.append("objects grew from %d to %d" % (baseline["objects"], now["objects"]))
+    if now["rss_mb"] - baseline["rss_mb"] > args.max_growth_mb:
+        problems.append("RSS grew from %.1f to %.1f MB" % (baseline["rss_mb"], now["rss_mb"]))
+
+    print("%d sessions, %s reaped by finalizers" % (sessions, resources.leaked() or "nothing"))
+    for problem in problems:
+        print("LEAK: " + problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
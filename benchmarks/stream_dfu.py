@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Streaming DFU of simulated devices passing by.
+
+ Each device comes within range now and then: over a pass its RSSI rises
+ from below the adapter's sensitivity to a peak and falls off again, losing
+ more packets the weaker it is. A StreamingUpdater consumes the scans of a
+ simulated adapter and updates the devices as they pass:
+
+   guarded      sessions run under an RssiGuard and resume on the next pass
+   unguarded    sessions run until the link drops, and resume
+   restart      unguarded, and the bootloaders forget partial transfers,
+                so each pass starts the image over
+
+ Sessions sleep for --time-scale of their simulated time; times are in
+ simulated seconds. Reports devices updated, when the last one was, the
+ sessions: preempted, resumed (of jobs with progress recorded, which the
+ restarting bootloaders have lost) and failed, and packets sent per packet
+ of the image, for each of --runs sets of passes (seeds from --seed) and
+ their mean.
+
+   python benchmarks/stream_dfu.py [--devices N] [-j N] [--runs N] [--image-size N] [--time-scale F]
+------------------------------------------------------------------------------
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from soak import addresses, init_packet
+
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.jobs import JobStore, JobWorker, JobStates
+from ota_dfu_python.metrics import Registry
+from ota_dfu_python.retry import RetryPolicy
+from ota_dfu_python.simulator import SimulatedAir, SimulatedDevice, SimulatedTransport
+from ota_dfu_python.stream import SCAN_ADDRESS, RssiGuard, StreamingUpdater, scan_sightings
+
+OUT_OF_RANGE = -120
+EDGE = -104
+
+
+class ForgetfulDevice(SimulatedDevice):
+    """A bootloader that starts over after losing the link mid-transfer"""
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @connected.setter
+    def connected(self, value):
+        if not value and getattr(self, "_connected", False) and not self.app_mode:
+            self.reset_bootloader_state()
+        self._connected = value
+
+
+def passes(rng, duration):
+    """(start, dwell, peak RSSI) of a device's passes within duration"""
+    result = []
+    start = rng.uniform(0, 30)
+    while start < duration:
+        dwell = rng.uniform(15, 30)
+        result.append((start, dwell, rng.randint(-75, -55)))
+        start += dwell + rng.uniform(20, 60)
+    return result
+
+
+def rssi_at(schedule, t):
+    for (start, dwell, peak) in schedule:
+        if start <= t < start + dwell:
+            # Closest half way through the pass
+            return EDGE + (peak - EDGE) * (1.0 - abs(2.0 * (t - start) / dwell - 1.0))
+    return OUT_OF_RANGE
+
+
+def move(devices, schedules, time_scale, stop, step=0.25):
+    """Move the devices along their passes in (scaled) real time"""
+    start = time.time()
+    while not stop.wait(step * time_scale):
+        t = (time.time() - start) / time_scale
+        for device in devices:
+            device.rssi = rssi_at(schedules[device.address], t)
+            device.packet_loss = max(0.0, -80 - device.rssi) * 0.003
+
+
+def clean_packets(binfile, datfile):
+    """Packets of one transfer without losses"""
+    device = SimulatedDevice("AA:BB:CC:DD:EE:FF")
+    with SecureDfu(device.address, binfile, datfile, SimulatedTransport(device.address, SimulatedAir([device]))) as dfu:
+        dfu.perform_dfu()
+    return device.packets
+
+
+def run(args, binfile, datfile, mode, seed):
+    rng = random.Random(seed)
+    targets = addresses(args.devices)
+    schedules = {address: passes(rng, args.duration) for address in targets}
+    cls = ForgetfulDevice if mode == "restart" else SimulatedDevice
+    devices = [cls(address, rssi=OUT_OF_RANGE) for address in targets]
+    air = SimulatedAir(devices)
+
+    guard = {name: value for name, value in (("floor", args.floor), ("drop", args.drop)) if value is not None}
+    options = {"link_guard": RssiGuard(**guard)} if mode == "guarded" else {}
+    store = JobStore(":memory:")
+    stop = threading.Event()
+    try:
+        worker = JobWorker(store, concurrency=args.concurrency, max_attempts=args.sessions,
+                           transport_factory=lambda address: SimulatedTransport(address, air,
+                                                                                time_scale=args.time_scale),
+                           controller_options=options, metrics_registry=Registry(),
+                           retry=RetryPolicy(attempts=2, base_delay=1.0))
+        updater = StreamingUpdater(worker, binfile, datfile, patterns=["AA:BB:CC:*"], cooldown=5.0,
+                                   clock=lambda: time.time() / args.time_scale)
+
+        def watch():
+            # Stop once every device has finished, or at the end of the passes
+            deadline = time.time() + args.duration * args.time_scale
+            while not stop.wait(0.05):
+                finished = [job for job in store.jobs() if job.state in (JobStates.DONE, JobStates.FAILED)]
+                if len(finished) == len(targets) or time.time() > deadline:
+                    updater.stop()
+                    stop.set()
+
+        threads = [threading.Thread(target=move, args=(devices, schedules, args.time_scale, stop)),
+                   threading.Thread(target=watch)]
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        scanner = SimulatedTransport(SCAN_ADDRESS, air, time_scale=args.time_scale)
+        results = updater.run(scan_sightings(scanner, interval=1.0, stop=stop))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        done = store.jobs(JobStates.DONE)
+    finally:
+        store.close()
+
+    last = max([(job.finished - start) / args.time_scale for job in done] or [0.0])
+    preempted = sum(1 for result in results if result.get("preempted"))
+    resumed = sum(1 for result in results if result.get("resumed_from"))
+    failed = sum(1 for result in results if "error" in result and not result.get("preempted"))
+    image_packets = clean_packets(binfile, datfile)
+    sent = sum(device.packets for device in devices)
+    row = (len(done), last, len(results), preempted, resumed, failed, sent / float(max(1, len(done)) * image_packets))
+    report("%s #%d" % (mode, seed), row)
+    return row
+
+
+def report(name, row):
+    print("%-16s %6.1f %8.0f %9.1f %10.1f %8.1f %8.1f %12.2f" % ((name,) + tuple(row)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare streaming DFU modes on simulated passing devices.")
+    parser.add_argument('--devices', type=int, default=12, help='Devices passing by.')
+    parser.add_argument('-j', '--concurrency', type=int, default=4, help='Concurrent sessions.')
+    parser.add_argument('--image-size', type=int, default=262144, help='Firmware image size in bytes.')
+    parser.add_argument('--duration', type=float, default=600.0, help='Simulated seconds of passes.')
+    parser.add_argument('--sessions', type=int, default=20, help='Sessions per device before giving up.')
+    parser.add_argument('--floor', type=float, default=None, help='RSSI floor of the guard, dBm.')
+    parser.add_argument('--drop', type=float, default=None, help='RSSI drop from the peak the guard allows, dB.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the first run\'s passes.')
+    parser.add_argument('--runs', type=int, default=3, help='Runs, each with the next seed.')
+    parser.add_argument('--time-scale', type=float, default=0.05, help='Real seconds per simulated second.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(args.image_size))
+    directory = tempfile.mkdtemp(prefix="ota_dfu_stream_")
+    binfile = os.path.join(directory, "app.bin")
+    datfile = os.path.join(directory, "app.dat")
+    with open(binfile, 'wb') as f:
+        f.write(image)
+    with open(datfile, 'wb') as f:
+        f.write(init_packet(image))
+
+    try:
+        print("%-16s %6s %8s %9s %10s %8s %8s %12s" % ("mode", "done", "last at", "sessions", "preempted",
+                                                       "resumed", "failed", "sent/image"))
+        rows = {"guarded": [], "unguarded": [], "restart": []}
+        for seed in range(args.seed, args.seed + args.runs):
+            for mode, mode_rows in rows.items():
+                mode_rows.append(run(args, binfile, datfile, mode, seed))
+        for mode, mode_rows in rows.items():
+            report("%s mean" % mode, [sum(column) / len(column) for column in zip(*mode_rows)])
+    finally:
+        for name in (binfile, datfile):
+            os.remove(name)
+        os.rmdir(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
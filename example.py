@@ -1,17 +1,16 @@
 import logging
 import argparse
-import asyncio
 import time
 import sys
 
-from PyInquirer import prompt, style_from_dict, Token
-from bleak import discover
 from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.events import ProgressBar
 from ota_dfu_python.unpacker import Unpacker
 
 def select_ble_device(devices):
     """Select device used for DFU"""
-    
+    from PyInquirer import prompt
+
     question_devices = [
         {
             "type": "list",
@@ -27,6 +26,8 @@ def select_ble_device(devices):
 
 def get_ble_devices(loop):
     """Finds all devices containg 'identifier' in name"""
+    from bleak import discover
+
     try:
         logging.info("Starting BLE device discovery")
         device_list = []
@@ -83,6 +84,9 @@ else:
 if address is None:
     logging.warning("No device address specified.")
     time.sleep(1)
+    # Discovery and prompts are only needed without an address, so their
+    # (slow to import) dependencies are loaded here
+    import asyncio
     loop = asyncio.get_event_loop()
     devices = get_ble_devices(loop)
     selected_device = select_ble_device(devices)
@@ -102,6 +106,7 @@ if hexfile is not None and datfile is not None:
         try:
             # initialize dfu class
             dfu = SecureDfu(address, hexfile, datfile)
+            dfu.subscribe(ProgressBar(), min_interval=0.1)
             dfu.perform_dfu()
             success = True
             if not success:
@@ -34,6 +34,17 @@ setup(
     install_requires=[
         "pexpect", 
     ],
+    extras_require={
+        "hex": ["intelhex"],
+        "bluez": ["jeepney>=0.7"],
+    },
+    entry_points={
+        "console_scripts": [
+            "ota-dfu = ota_dfu_python.cli:main",
+            "ota-dfu-calibrate = ota_dfu_python.calibration:main",
+            "ota-dfu-plan = ota_dfu_python.planner:main",
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
@@ -0,0 +1,100 @@
+"""
+------------------------------------------------------------------------------
+ Learned bootloader addresses.
+
+ Secure DFU bootloaders usually advertise at the application address + 1,
+ but some keep the application address. AddressMap remembers, per device
+ and per model (e.g. hardware version), at which offset from the
+ application address the bootloader was found, so the most likely address
+ is tried first. With a path the map is persisted as JSON.
+------------------------------------------------------------------------------
+"""
+import json
+import logging
+import os
+import threading
+
+from ota_dfu_python.util import mac_string_to_uint, uint_to_mac_string
+
+# Offsets tried when nothing is known, most likely first
+DEFAULT_OFFSETS = (1, 0)
+
+
+def offset_address(address, offset):
+    return uint_to_mac_string(mac_string_to_uint(address.upper()) + offset)
+
+
+def address_offset(app_address, address):
+    return mac_string_to_uint(address.upper()) - mac_string_to_uint(app_address.upper())
+
+
+class AddressMap(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.devices = {}   # app address -> offset
+        self.models = {}    # model -> {offset: times seen}
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.devices = {address: int(offset) for address, offset in data.get("devices", {}).items()}
+                self.models = {model: {int(offset): count for offset, count in offsets.items()}
+                               for model, offsets in data.get("models", {}).items()}
+            except (OSError, ValueError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable address map {path}: {e}")
+
+    # --------------------------------------------------------------------------
+    #  Bootloader address offsets to try for a device, most likely first:
+    #  what was learned for the device, then for its model, then the defaults
+    # --------------------------------------------------------------------------
+    def offsets(self, address, model=None):
+        ordered = []
+        with self._lock:
+            learned = self.devices.get(address.upper())
+            if learned is not None:
+                ordered.append(learned)
+            if model is not None:
+                counts = self.models.get(str(model), {})
+                ordered.extend(sorted(counts, key=lambda offset: -counts[offset]))
+
+        result = []
+        for offset in ordered + list(DEFAULT_OFFSETS):
+            if offset not in result:
+                result.append(offset)
+        return result
+
+    def learned(self, address):
+        with self._lock:
+            return self.devices.get(address.upper())
+
+    # --------------------------------------------------------------------------
+    #  Record that the bootloader of `address` was found at `offset`
+    # --------------------------------------------------------------------------
+    def record(self, address, offset, model=None):
+        address = address.upper()
+        with self._lock:
+            changed = self.devices.get(address) != offset
+            self.devices[address] = offset
+            if model is not None:
+                counts = self.models.setdefault(str(model), {})
+                counts[offset] = counts.get(offset, 0) + 1
+                changed = True
+            if changed:
+                self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        data = {
+            "devices": self.devices,
+            "models": {model: {str(offset): count for offset, count in offsets.items()}
+                       for model, offsets in self.models.items()},
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
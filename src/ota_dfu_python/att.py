@@ -0,0 +1,640 @@
+"""
+------------------------------------------------------------------------------
+ Attribute Protocol over a raw LE L2CAP socket.
+
+ AttTransport opens the ATT fixed channel (CID 4) to the peripheral itself
+ and speaks ATT: MTU exchange, characteristic and descriptor discovery,
+ reads, write requests and commands, notifications and indications. There
+ is no gatttool output to parse and no hop through bluetoothd; a write
+ command is one send() on the socket. Meant for dedicated gateways: keep
+ bluetoothd from connecting to the targets itself, or its GATT client
+ shares the channel.
+
+ The codec encodes and decodes PDUs with precompiled struct formats, both
+ directions, so that a stand-in peripheral can be served from the same
+ code. AttClient is the client side of one bearer over any connected
+ SOCK_SEQPACKET socket, e.g. one end of a socketpair.
+------------------------------------------------------------------------------
+"""
+import collections
+import logging
+import select
+import socket
+import struct
+import time
+
+from ota_dfu_python import resources
+from ota_dfu_python.codec import CodecError
+from ota_dfu_python.transport import HcitoolSupport, Transport
+
+ATT_CID = 4
+DEFAULT_MTU = 23
+
+BDADDR_LE_PUBLIC = 1
+BDADDR_LE_RANDOM = 2
+ADDRESS_TYPES = {"public": BDADDR_LE_PUBLIC, "random": BDADDR_LE_RANDOM}
+
+UUID_PRIMARY_SERVICE = 0x2800
+UUID_CHARACTERISTIC = 0x2803
+UUID_CCCD = 0x2902
+
+# Characteristic properties
+PROP_READ = 0x02
+PROP_WRITE_WITHOUT_RESPONSE = 0x04
+PROP_WRITE = 0x08
+PROP_NOTIFY = 0x10
+PROP_INDICATE = 0x20
+
+_BASE_UUID = "-0000-1000-8000-00805f9b34fb"
+
+
+class AttOpcodes:
+    ERROR_RSP               = 0x01
+    EXCHANGE_MTU_REQ        = 0x02
+    EXCHANGE_MTU_RSP        = 0x03
+    FIND_INFORMATION_REQ    = 0x04
+    FIND_INFORMATION_RSP    = 0x05
+    READ_BY_TYPE_REQ        = 0x08
+    READ_BY_TYPE_RSP        = 0x09
+    READ_REQ                = 0x0A
+    READ_RSP                = 0x0B
+    WRITE_REQ               = 0x12
+    WRITE_RSP               = 0x13
+    HANDLE_VALUE_NTF        = 0x1B
+    HANDLE_VALUE_IND        = 0x1D
+    HANDLE_VALUE_CFM        = 0x1E
+    WRITE_CMD               = 0x52
+
+    # Opcodes with this bit set are commands, never answered
+    COMMAND_FLAG            = 0x40
+
+    RESPONSES = {
+        EXCHANGE_MTU_REQ        : EXCHANGE_MTU_RSP,
+        FIND_INFORMATION_REQ    : FIND_INFORMATION_RSP,
+        READ_BY_TYPE_REQ        : READ_BY_TYPE_RSP,
+        READ_REQ                : READ_RSP,
+        WRITE_REQ               : WRITE_RSP,
+    }
+
+    string_map = {
+        ERROR_RSP               : "ERROR_RSP",
+        EXCHANGE_MTU_REQ        : "EXCHANGE_MTU_REQ",
+        EXCHANGE_MTU_RSP        : "EXCHANGE_MTU_RSP",
+        FIND_INFORMATION_REQ    : "FIND_INFORMATION_REQ",
+        FIND_INFORMATION_RSP    : "FIND_INFORMATION_RSP",
+        READ_BY_TYPE_REQ        : "READ_BY_TYPE_REQ",
+        READ_BY_TYPE_RSP        : "READ_BY_TYPE_RSP",
+        READ_REQ                : "READ_REQ",
+        READ_RSP                : "READ_RSP",
+        WRITE_REQ               : "WRITE_REQ",
+        WRITE_RSP               : "WRITE_RSP",
+        HANDLE_VALUE_NTF        : "HANDLE_VALUE_NTF",
+        HANDLE_VALUE_IND        : "HANDLE_VALUE_IND",
+        HANDLE_VALUE_CFM        : "HANDLE_VALUE_CFM",
+        WRITE_CMD               : "WRITE_CMD",
+    }
+
+    @staticmethod
+    def to_string(opcode):
+        return AttOpcodes.string_map.get(opcode, "UNKNOWN(0x%02x)" % opcode)
+
+
+class AttErrors:
+    INVALID_HANDLE                  = 0x01
+    READ_NOT_PERMITTED              = 0x02
+    WRITE_NOT_PERMITTED             = 0x03
+    INVALID_PDU                     = 0x04
+    INSUFFICIENT_AUTHENTICATION     = 0x05
+    REQUEST_NOT_SUPPORTED           = 0x06
+    INVALID_OFFSET                  = 0x07
+    INSUFFICIENT_AUTHORIZATION      = 0x08
+    PREPARE_QUEUE_FULL              = 0x09
+    ATTRIBUTE_NOT_FOUND             = 0x0A
+    ATTRIBUTE_NOT_LONG              = 0x0B
+    INSUFFICIENT_KEY_SIZE           = 0x0C
+    INVALID_VALUE_LENGTH            = 0x0D
+    UNLIKELY_ERROR                  = 0x0E
+    INSUFFICIENT_ENCRYPTION         = 0x0F
+    UNSUPPORTED_GROUP_TYPE          = 0x10
+    INSUFFICIENT_RESOURCES          = 0x11
+
+    string_map = {
+        INVALID_HANDLE                  : "INVALID_HANDLE",
+        READ_NOT_PERMITTED              : "READ_NOT_PERMITTED",
+        WRITE_NOT_PERMITTED             : "WRITE_NOT_PERMITTED",
+        INVALID_PDU                     : "INVALID_PDU",
+        INSUFFICIENT_AUTHENTICATION     : "INSUFFICIENT_AUTHENTICATION",
+        REQUEST_NOT_SUPPORTED           : "REQUEST_NOT_SUPPORTED",
+        INVALID_OFFSET                  : "INVALID_OFFSET",
+        INSUFFICIENT_AUTHORIZATION      : "INSUFFICIENT_AUTHORIZATION",
+        PREPARE_QUEUE_FULL              : "PREPARE_QUEUE_FULL",
+        ATTRIBUTE_NOT_FOUND             : "ATTRIBUTE_NOT_FOUND",
+        ATTRIBUTE_NOT_LONG              : "ATTRIBUTE_NOT_LONG",
+        INSUFFICIENT_KEY_SIZE           : "INSUFFICIENT_ENCRYPTION_KEY_SIZE",
+        INVALID_VALUE_LENGTH            : "INVALID_ATTRIBUTE_VALUE_LENGTH",
+        UNLIKELY_ERROR                  : "UNLIKELY_ERROR",
+        INSUFFICIENT_ENCRYPTION         : "INSUFFICIENT_ENCRYPTION",
+        UNSUPPORTED_GROUP_TYPE          : "UNSUPPORTED_GROUP_TYPE",
+        INSUFFICIENT_RESOURCES          : "INSUFFICIENT_RESOURCES",
+    }
+
+    @staticmethod
+    def to_string(code):
+        return AttErrors.string_map.get(code, "UNKNOWN(0x%02x)" % code)
+
+
+class AttError(Exception):
+    """The peripheral answered a request with an error response"""
+
+    def __init__(self, request, handle, code):
+        Exception.__init__(self, "{} on handle 0x{:04x} failed: {}".format(
+            AttOpcodes.to_string(request), handle, AttErrors.to_string(code)))
+        self.request = request
+        self.handle = handle
+        self.code = code
+
+
+# ------------------------------------------------------------------------------
+#  UUIDs: 16 bit ones as int or in the Bluetooth base UUID, 128 bit ones as
+#  strings; little endian on the air
+# ------------------------------------------------------------------------------
+def uuid_to_bytes(uuid):
+    if isinstance(uuid, int):
+        return struct.pack('<H', uuid)
+    uuid = uuid.lower()
+    if uuid.startswith("0000") and uuid.endswith(_BASE_UUID):
+        return struct.pack('<H', int(uuid[4:8], 16))
+    return bytes.fromhex(uuid.replace('-', ''))[::-1]
+
+
+def uuid_from_bytes(data):
+    if len(data) == 2:
+        return "0000%04x%s" % (struct.unpack('<H', data)[0], _BASE_UUID)
+    if len(data) != 16:
+        raise CodecError("Invalid UUID length: {}".format(len(data)))
+    h = bytes(data[::-1]).hex()
+    return "%s-%s-%s-%s-%s" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+# ------------------------------------------------------------------------------
+#  Encoding
+# ------------------------------------------------------------------------------
+_OPCODE = struct.Struct('<B')
+_OPCODE_U16 = struct.Struct('<BH')
+_RANGE = struct.Struct('<BHH')
+_ERROR = struct.Struct('<BBHB')
+_HANDLE = struct.Struct('<H')
+_DECLARATION = struct.Struct('<BH')
+
+
+def encode_exchange_mtu_req(mtu):
+    return _OPCODE_U16.pack(AttOpcodes.EXCHANGE_MTU_REQ, mtu)
+
+def encode_exchange_mtu_rsp(mtu):
+    return _OPCODE_U16.pack(AttOpcodes.EXCHANGE_MTU_RSP, mtu)
+
+def encode_find_information_req(start, end):
+    return _RANGE.pack(AttOpcodes.FIND_INFORMATION_REQ, start, end)
+
+def encode_read_by_type_req(start, end, uuid):
+    return _RANGE.pack(AttOpcodes.READ_BY_TYPE_REQ, start, end) + uuid_to_bytes(uuid)
+
+def encode_read_req(handle):
+    return _OPCODE_U16.pack(AttOpcodes.READ_REQ, handle)
+
+def encode_write_req(handle, value):
+    return _OPCODE_U16.pack(AttOpcodes.WRITE_REQ, handle) + bytes(value)
+
+def encode_write_cmd(handle, value):
+    return _OPCODE_U16.pack(AttOpcodes.WRITE_CMD, handle) + bytes(value)
+
+def encode_handle_value_cfm():
+    return _OPCODE.pack(AttOpcodes.HANDLE_VALUE_CFM)
+
+def encode_error_rsp(request, handle, code):
+    return _ERROR.pack(AttOpcodes.ERROR_RSP, request, handle, code)
+
+# Server side, for stand-in peripherals
+def encode_find_information_rsp(entries):
+    """entries: [(handle, uuid)], all of one UUID size"""
+    uuids = [uuid_to_bytes(uuid) for (_, uuid) in entries]
+    fmt = 0x01 if len(uuids[0]) == 2 else 0x02
+    return bytes([AttOpcodes.FIND_INFORMATION_RSP, fmt]) + b''.join(
+        _HANDLE.pack(handle) + uuid for ((handle, _), uuid) in zip(entries, uuids))
+
+def encode_read_by_type_rsp(entries):
+    """entries: [(handle, value)], all values of one length"""
+    return bytes([AttOpcodes.READ_BY_TYPE_RSP, 2 + len(entries[0][1])]) + b''.join(
+        _HANDLE.pack(handle) + bytes(value) for (handle, value) in entries)
+
+def encode_read_rsp(value):
+    return _OPCODE.pack(AttOpcodes.READ_RSP) + bytes(value)
+
+def encode_write_rsp():
+    return _OPCODE.pack(AttOpcodes.WRITE_RSP)
+
+def encode_notification(handle, value):
+    return _OPCODE_U16.pack(AttOpcodes.HANDLE_VALUE_NTF, handle) + bytes(value)
+
+def encode_indication(handle, value):
+    return _OPCODE_U16.pack(AttOpcodes.HANDLE_VALUE_IND, handle) + bytes(value)
+
+def encode_characteristic(properties, value_handle, uuid):
+    """The value of a characteristic declaration"""
+    return _DECLARATION.pack(properties, value_handle) + uuid_to_bytes(uuid)
+
+
+# ------------------------------------------------------------------------------
+#  Decoding. All raise CodecError on truncated or malformed PDUs.
+# ------------------------------------------------------------------------------
+def _check(pdu, opcode, size):
+    if len(pdu) < size or pdu[0] != opcode:
+        raise CodecError("Malformed {}: {}".format(AttOpcodes.to_string(opcode), bytes(pdu).hex()))
+
+
+def decode_error_rsp(pdu):
+    """(request opcode, handle, error code)"""
+    _check(pdu, AttOpcodes.ERROR_RSP, _ERROR.size)
+    return _ERROR.unpack_from(pdu)[1:]
+
+
+def decode_mtu(pdu):
+    """The MTU of an EXCHANGE_MTU request or response"""
+    if len(pdu) < _OPCODE_U16.size or pdu[0] not in (AttOpcodes.EXCHANGE_MTU_REQ, AttOpcodes.EXCHANGE_MTU_RSP):
+        raise CodecError("Malformed MTU exchange: {}".format(bytes(pdu).hex()))
+    return _OPCODE_U16.unpack_from(pdu)[1]
+
+
+def decode_find_information_rsp(pdu):
+    """[(handle, uuid)]"""
+    _check(pdu, AttOpcodes.FIND_INFORMATION_RSP, 2)
+    step = {0x01: 4, 0x02: 18}.get(pdu[1])
+    if step is None or (len(pdu) - 2) % step or len(pdu) == 2:
+        raise CodecError("Malformed FIND_INFORMATION_RSP: {}".format(bytes(pdu).hex()))
+    return [(_HANDLE.unpack_from(pdu, i)[0], uuid_from_bytes(pdu[i + 2:i + step]))
+            for i in range(2, len(pdu), step)]
+
+
+def decode_read_by_type_rsp(pdu):
+    """[(handle, value)]"""
+    _check(pdu, AttOpcodes.READ_BY_TYPE_RSP, 2)
+    step = pdu[1]
+    if step < 2 or (len(pdu) - 2) % step or len(pdu) == 2:
+        raise CodecError("Malformed READ_BY_TYPE_RSP: {}".format(bytes(pdu).hex()))
+    return [(_HANDLE.unpack_from(pdu, i)[0], bytes(pdu[i + 2:i + step])) for i in range(2, len(pdu), step)]
+
+
+def decode_characteristic(value):
+    """(properties, value handle, uuid) of a characteristic declaration"""
+    if len(value) not in (5, 19):
+        raise CodecError("Malformed characteristic declaration: {}".format(bytes(value).hex()))
+    (properties, value_handle) = _DECLARATION.unpack_from(value)
+    return properties, value_handle, uuid_from_bytes(value[3:])
+
+
+def decode_handle_value(pdu):
+    """(handle, value) of a notification, indication, write request or command"""
+    if len(pdu) < _OPCODE_U16.size:
+        raise CodecError("Malformed {}: {}".format(AttOpcodes.to_string(pdu[0] if pdu else 0), bytes(pdu).hex()))
+    return _OPCODE_U16.unpack_from(pdu)[1], bytes(pdu[3:])
+
+
+def decode_range(pdu):
+    """(start, end, uuid or None) of a FIND_INFORMATION or READ_BY_TYPE request"""
+    if len(pdu) not in (5, 7, 21):
+        raise CodecError("Malformed {}: {}".format(AttOpcodes.to_string(pdu[0] if pdu else 0), bytes(pdu).hex()))
+    (_, start, end) = _RANGE.unpack_from(pdu)
+    return start, end, uuid_from_bytes(pdu[5:]) if len(pdu) > 5 else None
+
+
+def decode_read_req(pdu):
+    _check(pdu, AttOpcodes.READ_REQ, _OPCODE_U16.size)
+    return _OPCODE_U16.unpack_from(pdu)[1]
+
+
+class AttClient(object):
+    """
+    The client side of one ATT bearer. At most one request is outstanding;
+    notifications and indications (confirmed at once) are queued in arrival
+    order, and requests from the server answered: MTU exchange with our
+    MTU, anything else as not supported.
+    """
+
+    def __init__(self, sock, mtu=247):
+        self.sock = sock
+        self.local_mtu = mtu
+        self.mtu = DEFAULT_MTU
+        self.notifications = collections.deque()
+        self.closed = False
+        self._pending = None
+
+    def send(self, pdu):
+        if len(pdu) > self.mtu:
+            raise Exception(f"{AttOpcodes.to_string(pdu[0])} of {len(pdu)} bytes exceeds the ATT MTU of {self.mtu}")
+        try:
+            self.sock.send(pdu)
+        except OSError as e:
+            logging.debug(f"ATT send failed: {e}")
+            self.closed = True
+
+    # --------------------------------------------------------------------------
+    #  Send a request and return the response PDU, or None if the link went
+    #  down or the timeout passed. Raises AttError for error responses.
+    # --------------------------------------------------------------------------
+    def request(self, pdu, timeout):
+        self._pending = AttOpcodes.RESPONSES[pdu[0]]
+        self.send(pdu)
+        deadline = time.monotonic() + timeout
+        try:
+            while not self.closed:
+                response = self._receive(deadline - time.monotonic())
+                if response is None:
+                    if time.monotonic() >= deadline:
+                        return None
+                    continue
+                if response[0] == AttOpcodes.ERROR_RSP:
+                    (request, handle, code) = decode_error_rsp(response)
+                    raise AttError(request, handle, code)
+                return response
+            return None
+        finally:
+            self._pending = None
+
+    def exchange_mtu(self, timeout):
+        response = self.request(encode_exchange_mtu_req(self.local_mtu), timeout)
+        if response is not None:
+            self.mtu = max(DEFAULT_MTU, min(self.local_mtu, decode_mtu(response)))
+        return self.mtu
+
+    def wait_for_notification(self, timeout):
+        """The value of the next notification or indication, None on timeout or link loss"""
+        deadline = time.monotonic() + timeout
+        while not self.notifications and not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._receive(remaining)
+        if self.notifications:
+            return self.notifications.popleft()[1]
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Handle one incoming PDU, waiting up to timeout for it. Returns it if it
+    #  is the response (or error response) to the pending request.
+    # --------------------------------------------------------------------------
+    def _receive(self, timeout):
+        (ready, _, _) = select.select([self.sock], [], [], max(0.0, timeout))
+        if not ready:
+            return None
+        try:
+            pdu = self.sock.recv(max(self.mtu, self.local_mtu))
+        except OSError as e:
+            logging.debug(f"ATT receive failed: {e}")
+            pdu = b''
+        if not pdu:
+            self.closed = True
+            return None
+
+        opcode = pdu[0]
+        if opcode == AttOpcodes.HANDLE_VALUE_NTF or opcode == AttOpcodes.HANDLE_VALUE_IND:
+            try:
+                self.notifications.append(decode_handle_value(pdu))
+            except CodecError as e:
+                logging.warning(f"Ignoring {e}")
+            if opcode == AttOpcodes.HANDLE_VALUE_IND:
+                self.send(encode_handle_value_cfm())
+            return None
+
+        if opcode == self._pending or (opcode == AttOpcodes.ERROR_RSP and self._pending is not None):
+            return pdu
+
+        if opcode == AttOpcodes.EXCHANGE_MTU_REQ:
+            self.mtu = max(DEFAULT_MTU, min(self.local_mtu, decode_mtu(pdu)))
+            self.send(encode_exchange_mtu_rsp(self.local_mtu))
+        elif opcode & AttOpcodes.COMMAND_FLAG == 0 and opcode not in AttOpcodes.RESPONSES.values() \
+                and opcode not in (AttOpcodes.ERROR_RSP, AttOpcodes.HANDLE_VALUE_CFM):
+            # We are no GATT server
+            self.send(encode_error_rsp(opcode, 0x0000, AttErrors.REQUEST_NOT_SUPPORTED))
+        else:
+            logging.debug(f"Ignoring unexpected {AttOpcodes.to_string(opcode)}")
+        return None
+
+
+# ------------------------------------------------------------------------------
+#  LE L2CAP sockets. Python's socket module has no address format with the
+#  channel id and LE address type, so bind() and connect() go through libc.
+# ------------------------------------------------------------------------------
+_SOCKADDR_L2 = struct.Struct('<HH6sHBx')
+_HCIGETDEVINFO = 0x800448d3
+
+
+def _sockaddr_l2(address, address_type):
+    bdaddr = bytes.fromhex(address.replace(':', ''))[::-1]
+    return _SOCKADDR_L2.pack(socket.AF_BLUETOOTH, 0, bdaddr, ATT_CID, address_type)
+
+
+def adapter_address(adapter):
+    """Address of an adapter given as "hciN" (or already as an address)"""
+    import fcntl
+
+    if adapter is None:
+        return "00:00:00:00:00:00"
+    if ':' in adapter:
+        return adapter
+    with socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI) as hci:
+        info = fcntl.ioctl(hci.fileno(), _HCIGETDEVINFO, struct.pack('<H', int(adapter[3:])) + bytes(126))
+    return ':'.join("%02X" % byte for byte in info[10:16][::-1])
+
+
+def l2cap_connect(address, adapter=None, address_type="random", timeout=2):
+    """A SOCK_SEQPACKET socket connected to the ATT channel of address"""
+    import ctypes
+    import errno
+    import os
+
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    def sockaddr_call(function, sock, addr, addr_type):
+        buf = ctypes.create_string_buffer(_sockaddr_l2(addr, addr_type), _SOCKADDR_L2.size)
+        if function(sock.fileno(), buf, _SOCKADDR_L2.size) == 0:
+            return 0
+        return ctypes.get_errno()
+
+    sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_SEQPACKET, socket.BTPROTO_L2CAP)
+    try:
+        err = sockaddr_call(libc.bind, sock, adapter_address(adapter), BDADDR_LE_PUBLIC)
+        if err:
+            raise OSError(err, "bind: " + os.strerror(err))
+
+        sock.setblocking(False)
+        err = sockaddr_call(libc.connect, sock, address, ADDRESS_TYPES[address_type])
+        if err == errno.EINPROGRESS:
+            (_, writable, _) = select.select([], [sock], [], timeout)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) if writable else errno.ETIMEDOUT
+        if err:
+            raise OSError(err, "connect: " + os.strerror(err))
+        sock.setblocking(True)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _close_socket(sock):
+    sock.close()
+
+
+class AttTransport(HcitoolSupport, Transport):
+    """
+    Speaks ATT to the peripheral over an L2CAP socket of its own. connector
+    (address, timeout) returns the connected socket instead of l2cap_connect,
+    e.g. one end of a socketpair served by a stand-in.
+    """
+
+    def __init__(self, target_mac, adapter=None, address_type="random", mtu=247, connector=None):
+        self.target_mac = target_mac
+        self.adapter = adapter
+        self.address_type = address_type
+        self.mtu = mtu
+        self.connector = connector
+        self.att = None
+        self._socket = None
+        self._characteristics = None
+
+    def connect(self, timeout=2):
+        self.disconnect()
+        start = time.monotonic()
+        try:
+            if self.connector is not None:
+                sock = self.connector(self.target_mac, timeout)
+            else:
+                sock = l2cap_connect(self.target_mac, self.adapter, self.address_type, timeout)
+        except OSError as e:
+            logging.warning(f"Connecting to {self.target_mac} failed: {e}")
+            return False
+
+        self._socket = resources.track(self, "ATT socket", _close_socket, sock)
+        self.att = AttClient(sock, self.mtu)
+        try:
+            mtu = self.att.exchange_mtu(max(0.1, timeout - (time.monotonic() - start)))
+        except AttError as e:
+            logging.debug(f"MTU exchange rejected: {e}")
+            mtu = self.att.mtu
+        logging.debug(f"Connected to {self.target_mac}, ATT MTU {mtu}")
+        return not self.att.closed
+
+    def disconnect(self):
+        if self._socket is not None:
+            self._socket.release()
+            self._socket = None
+        if self.att is not None:
+            self.att.closed = True
+        self._characteristics = None
+
+    def set_target(self, target_mac):
+        self.disconnect()
+        self.target_mac = target_mac
+
+    # --------------------------------------------------------------------------
+    #  All characteristic declarations: {uuid: [declaration handle,
+    #  properties, value handle, CCCD handle or None if not looked up yet]}
+    # --------------------------------------------------------------------------
+    def _discover(self, deadline):
+        characteristics = collections.OrderedDict()
+        start = 0x0001
+        while start <= 0xffff:
+            try:
+                response = self.att.request(encode_read_by_type_req(start, 0xffff, UUID_CHARACTERISTIC),
+                                            deadline - time.monotonic())
+            except AttError as e:
+                if e.code == AttErrors.ATTRIBUTE_NOT_FOUND:
+                    break
+                raise
+            if response is None:
+                return None
+
+            entries = decode_read_by_type_rsp(response)
+            for (handle, value) in entries:
+                (properties, value_handle, uuid) = decode_characteristic(value)
+                characteristics[uuid] = [handle, properties, value_handle, None]
+            start = entries[-1][0] + 1
+        return characteristics
+
+    def _find_cccd(self, characteristic, deadline):
+        (handle, properties, value_handle, _) = characteristic
+        if not properties & (PROP_NOTIFY | PROP_INDICATE):
+            return value_handle + 1
+
+        # Descriptors lie between the value and the next declaration
+        end = min([h for (h, _, _, _) in self._characteristics.values() if h > handle] + [0x10000]) - 1
+        start = value_handle + 1
+        while start <= end:
+            try:
+                response = self.att.request(encode_find_information_req(start, end), deadline - time.monotonic())
+            except AttError:
+                break
+            if response is None:
+                break
+            entries = decode_find_information_rsp(response)
+            for (descriptor, uuid) in entries:
+                if uuid_to_bytes(uuid) == uuid_to_bytes(UUID_CCCD):
+                    return descriptor
+            start = entries[-1][0] + 1
+        return value_handle + 1
+
+    def find_characteristic(self, uuid, timeout=10):
+        if self.att is None or self.att.closed:
+            return None
+        deadline = time.monotonic() + timeout
+
+        try:
+            if self._characteristics is None:
+                self._characteristics = self._discover(deadline)
+                if self._characteristics is None:
+                    return None
+            characteristic = self._characteristics.get(uuid.lower())
+            if characteristic is None:
+                return None
+            if characteristic[3] is None:
+                characteristic[3] = self._find_cccd(characteristic, deadline)
+        except (AttError, CodecError) as e:
+            logging.warning(f"Discovery of {uuid} failed: {e}")
+            return None
+
+        return (characteristic[0], characteristic[2], characteristic[3])
+
+    def read_characteristic(self, uuid, timeout=10):
+        if self.att is None or self.att.closed:
+            return None
+        try:
+            response = self.att.request(encode_read_by_type_req(0x0001, 0xffff, uuid), timeout)
+            if response is None:
+                return None
+            return decode_read_by_type_rsp(response)[0][1]
+        except (AttError, CodecError) as e:
+            logging.debug(f"Reading {uuid} failed: {e}")
+            return None
+
+    def write_request(self, handle, data, timeout=10):
+        if self.att is None or self.att.closed:
+            return False
+        try:
+            return self.att.request(encode_write_req(handle, data), timeout) is not None
+        except AttError as e:
+            logging.error(f"{e}")
+            return False
+
+    def write_command(self, handle, data):
+        if self.att is not None:
+            self.att.send(encode_write_cmd(handle, data))
+
+    def wait_for_notification(self, timeout=2):
+        if self.att is None:
+            return None
+        value = self.att.wait_for_notification(timeout)
+        if value is None and self.att.closed:
+            logging.warning('Connection lost!')
+        return value
+
+    def is_alive(self):
+        return self.att is not None and not self.att.closed
@@ -288,7 +288,8 @@ class BleDfuControllerLegacy(NrfBleDfuController):
         if verbose: print("dfu_send_init")
 
         # Open the DAT file and create array of its contents
-        init_bin_array = array('B', open(self.datfile_path, 'rb').read())
+        with open(self.datfile_path, 'rb') as f:
+            init_bin_array = array('B', f.read())
 
         # Transmit Init info
         self._dfu_send_data(init_bin_array)
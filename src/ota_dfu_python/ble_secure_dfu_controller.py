@@ -1,87 +1,140 @@
 import math
-import pexpect
-import time
 import logging
 
-from array import array
-from ota_dfu_python.util import *
+from ota_dfu_python.codec import (Procedures, CodecError, DfuResponseError, decode_response, encode_create, encode_set_prn,
+                                  encode_calc_checksum, encode_execute, encode_select, encode_firmware_version)
+from ota_dfu_python.events import Phases, PhaseEvent, ProgressEvent, ObjectCommittedEvent, RetransmitEvent
 
 from ota_dfu_python.nrf_ble_dfu_controller import NrfBleDfuController
+from ota_dfu_python.initpacket import validate_package
+from ota_dfu_python.profiling import SessionProfiler
+from ota_dfu_python.retry import LinkLostError, DfuTimeoutError, CrcMismatchError
+from ota_dfu_python.addresses import offset_address
+from ota_dfu_python.packages import FirmwarePackage
 
 verbose = False
 
-class Procedures:
-    CREATE          = 0x01
-    SET_PRN         = 0x02
-    CALC_CHECKSUM   = 0x03
-    EXECUTE         = 0x04
-    SELECT          = 0x06
-    RESPONSE        = 0x60
-
-    PARAM_COMMAND   = 0x01
-    PARAM_DATA      = 0x02
-
-    string_map = {
-        CREATE          : "CREATE",
-        SET_PRN         : "SET_PRN",
-        CALC_CHECKSUM   : "CALC_CHECKSUM",
-        EXECUTE         : "EXECUTE",
-        SELECT          : "SELECT",
-        RESPONSE        : "RESPONSE",
-    }
-
-    @staticmethod
-    def to_string(proc):
-        return Procedures.string_map[proc]
-
-    @staticmethod
-    def from_string(proc_str):
-        return int(proc_str, 16)
-
-class Results:
-    INVALID_CODE                = 0x00
-    SUCCESS                     = 0x01
-    OPCODE_NOT_SUPPORTED        = 0x02
-    INVALID_PARAMETER           = 0x03
-    INSUFF_RESOURCES            = 0x04
-    INVALID_OBJECT              = 0x05
-    UNSUPPORTED_TYPE            = 0x07
-    OPERATION_NOT_PERMITTED     = 0x08
-    OPERATION_FAILED            = 0x0A
-
-    string_map = {
-        INVALID_CODE            : "INVALID_CODE",
-        SUCCESS                 : "SUCCESS",
-        OPCODE_NOT_SUPPORTED    : "OPCODE_NOT_SUPPORTED",
-        INVALID_PARAMETER       : "INVALID_PARAMETER",
-        INSUFF_RESOURCES        : "INSUFFICIENT_RESOURCES",
-        INVALID_OBJECT          : "INVALID_OBJECT",
-        UNSUPPORTED_TYPE        : "UNSUPPORTED_TYPE",
-        OPERATION_NOT_PERMITTED : "OPERATION_NOT_PERMITTED",
-        OPERATION_FAILED        : "OPERATION_FAILED",
-    }
-
-    @staticmethod
-    def to_string(res):
-        return Results.string_map[res]
-
-    @staticmethod
-    def from_string(res_str):
-        return int(res_str, 16)
-
-
 class BleDfuControllerSecure(NrfBleDfuController):
     # Class constants
     UUID_BUTTONLESS      = '8ec90003-f315-4f60-9fb8-838830daea50'  # changed ed to ec for buttonless nordic characteristic
     UUID_CONTROL_POINT   = '8ec90001-f315-4f60-9fb8-838830daea50'
     UUID_PACKET          = '8ec90002-f315-4f60-9fb8-838830daea50'
+    UUID_FIRMWARE_REVISION = '00002a26-0000-1000-8000-00805f9b34fb'
+    UUID_DEVICE_NAME     = '00002a00-0000-1000-8000-00805f9b34fb'
+    UUID_MODEL_NUMBER    = '00002a24-0000-1000-8000-00805f9b34fb'
+    UUID_HARDWARE_REVISION = '00002a27-0000-1000-8000-00805f9b34fb'
+
+    # Device properties the init packet is checked against before any radio
+    # time is spent; None skips the check
+    hw_version           = None
+    sd_version           = None
+    verify_init_packet   = True
+
+    # Device Information Service firmware revision of a device already running
+    # this package. Such devices are not updated; None disables the check.
+    firmware_revision    = None
+
+    # Parsed package (ota_dfu_python.packages.FirmwarePackage) to send instead
+    # of loading firmware_path and datfile_path, e.g. from a PackageCache
+    package              = None
+    init_packet          = None
+
+    # Profile the session: True or a comma separated list of "timers",
+    # "cprofile" and "tracemalloc". The report goes to stats.profile, raw
+    # cProfile data to profile_dir/<address>.prof if profile_dir is set.
+    profile              = None
+    profile_dir          = None
+
+    # Times one data object is sent again in a row before the session fails
+    # with the kind of the last failure (see ota_dfu_python.retry)
+    max_object_retransmits = 3
+    _retransmit_reason   = None
+    _retransmit_error    = CrcMismatchError
+
+    # Calibration profiles (ota_dfu_python.calibration.CalibrationProfiles);
+    # the one for the model and bootloader sets the transfer settings, except
+    # those named in calibration_pinned
+    calibration          = None
+    calibration_pinned   = ()
+
+    # Watches the link while the image is sent (e.g. ota_dfu_python.stream.
+    # RssiGuard): guard.start(transport) returns a monitor whose check()
+    # raises PreemptedError to end the session before the link drops
+    link_guard           = None
+    _link_monitor        = None
+
+    # Firmware types in FIRMWARE_VERSION responses
+    FW_TYPE_BOOTLOADER   = 2
+
+    # (section, method) timed when profiling
+    PROFILED_METHODS = (("write_command", "_dfu_send_data"),
+                        ("write_request", "_dfu_send_request"),
+                        ("notification", "_dfu_wait_for_notify"),
+                        ("parse", "_dfu_parse_notify"),
+                        ("crc", "_image_crc"))
 
     # Constructor inherited from abstract base class
 
+    # --------------------------------------------------------------------------
+    #  Load the image and validate the init packet against it, so that a bad
+    #  package fails here instead of after connecting and sending the init.
+    # --------------------------------------------------------------------------
+    def input_setup(self):
+        if self.package is None:
+            self.package = FirmwarePackage(self.firmware_path, self.datfile_path)
+        logging.debug(f"Sending {self.package} to {self.target_mac}")
+
+        self.firmware_path = self.package.firmware_path
+        self.datfile_path = self.package.datfile_path
+        self.bin_array = self.package.bin_array
+        self.image_size = self.package.image_size
+        self.stats.image_size = self.image_size
+        self.stats.package = self.package.name
+
+        self.init_packet = None
+        if self.verify_init_packet:
+            self.init_packet = validate_package(self.datfile_path, self.firmware_path, self.bin_array,
+                                                self.hw_version, self.sd_version)
+            logging.debug(f"Init packet: {self.init_packet}")
+
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
     def start(self):
+        profiler = self._start_profiling()
+        try:
+            self._start()
+        finally:
+            if profiler is not None:
+                self._stop_profiling(profiler)
+
+    def _start(self):
+        self.prepare()
+        self._apply_calibration()
+
+        self._setup_flow_control()
+
+        # Set the Packet Receipt Notification interval
+        self._dfu_send_request(encode_set_prn(self.pkt_receipt_interval))
+        self._wait_and_parse_notify()
+
+        self.events.emit(PhaseEvent(Phases.INIT))
+        self._dfu_send_init()
+
+        self.events.emit(PhaseEvent(Phases.IMAGE))
+        self._tune_connection()
+        try:
+            self._dfu_send_image()
+        finally:
+            self._restore_connection()
+
+        self.events.emit(PhaseEvent(Phases.COMPLETE))
+
+    # --------------------------------------------------------------------------
+    #  Find the DFU characteristics and subscribe to control point
+    #  notifications. Needs a connection to the bootloader.
+    # --------------------------------------------------------------------------
+    def prepare(self):
         (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
         (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
 
@@ -91,96 +144,235 @@ class BleDfuControllerSecure(NrfBleDfuController):
         # Subscribe to notifications from Control Point characteristic
         self._enable_notifications(self.ctrlpt_cccd_handle)
 
-        # Set the Packet Receipt Notification interval
-        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.SET_PRN, prn)
-
-        self._dfu_send_init()
+    @property
+    def model(self):
+        """Hardware version the package is for"""
+        if self.hw_version is not None:
+            return self.hw_version
+        return getattr(self.init_packet, "hw_version", None)
 
-        self._dfu_send_image()
+    # --------------------------------------------------------------------------
+    #  Version of the bootloader, None if it does not tell (the FIRMWARE_VERSION
+    #  procedure is only implemented by newer SDKs)
+    # --------------------------------------------------------------------------
+    def bootloader_version(self):
+        for image in range(4):
+            self._dfu_send_request(encode_firmware_version(image))
+            try:
+                response = self._wait_and_parse_notify()
+            except DfuResponseError:
+                return None
+            if response.fw_type == self.FW_TYPE_BOOTLOADER:
+                return response.version
+        return None
 
     # --------------------------------------------------------------------------
-    #  Check if the peripheral is running in bootloader (DFU) or application mode
-    #  Returns True if the peripheral is in DFU mode
+    #  Apply the calibration profile for this model and bootloader, if any
     # --------------------------------------------------------------------------
-    def check_DFU_mode(self):
-        logging.info("Checking DFU State...")
+    def _apply_calibration(self):
+        if self.calibration is None:
+            return
 
-        self.ble_conn.sendline('characteristics')
+        from ota_dfu_python.calibration import controller_options
 
-        dfu_mode = False
+        version = self.bootloader_version()
+        profile = self.calibration.lookup(self.model, version)
+        if profile is None:
+            logging.info(f"No calibration profile for hw {self.model}, bootloader {version}")
+            return
 
-        try:
-            logging.info("Trying to find buttonless dfu characteristic")
-            self.ble_conn.expect(self.UUID_BUTTONLESS, timeout=2)
-        except pexpect.TIMEOUT as e:
-            dfu_mode = True
+        for name, value in controller_options(profile["settings"]).items():
+            if name not in self.calibration_pinned:
+                setattr(self, name, value)
+        logging.info(f"Calibration profile {profile['key']}: {profile['settings']}")
+        self.stats.calibration = {"profile": profile["key"], "settings": profile["settings"]}
 
-        return dfu_mode
+    # --------------------------------------------------------------------------
+    #  Apply controller options and set up the flow control they imply, which
+    #  may lower the PRN interval to the write window
+    # --------------------------------------------------------------------------
+    def configure(self, options):
+        for name, value in options.items():
+            setattr(self, name, value)
+        self._setup_flow_control()
 
-    def switch_to_dfu_mode(self):
-        logging.info("Switching to DFU mode")
-        (_, bl_value_handle, bl_cccd_handle) = self._get_handles(self.UUID_BUTTONLESS)
+    # --------------------------------------------------------------------------
+    #  Trial transfer for calibration: apply the options, then send the first
+    #  data object `objects` times. Objects are checked but never executed.
+    #  Needs prepare() and a valid init packet on the device.
+    # --------------------------------------------------------------------------
+    def trial_transfer(self, options, objects=3):
+        self.configure(options)
 
-        cmd  = 'char-write-req 0x%04x %s' % (bl_cccd_handle, '02')
-        logging.debug(f"Writing: {cmd}")
-        self.ble_conn.sendline(cmd)
-        # Verify that command was successfully written
+        retransmits = self.stats.retransmits
+        sent = 0
+        error = None
+        start = self.transport.clock()
         try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=2)
-        except pexpect.TIMEOUT as e:
-            logging.error(f"State timeout when switching to dfu mode: {e}")
+            self._dfu_send_request(encode_set_prn(self.pkt_receipt_interval))
+            self._wait_and_parse_notify()
+            self._tune_connection()
+
+            self._dfu_send_request(encode_select(Procedures.PARAM_DATA))
+            max_size = self._wait_and_parse_notify().max_size
+
+            start = self.transport.clock()
+            for _ in range(objects):
+                sent += self._dfu_send_object(0, max_size, execute=False)
+        except (DfuTimeoutError, CrcMismatchError, DfuResponseError) as e:
+            error = str(e)
+        duration = self.transport.clock() - start
+
+        return {
+            "bytes": sent,
+            "duration": duration,
+            "throughput": sent / duration if duration > 0 else 0.0,
+            "retransmits": self.stats.retransmits - retransmits,
+            "error": error,
+        }
+
+    # --------------------------------------------------------------------------
+    #  Wrap the hot path with timers (per phase) and start cProfile and
+    #  tracemalloc as configured. Returns None if profiling is off.
+    # --------------------------------------------------------------------------
+    def _start_profiling(self):
+        if not self.profile:
+            return None
+
+        profiler = SessionProfiler(self.profile, phase=lambda: self.stats.current_phase)
+        for section, name in self.PROFILED_METHODS:
+            setattr(self, name, profiler.wrap(section, getattr(self, name)))
+        self.events.emit = profiler.wrap("events", self.events.emit)
+
+        profiler.start()
+        return profiler
 
-        # Reset the board in DFU mode. After reset the board will be disconnected
-        cmd = 'char-write-req 0x%04x 01' % (bl_value_handle)
-        logging.debug(f"Writing: {cmd}")
-        self.ble_conn.sendline(cmd)
+    def _stop_profiling(self, profiler):
+        profiler.stop()
 
-        # Wait some time for board to reboot
-        time.sleep(2)
+        # Drop the instance level wrappers again
+        for _, name in self.PROFILED_METHODS:
+            self.__dict__.pop(name, None)
+        self.events.__dict__.pop("emit", None)
 
-        # Increase the mac address by one and reconnect
-        self.target_mac_increase(1)
-        return self.scan_and_connect()
+        self.stats.profile = profiler.report()
+        if self.profile_dir is not None:
+            import os
+
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump(os.path.join(self.profile_dir, self.target_mac.replace(':', '_') + ".prof"))
 
     # --------------------------------------------------------------------------
-    #  Parse notification status results
+    #  CRC32 of the first `length` bytes of the image
     # --------------------------------------------------------------------------
-    def _dfu_parse_notify(self, notify):
-        if len(notify) < 3:
-            logging.error("Notify data length error")
-            return None
+    def _image_crc(self, length):
+        return self.package.crc(length)
 
-        logging.debug(notify)
+    # --------------------------------------------------------------------------
+    #  Check if the peripheral is running in bootloader (DFU) or application mode
+    #  Returns True if the peripheral is in DFU mode
+    # --------------------------------------------------------------------------
+    def check_DFU_mode(self):
+        logging.info("Checking DFU State...")
 
-        dfu_notify_opcode = Procedures.from_string(notify[0])
-        if dfu_notify_opcode == Procedures.RESPONSE:
+        logging.info("Trying to find buttonless dfu characteristic")
+        # In DFU mode the search runs into its timeout, which is therefore
+        # not counted as an expiration
+        start = self.transport.clock()
+        timeout = self._timeout("discover")
+        dfu_mode = self.transport.find_characteristic(self.UUID_BUTTONLESS, timeout=timeout) is None
+        if not dfu_mode:
+            self._sample("discover", start, timeout, True)
 
-            dfu_procedure = Procedures.from_string(notify[1])
-            dfu_result  = Results.from_string(notify[2])
+        return dfu_mode
 
-            procedure_str = Procedures.to_string(dfu_procedure)
-            result_str  = Results.to_string(dfu_result)
+    # --------------------------------------------------------------------------
+    #  In application mode: True if the device reports the firmware revision
+    #  of the package, i.e. the update can be skipped.
+    # --------------------------------------------------------------------------
+    def is_current(self):
+        if self.firmware_revision is None:
+            return False
 
-            logging.debug("opcode: 0x%02x, proc: %s, res: %s" % (dfu_notify_opcode, procedure_str, result_str))
+        value = self.transport.read_characteristic(self.UUID_FIRMWARE_REVISION, timeout=self._timeout("write"))
+        if value is None:
+            logging.debug("Device reports no firmware revision")
+            return False
 
-            # Packet Receipt notifications are sent in the exact same format
-            # as responses to the CALC_CHECKSUM procedure.
-            if(dfu_procedure == Procedures.CALC_CHECKSUM and dfu_result == Results.SUCCESS):
-                offset = bytes_to_uint32_le(notify[3:7])
-                crc32 = bytes_to_uint32_le(notify[7:11])
+        revision = value.decode('UTF-8', 'replace').strip('\x00 ')
+        logging.info(f"Device firmware revision: {revision}")
+        return revision == str(self.firmware_revision)
+
+    # --------------------------------------------------------------------------
+    #  In application mode: what the device tells about itself, for picking
+    #  its firmware variant. Attributes it does not report are left out.
+    # --------------------------------------------------------------------------
+    def read_device_info(self):
+        info = {}
+        for name, uuid in (("name", self.UUID_DEVICE_NAME), ("model", self.UUID_MODEL_NUMBER),
+                           ("hw_revision", self.UUID_HARDWARE_REVISION)):
+            value = self.transport.read_characteristic(uuid, timeout=self._timeout("write"))
+            if value is not None:
+                info[name] = value.decode('UTF-8', 'replace').strip('\x00 ')
+        logging.info(f"Device information: {info}")
+        return info
+
+    # --------------------------------------------------------------------------
+    #  Reboot into the bootloader and connect to it. Returns the offset of the
+    #  bootloader address from the application address, None if the
+    #  bootloader could not be reached.
+    # --------------------------------------------------------------------------
+    def switch_to_dfu_mode(self):
+        logging.info("Switching to DFU mode")
+        app_mac = self.target_mac
+        (_, bl_value_handle, bl_cccd_handle) = self._get_handles(self.UUID_BUTTONLESS)
+        # The bootloader has its own attribute table
+        self._handles.clear()
 
-                return (dfu_procedure, dfu_result, offset, crc32)
+        # Enable indications on the buttonless characteristic
+        if not self._write_request(bl_cccd_handle, [0x02]):
+            logging.error("State timeout when switching to dfu mode")
 
-            elif(dfu_procedure == Procedures.SELECT and dfu_result == Results.SUCCESS):
-                max_size = bytes_to_uint32_le(notify[3:7])
-                offset = bytes_to_uint32_le(notify[7:11])
-                crc32 = bytes_to_uint32_le(notify[11:15])
+        # Reset the board in DFU mode. After reset the board will be disconnected,
+        # so a missing acknowledgement says nothing about the round trip time
+        self.transport.write_request(bl_value_handle, [0x01], timeout=self._timeout("write"))
 
-                return (dfu_procedure, dfu_result, max_size, offset, crc32)
+        # Wait for the board to reboot, then reconnect at the bootloader address
+        seen = self._wait_for_bootloader(app_mac)
+        return self.connect_bootloader(app_mac, seen=seen)
 
-            else:
-                return (dfu_procedure, dfu_result)
+    # --------------------------------------------------------------------------
+    #  Wait until one of the bootloader addresses advertises, at most
+    #  reboot_delay. Returns the addresses heard, None if the transport
+    #  cannot scan (then the whole delay is waited).
+    # --------------------------------------------------------------------------
+    def _wait_for_bootloader(self, app_mac):
+        start = self.transport.clock()
+        self.transport.sleep(self.reboot_min_delay)
+
+        candidates = [offset_address(app_mac, offset) for offset in self.bootloader_offsets]
+        while True:
+            seen = self.scan(candidates)
+            if seen is None:
+                self.transport.sleep(max(0.0, self.reboot_delay - (self.transport.clock() - start)))
+                return None
+            if seen or self.transport.clock() - start >= self.reboot_delay:
+                return seen
+
+    # --------------------------------------------------------------------------
+    #  Parse notification status results.
+    #  Returns a codec Response (SelectResponse, ChecksumResponse, ...) or None
+    #  if the notification is not a control point response.
+    # --------------------------------------------------------------------------
+    def _dfu_parse_notify(self, notify):
+        try:
+            response = decode_response(notify)
+        except CodecError as e:
+            logging.error(f"Notify data error: {e}")
+            return None
+
+        logging.debug(response)
+        return response
 
     # --------------------------------------------------------------------------
     #  Wait for a notification and parse the response
@@ -191,46 +383,40 @@ class BleDfuControllerSecure(NrfBleDfuController):
         notify = self._dfu_wait_for_notify()
 
         if notify is None:
-            raise Exception("No notification received")
+            if not self.transport.is_alive():
+                raise LinkLostError("Connection lost")
+            raise DfuTimeoutError("No notification received")
 
         logging.debug("Parsing notification")
 
-        result = self._dfu_parse_notify(notify)
-        if result[1] != Results.SUCCESS:
-            raise Exception("Error in {} procedure, reason: {}".format(
-                Procedures.to_string(result[0]),
-                Results.to_string(result[1])))
+        response = self._dfu_parse_notify(notify)
+        if response is None:
+            raise Exception("Invalid notification: {}".format(notify.hex()))
+
+        if not response.success:
+            raise DfuResponseError(response)
 
-        return result
+        return response
 
     # --------------------------------------------------------------------------
     #  Send the Init info (*.dat file contents) to peripheral device.
     # --------------------------------------------------------------------------
-    def _dfu_send_init(self):
+    def _dfu_send_init(self, force=False):
 
         logging.debug("DFU SEND INIT")
-        # Open the DAT file and create array of its contents
-        init_bin_array = array('B', open(self.datfile_path, 'rb').read())
+        init_bin_array = self.package.init_data
         init_size = len(init_bin_array)
-        init_crc = 0
+        init_crc = self.package.init_crc
 
         # Select command
-        self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_COMMAND])
-        try:
-            (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
-        except Exception as e:
-            logging.error(f"An error when waiting for notification 0: {e}")
-            return None
+        self._dfu_send_request(encode_select(Procedures.PARAM_COMMAND))
+        select = self._wait_and_parse_notify()
 
-        if offset != init_size or crc32 != init_crc:
-            if offset == 0 or offset > init_size:
+        if force or select.offset != init_size or select.crc32 != init_crc:
+            if force or select.offset == 0 or select.offset > init_size:
                 # Create command
-                self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_COMMAND] + uint32_to_bytes_le(init_size))
-                try:
-                    res = self._wait_and_parse_notify()
-                except Exception as e:
-                    logging.error(f"An error when waiting for notification 1: {e}")
-                    return None
+                self._dfu_send_request(encode_create(Procedures.PARAM_COMMAND, init_size))
+                self._wait_and_parse_notify()
 
                 segment_count = 0
                 segment_total = int(math.ceil(init_size/float(self.pkt_payload_size)))
@@ -241,46 +427,24 @@ class BleDfuControllerSecure(NrfBleDfuController):
                     segment_count += 1
 
                     if (segment_count % self.pkt_receipt_interval) == 0:
-                        try:
-                            (proc, res, offset, crc32) = self._wait_and_parse_notify()
-                        except Exception as e:
-                            logging.error(f"An error when waiting for notification 2: {e}")
-                            return None
-
-                        if res != Results.SUCCESS:
-                            raise Exception("bad notification status: {}".format(Results.to_string(res)))
-                        
+                        self._wait_and_parse_notify()
+
             else:
-                self._dfu_send_command(Procedures.EXECUTE)
-                try:
-                    res = self._wait_and_parse_notify()
-                except Exception as e:
-                    logging.error(f"An error when waiting for notification 3: {e}")
-                    return None
+                self._dfu_send_request(encode_execute())
+                self._wait_and_parse_notify()
 
                 # Select command
-                self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_COMMAND])
-                try:
-                    (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
-                except Exception as e:
-                    logging.error(f"An error when waiting for notification 0: {e}")
-                    return None
+                self._dfu_send_request(encode_select(Procedures.PARAM_COMMAND))
+                select = self._wait_and_parse_notify()
 
 
             # Calculate CRC
-            self._dfu_send_command(Procedures.CALC_CHECKSUM)
-            try:
-                self._wait_and_parse_notify()
-            except Exception as e:
-                logging.error(f"An error when waiting for notification 3: {e}")
-                return None
+            self._dfu_send_request(encode_calc_checksum())
+            self._wait_and_parse_notify()
 
         # Execute command
-        self._dfu_send_command(Procedures.EXECUTE)
-        try:
-            self._wait_and_parse_notify()
-        except Exception as e:
-            return None
+        self._dfu_send_request(encode_execute())
+        self._wait_and_parse_notify()
 
         logging.debug("Init packet successfully transfered")
 
@@ -291,86 +455,134 @@ class BleDfuControllerSecure(NrfBleDfuController):
         logging.debug("Sending DFU image")
 
         # Select Data Object
-        self._dfu_send_command(Procedures.SELECT, [Procedures.PARAM_DATA])
-        try:
-            (proc, res, max_size, offset, crc32) = self._wait_and_parse_notify()
-        except Exception as e:
-            return None
+        self._dfu_send_request(encode_select(Procedures.PARAM_DATA))
+        select = self._wait_and_parse_notify()
+
+        max_size = select.max_size
+        offset = select.offset
+
+        if offset == self.image_size and select.crc32 == self._image_crc(self.image_size):
+            self._dfu_activate_received_image(max_size)
+            return
 
         # Split the firmware into multiple objects
         num_objects = int(math.ceil(self.image_size / float(max_size)))
         logging.debug("Max object size: %d, num objects: %d, offset: %d, total size: %d" % (max_size, num_objects, offset, self.image_size))
 
-        time_start = time.time()
-        last_send_time = time.time()
+        time_start = self.transport.clock()
+        self._link_monitor = self.link_guard.start(self.transport) if self.link_guard is not None else None
 
         obj_offset = int(offset / max_size) * max_size
-        dfu_failed = False
+        failures = 0
         while obj_offset < self.image_size:
+            if self._link_monitor is not None:
+                self._link_monitor.check()
             ret = self._dfu_send_object(obj_offset, max_size)
-            if ret is not None:
+            if ret:
                 obj_offset += ret
-            else:
-                dfu_failed = True
+                failures = 0
+                continue
+
+            # Sending the same object again and again will not get it through
+            failures += 1
+            if failures > self.max_object_retransmits:
+                raise self._retransmit_error("Object at offset {} failed {} times, last: {}".format(
+                    obj_offset, failures, self._retransmit_reason))
 
-        # Image uploaded successfully, update the progress bar
-        print_progress(self.image_size, self.image_size, barLength = 50)
+        # Image uploaded successfully, report final progress
+        self.events.emit(ProgressEvent(self.image_size, self.image_size))
+        self.events.flush()
 
-        duration = time.time() - time_start
+        self.stats.write_stalls = self.credits.stalls
+
+        duration = self.transport.clock() - time_start
         logging.info("Upload complete in {} minutes and {} seconds".format(int(duration / 60), int(duration % 60)))
 
     # --------------------------------------------------------------------------
-    #  Send a single data object of given size and offset.
+    #  The bootloader already holds the whole image (e.g. the session dropped
+    #  before the last execute): execute it instead of sending it again.
+    # --------------------------------------------------------------------------
+    def _dfu_activate_received_image(self, max_size):
+        logging.info("Image already received by the bootloader, skipping transfer")
+        self.stats.skipped = "image on device"
+
+        self._dfu_send_request(encode_execute())
+        self._wait_and_parse_notify()
+
+        last_offset = (self.image_size - 1) // max_size * max_size
+        self.events.emit(ObjectCommittedEvent(last_offset, self.image_size - last_offset))
+
+    # --------------------------------------------------------------------------
+    #  Send a single data object of given size and offset. Without execute
+    #  the object is only checked and its size returned.
     # --------------------------------------------------------------------------
-    def _dfu_send_object(self, offset, obj_max_size):
+    def _dfu_send_object(self, offset, obj_max_size, execute=True):
+        object_offset = offset
         if offset != self.image_size:
             if offset == 0 or offset >= obj_max_size:  # or crc32 != crc32_unsigned(self.bin_array[0:offset]):
                 # Create Data Object
                 size = min(obj_max_size, self.image_size - offset)
-                self._dfu_send_command(Procedures.CREATE, [Procedures.PARAM_DATA] + uint32_to_bytes_le(size))
-                try:
-                    self._wait_and_parse_notify()
-                except Exception as e:
-                    return None
+                self._dfu_send_request(encode_create(Procedures.PARAM_DATA, size))
+                self._wait_and_parse_notify()
 
             segment_count = 0
             segment_total = int(math.ceil(min(obj_max_size, self.image_size-offset)/float(self.pkt_payload_size)))
 
             segment_begin = offset
             segment_end = min(offset+obj_max_size, self.image_size)
+            payloads = self.package.payloads(obj_max_size, self.pkt_payload_size)
 
             for i in range(segment_begin, segment_end, self.pkt_payload_size):
                 num_bytes = min(self.pkt_payload_size, segment_end - i)
-                segment = self.bin_array[i:i + num_bytes]
+                segment = payloads.get(i)
+                if segment is None or len(segment) != num_bytes:
+                    # Resuming at an offset the payloads are not aligned to
+                    segment = self.package.image[i:i + num_bytes]
                 self._dfu_send_data(segment)
+                self._bytes_sent.inc(num_bytes)
                 segment_count += 1
 
                 if (segment_count % self.pkt_receipt_interval) == 0:
                     try:
-                        (proc, res, offset, crc32) = self._wait_and_parse_notify()
-                    except Exception as e:
+                        receipt = self._wait_and_parse_notify()
+                    except DfuTimeoutError:
                         # Likely no notification received, need to re-transmit object
-                        return 0
-
-                    if res != Results.SUCCESS:
-                        raise Exception("bad notification status: {}".format(Results.to_string(res)))
+                        return self._retransmit(object_offset, "no receipt notification", DfuTimeoutError)
 
-                    if crc32 != crc32_unsigned(self.bin_array[0:offset]):
+                    offset = receipt.offset
+                    if receipt.crc32 != self._image_crc(offset):
                         # Something went wrong, need to re-transmit this object
-                        return 0
+                        return self._retransmit(object_offset, "receipt CRC mismatch", CrcMismatchError)
 
-                    print_progress(offset, self.image_size, barLength = 50)
+                    if self.events:
+                        self.events.emit(ProgressEvent(offset, self.image_size))
+                    if self._link_monitor is not None:
+                        self._link_monitor.check()
 
             # Calculate CRC
-            self._dfu_send_command(Procedures.CALC_CHECKSUM)
-            (proc, res, offset, crc32) = self._wait_and_parse_notify()
-            if(crc32 != crc32_unsigned(self.bin_array[0:offset])):
+            self._dfu_send_request(encode_calc_checksum())
+            checksum = self._wait_and_parse_notify()
+            if(checksum.crc32 != self._image_crc(checksum.offset)):
                 # Need to re-transmit object
-                return 0
+                return self._retransmit(object_offset, "object CRC mismatch", CrcMismatchError)
+
+            if not execute:
+                return segment_end - segment_begin
 
         # Execute command
-        self._dfu_send_command(Procedures.EXECUTE)
+        self._dfu_send_request(encode_execute())
         self._wait_and_parse_notify()
+        self.events.emit(ObjectCommittedEvent(object_offset, min(obj_max_size, self.image_size - object_offset)))
 
         # If everything executed correctly, return amount of bytes transfered
         return obj_max_size
+
+    # --------------------------------------------------------------------------
+    #  The object at offset has to be sent again. Returns 0 bytes transferred;
+    #  error is raised if the object keeps failing this way.
+    # --------------------------------------------------------------------------
+    def _retransmit(self, offset, reason, error):
+        self._retransmit_reason = reason
+        self._retransmit_error = error
+        self.events.emit(RetransmitEvent(offset, reason))
+        return 0
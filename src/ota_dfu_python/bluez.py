@@ -0,0 +1,511 @@
+"""
+------------------------------------------------------------------------------
+ BLE transport over BlueZ' D-Bus API.
+
+ Even over D-Bus a client pays a message round trip per packet if it
+ writes through WriteValue. BlueZ hands out sockets instead: AcquireWrite
+ for the packet characteristic (write without response) and AcquireNotify
+ for the control point notifications. Each send on the write socket is one
+ write command and each datagram read from the notify socket one
+ notification, so the image goes out without any D-Bus traffic and
+ notifications are waited for with select() on the sockets.
+
+ Requests (write with response, reads, connecting) still go over D-Bus, as
+ do indications, which AcquireNotify does not carry (StartNotify and
+ PropertiesChanged signals). Needs the optional jeepney package unless a
+ bus object is given (see BluezBus for what it has to provide).
+------------------------------------------------------------------------------
+"""
+import collections
+import fcntl
+import logging
+import re
+import select
+import socket
+import struct
+import termios
+import time
+
+from ota_dfu_python import resources
+from ota_dfu_python.transport import Transport
+
+BLUEZ = 'org.bluez'
+ADAPTER_INTERFACE = 'org.bluez.Adapter1'
+DEVICE_INTERFACE = 'org.bluez.Device1'
+CHARACTERISTIC_INTERFACE = 'org.bluez.GattCharacteristic1'
+DESCRIPTOR_INTERFACE = 'org.bluez.GattDescriptor1'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+
+UUID_CCCD = '00002902-0000-1000-8000-00805f9b34fb'
+
+# Object paths carry the attribute handles: .../service000a/char000b/desc000d
+_HANDLE = re.compile(r'/(?:char|desc)([0-9a-fA-F]{4})$')
+
+
+class BluezError(Exception):
+    """An error reply (or no reply) from BlueZ"""
+
+    def __init__(self, name, message=""):
+        super().__init__("%s: %s" % (name, message) if message else name)
+        self.name = name
+
+
+class BluezBus(object):
+    """
+    Method calls to BlueZ and the PropertiesChanged signals of watched
+    objects, over a jeepney connection to the system bus. Stand-ins (e.g.
+    for tests) provide the same methods: call, managed_objects, get, watch,
+    poll, fileno and close, and count D-Bus calls in `calls`.
+    """
+
+    def __init__(self, connection=None):
+        from jeepney.io.blocking import open_dbus_connection
+
+        self.conn = connection if connection is not None else open_dbus_connection(bus='SYSTEM', enable_fds=True)
+        self.calls = 0
+        self._signals = collections.deque()
+        self._filters = []
+
+    def call(self, path, interface, method, signature=None, body=(), timeout=10):
+        from jeepney import DBusAddress, MessageType, new_method_call
+
+        message = new_method_call(DBusAddress(path, bus_name=BLUEZ, interface=interface), method, signature, body)
+        self.calls += 1
+        try:
+            reply = self.conn.send_and_get_reply(message, timeout=timeout)
+        except TimeoutError:
+            raise BluezError("Timeout", f"{interface}.{method} on {path}")
+
+        if reply.header.message_type == MessageType.error:
+            from jeepney import HeaderFields
+
+            name = reply.header.fields.get(HeaderFields.error_name, "Error")
+            raise BluezError(name, reply.body[0] if reply.body else "")
+        return reply.body
+
+    def managed_objects(self):
+        """{path: {interface: {property: value}}} of all BlueZ objects"""
+        objects = self.call('/', OBJECT_MANAGER_INTERFACE, 'GetManagedObjects')[0]
+        return {path: {interface: _unwrap(properties) for interface, properties in interfaces.items()}
+                for path, interfaces in objects.items()}
+
+    def get(self, path, interface, name):
+        return self.call(path, PROPERTIES_INTERFACE, 'Get', 'ss', (interface, name))[0][1]
+
+    # --------------------------------------------------------------------------
+    #  Deliver PropertiesChanged signals of objects under path through poll()
+    # --------------------------------------------------------------------------
+    def watch(self, path):
+        from jeepney import MatchRule, message_bus
+
+        rule = MatchRule(type='signal', sender=BLUEZ, interface=PROPERTIES_INTERFACE,
+                         member='PropertiesChanged', path_namespace=path)
+        self.calls += 1
+        self.conn.send_and_get_reply(message_bus.AddMatch(rule), timeout=10)
+        self._filters.append(self.conn.filter(rule, queue=self._signals))
+
+    # --------------------------------------------------------------------------
+    #  Signals received within timeout (none waited for if 0), as
+    #  (path, interface, changed properties)
+    # --------------------------------------------------------------------------
+    def poll(self, timeout=0):
+        from jeepney import HeaderFields
+
+        try:
+            self.conn.recv_messages(timeout=timeout)
+            while True:
+                self.conn.recv_messages(timeout=0)
+        except TimeoutError:
+            pass
+
+        signals = []
+        while self._signals:
+            message = self._signals.popleft()
+            (interface, changed, _) = message.body
+            signals.append((message.header.fields[HeaderFields.path], interface, _unwrap(changed)))
+        return signals
+
+    def fileno(self):
+        return self.conn.sock.fileno()
+
+    def close(self):
+        for handle in self._filters:
+            handle.close()
+        self._filters = []
+        self.conn.close()
+
+
+def _unwrap(properties):
+    # D-Bus variants arrive as (signature, value)
+    return {name: value[1] if isinstance(value, tuple) else value for name, value in properties.items()}
+
+
+def _close_socket(sock):
+    sock.close()
+
+
+def _to_socket(fd):
+    # jeepney returns FileDescriptor objects, stand-ins may pass plain fds
+    if hasattr(fd, 'to_socket'):
+        return fd.to_socket()
+    return socket.socket(fileno=fd)
+
+
+def _unsent(sock):
+    """Bytes sent on sock that the other end has not read yet"""
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0' * 4))[0]
+    except OSError:
+        return 0
+
+
+class _Characteristic(object):
+    __slots__ = ("uuid", "path", "handle", "flags", "cccd_handle")
+
+    def __init__(self, uuid, path, handle, flags, cccd_handle):
+        self.uuid = uuid
+        self.path = path
+        self.handle = handle
+        self.flags = flags
+        self.cccd_handle = cccd_handle
+
+    @property
+    def value_handle(self):
+        # The value attribute always follows the declaration
+        return self.handle + 1
+
+
+class BluezTransport(Transport):
+    """Talks to bluetoothd over D-Bus, sending data through acquired sockets"""
+
+    def __init__(self, target_mac, adapter="hci0", bus=None):
+        self.adapter = adapter
+        self.adapter_path = "/org/bluez/" + adapter
+        self._own_bus = bus is None
+        self.bus = bus if bus is not None else BluezBus()
+        self._bus_resource = resources.track(self, "D-Bus connection", self.bus.close) if self._own_bus else None
+        self._watched = set()
+
+        self.target_mac = target_mac
+        self._reset()
+
+    def _reset(self):
+        self._characteristics = {}      # uuid -> _Characteristic
+        self._by_handle = {}            # value or CCCD handle -> _Characteristic
+        self._writers = {}              # path -> (socket, resource, largest write)
+        self._notifiers = {}            # path -> (socket, resource, mtu)
+        self._started = set()           # paths notifying through signals
+        self._notifications = collections.deque()
+        self._link_lost = False
+        self._connected = False
+
+    @property
+    def device_path(self):
+        return "%s/dev_%s" % (self.adapter_path, self.target_mac.upper().replace(':', '_'))
+
+    def _watch(self, path):
+        if path not in self._watched:
+            self.bus.watch(path)
+            self._watched.add(path)
+
+    def connect(self, timeout=2):
+        self._release_sockets()
+        self._reset()
+        deadline = time.monotonic() + timeout
+
+        objects = self.bus.managed_objects()
+        if DEVICE_INTERFACE not in objects.get(self.device_path, {}):
+            # BlueZ only connects to devices it has seen advertising
+            if not self.scan([self.target_mac], timeout=max(0.1, min(timeout, 2.0))):
+                logging.warning(f"{self.target_mac} not found")
+                return False
+
+        self._watch(self.device_path)
+        try:
+            self.bus.call(self.device_path, DEVICE_INTERFACE, 'Connect', timeout=max(0.1, deadline - time.monotonic()))
+        except BluezError as e:
+            logging.warning(f"Connecting to {self.target_mac} failed: {e}")
+            return False
+
+        # Handles are only known once BlueZ has discovered the services
+        while not self.bus.get(self.device_path, DEVICE_INTERFACE, 'ServicesResolved'):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"Timeout resolving the services of {self.target_mac}")
+                return False
+            self._handle_signals(self.bus.poll(min(remaining, 0.1)))
+
+        self._connected = True
+        self._load_characteristics()
+        return True
+
+    def _load_characteristics(self):
+        objects = self.bus.managed_objects()
+        prefix = self.device_path + "/"
+
+        characteristics = {}
+        for path, interfaces in objects.items():
+            match = _HANDLE.search(path)
+            if not path.startswith(prefix) or match is None:
+                continue
+            properties = interfaces.get(CHARACTERISTIC_INTERFACE)
+            if properties is not None:
+                characteristics[path] = _Characteristic(properties['UUID'].lower(), path, int(match.group(1), 16),
+                                                        list(properties.get('Flags', [])), None)
+
+        for path, interfaces in objects.items():
+            properties = interfaces.get(DESCRIPTOR_INTERFACE)
+            if properties is not None and path.startswith(prefix) and properties['UUID'].lower() == UUID_CCCD:
+                characteristic = characteristics.get(properties.get('Characteristic'))
+                if characteristic is not None:
+                    characteristic.cccd_handle = int(_HANDLE.search(path).group(1), 16)
+
+        for characteristic in characteristics.values():
+            if characteristic.cccd_handle is None:
+                characteristic.cccd_handle = characteristic.handle + 2
+            self._characteristics[characteristic.uuid] = characteristic
+            self._by_handle[characteristic.value_handle] = characteristic
+            self._by_handle[characteristic.cccd_handle] = characteristic
+
+    def _release_sockets(self):
+        for (_, resource, _) in list(self._writers.values()) + list(self._notifiers.values()):
+            if resource is not None:
+                resource.release()
+        self._writers = {}
+        self._notifiers = {}
+
+    def disconnect(self):
+        self._release_sockets()
+        if self._connected:
+            self._connected = False
+            try:
+                self.bus.call(self.device_path, DEVICE_INTERFACE, 'Disconnect')
+            except BluezError as e:
+                logging.debug(f"Disconnecting {self.target_mac} failed: {e}")
+
+    def close(self):
+        self.disconnect()
+        if self._bus_resource is not None:
+            self._bus_resource.release()
+            self._bus_resource = None
+
+    def set_target(self, target_mac):
+        self.disconnect()
+        self.target_mac = target_mac
+
+    # --------------------------------------------------------------------------
+    #  LE discovery for the timeout. BlueZ only has RSSI for devices heard
+    #  during the current discovery, so objects are read before stopping it.
+    # --------------------------------------------------------------------------
+    def scan(self, addresses, timeout=1.0):
+        wanted = None if addresses is None else {address.upper() for address in addresses}
+        try:
+            self.bus.call(self.adapter_path, ADAPTER_INTERFACE, 'SetDiscoveryFilter', 'a{sv}',
+                          ({'Transport': ('s', 'le'), 'DuplicateData': ('b', True)},))
+            self.bus.call(self.adapter_path, ADAPTER_INTERFACE, 'StartDiscovery')
+        except BluezError as e:
+            logging.debug(f"Discovery failed: {e}")
+            return None
+
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._handle_signals(self.bus.poll(min(remaining, 0.1)))
+            objects = self.bus.managed_objects()
+        finally:
+            try:
+                self.bus.call(self.adapter_path, ADAPTER_INTERFACE, 'StopDiscovery')
+            except BluezError as e:
+                logging.debug(f"Stopping discovery failed: {e}")
+
+        seen = {}
+        for path, interfaces in objects.items():
+            properties = interfaces.get(DEVICE_INTERFACE)
+            if properties is None or not path.startswith(self.adapter_path + "/"):
+                continue
+            address = properties.get('Address', '').upper()
+            if (wanted is None or address in wanted) and 'RSSI' in properties:
+                seen[address] = properties['RSSI']
+        return seen
+
+    def find_characteristic(self, uuid, timeout=10):
+        characteristic = self._characteristics.get(uuid.lower())
+        if characteristic is None and self._connected:
+            # Services may have changed, e.g. the device rebooted
+            self._load_characteristics()
+            characteristic = self._characteristics.get(uuid.lower())
+        if characteristic is None:
+            return None
+        return (characteristic.handle, characteristic.value_handle, characteristic.cccd_handle)
+
+    def read_characteristic(self, uuid, timeout=10):
+        characteristic = self._characteristics.get(uuid.lower())
+        if characteristic is None:
+            return None
+        try:
+            return bytes(self.bus.call(characteristic.path, CHARACTERISTIC_INTERFACE, 'ReadValue', 'a{sv}', ({},),
+                                       timeout=timeout)[0])
+        except BluezError as e:
+            logging.debug(f"Reading {uuid} failed: {e}")
+            return None
+
+    # --------------------------------------------------------------------------
+    #  A write to a CCCD turns into AcquireNotify (StartNotify for
+    #  indications, or if the socket is refused), any other into WriteValue
+    # --------------------------------------------------------------------------
+    def write_request(self, handle, data, timeout=10):
+        characteristic = self._by_handle.get(handle)
+        if characteristic is None:
+            logging.error(f"Unknown handle 0x{handle:04x}")
+            return False
+
+        # Requests must not overtake write commands still queued on a socket
+        self._drain(timeout)
+
+        try:
+            if handle == characteristic.cccd_handle:
+                return self._subscribe(characteristic, bytes(data), timeout)
+
+            self.bus.call(characteristic.path, CHARACTERISTIC_INTERFACE, 'WriteValue', 'aya{sv}',
+                          (bytes(data), {'type': ('s', 'request')}), timeout=timeout)
+        except BluezError as e:
+            logging.error(f"Write to 0x{handle:04x} failed: {e}")
+            return False
+        return True
+
+    def _drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        for (sock, _, _) in list(self._writers.values()):
+            while sock is not None and _unsent(sock) and time.monotonic() < deadline:
+                time.sleep(0.0005)
+
+    def _subscribe(self, characteristic, value, timeout):
+        path = characteristic.path
+        if not any(value):
+            if path in self._notifiers:
+                self._notifiers.pop(path)[1].release()
+            if path in self._started:
+                self._started.discard(path)
+                self.bus.call(path, CHARACTERISTIC_INTERFACE, 'StopNotify', timeout=timeout)
+            return True
+
+        if path in self._notifiers or path in self._started:
+            return True
+
+        if value[0] & 0x01 and 'notify' in characteristic.flags:
+            try:
+                (fd, mtu) = self.bus.call(path, CHARACTERISTIC_INTERFACE, 'AcquireNotify', 'a{sv}', ({},),
+                                          timeout=timeout)
+            except BluezError as e:
+                logging.debug(f"AcquireNotify on {characteristic.uuid} refused, using StartNotify: {e}")
+            else:
+                sock = _to_socket(fd)
+                self._notifiers[path] = (sock, resources.track(self, "BlueZ socket", _close_socket, sock), mtu)
+                return True
+
+        self._watch(path)
+        self.bus.call(path, CHARACTERISTIC_INTERFACE, 'StartNotify', timeout=timeout)
+        self._started.add(path)
+        return True
+
+    # --------------------------------------------------------------------------
+    #  Sent on the AcquireWrite socket of the characteristic, acquired on the
+    #  first write; WriteValue only if BlueZ refuses it
+    # --------------------------------------------------------------------------
+    def write_command(self, handle, data):
+        characteristic = self._by_handle.get(handle)
+        if characteristic is None:
+            logging.error(f"Unknown handle 0x{handle:04x}")
+            return
+
+        writer = self._writers.get(characteristic.path)
+        if writer is None:
+            writer = self._acquire_write(characteristic)
+
+        if writer is not None and len(data) <= writer[2]:
+            try:
+                writer[0].send(bytes(data))
+            except OSError as e:
+                logging.warning(f"Write socket of {characteristic.uuid} failed: {e}")
+                self._link_lost = True
+            return
+
+        try:
+            self.bus.call(characteristic.path, CHARACTERISTIC_INTERFACE, 'WriteValue', 'aya{sv}',
+                          (bytes(data), {'type': ('s', 'command')}))
+        except BluezError as e:
+            logging.warning(f"Write command to 0x{handle:04x} failed: {e}")
+
+    def _acquire_write(self, characteristic):
+        try:
+            (fd, mtu) = self.bus.call(characteristic.path, CHARACTERISTIC_INTERFACE, 'AcquireWrite', 'a{sv}', ({},))
+        except BluezError as e:
+            logging.warning(f"AcquireWrite on {characteristic.uuid} refused, writing over D-Bus: {e}")
+            writer = self._writers[characteristic.path] = (None, None, -1)
+            return writer
+
+        sock = _to_socket(fd)
+        # BlueZ reports the largest value one write can carry
+        writer = (sock, resources.track(self, "BlueZ socket", _close_socket, sock), mtu)
+        self._writers[characteristic.path] = writer
+        logging.debug(f"Acquired the write socket of {characteristic.uuid}, up to {mtu} bytes per write")
+        return writer
+
+    def _handle_signals(self, signals):
+        for (path, interface, changed) in signals:
+            if interface == DEVICE_INTERFACE and path == self.device_path and changed.get('Connected') is False:
+                if not self._link_lost:
+                    logging.warning('Connection lost!')
+                self._link_lost = True
+            elif interface == CHARACTERISTIC_INTERFACE and path in self._started and 'Value' in changed:
+                self._notifications.append(bytes(changed['Value']))
+
+    def wait_for_notification(self, timeout=2):
+        deadline = time.monotonic() + timeout
+        while True:
+            # Signals already read from the bus are not seen by select()
+            self._handle_signals(self.bus.poll(0))
+            if not self._notifications:
+                # What was sent before the link went down is still read
+                self._receive(0 if self._link_lost else max(0.0, deadline - time.monotonic()))
+            if self._notifications:
+                return self._notifications.popleft()
+            if self._link_lost or time.monotonic() >= deadline:
+                return None
+
+    def _receive(self, timeout):
+        sockets = {sock.fileno(): (sock, mtu) for (sock, _, mtu) in self._notifiers.values()}
+        (ready, _, _) = select.select(list(sockets) + [self.bus.fileno()], [], [], timeout)
+        for fd in ready:
+            if fd not in sockets:
+                continue
+            (sock, mtu) = sockets[fd]
+            try:
+                value = sock.recv(max(mtu, 512))
+            except OSError as e:
+                logging.debug(f"Notify socket failed: {e}")
+                value = b''
+            if not value:
+                # BlueZ closes the socket when the link goes down
+                if not self._link_lost:
+                    logging.warning('Connection lost!')
+                self._link_lost = True
+                continue
+            self._notifications.append(value)
+
+    def is_alive(self):
+        if self._link_lost or not self._connected:
+            return False
+
+        poller = select.poll()
+        for (sock, _, _) in list(self._writers.values()) + list(self._notifiers.values()):
+            if sock is not None:
+                poller.register(sock, select.POLLHUP)
+        if any(events & (select.POLLHUP | select.POLLERR | select.POLLNVAL) for (_, events) in poller.poll(0)):
+            self._link_lost = True
+            return False
+        return True
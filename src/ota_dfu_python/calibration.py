@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+------------------------------------------------------------------------------
+ Throughput calibration profiles.
+
+ The best payload size, PRN interval, write window and connection parameters
+ depend on the device model and its bootloader build. Calibrator connects to
+ a device's bootloader and runs short trial transfers: the first data object
+ is sent and checked, but never executed, so nothing is written to flash and
+ the device stays in the bootloader. It searches one setting at a time for
+ the highest sustained throughput without retransmits, and stores the winner
+ in CalibrationProfiles under the model (init packet hw_version) and the
+ bootloader version the device reports. Controllers given the profiles load
+ the matching one at the start of every session.
+
+   ota-dfu-calibrate -z app.zip -a AA:BB:CC:DD:EE:FF --profiles calibration.json
+------------------------------------------------------------------------------
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from ota_dfu_python.transport import ConnectionParameters, FAST_CONNECTION_CANDIDATES
+
+# Settings a profile holds and the controller attributes they map to
+SETTINGS = ("pkt_payload_size", "pkt_receipt_interval", "write_window", "connection")
+
+
+def profile_key(model, bootloader_version=None):
+    key = "hw{}".format(model if model is not None else "-")
+    if bootloader_version is not None:
+        key += "/bl{}".format(bootloader_version)
+    return key
+
+
+def controller_options(settings):
+    """Controller attributes for profile settings"""
+    options = {name: settings[name] for name in SETTINGS if name != "connection" and name in settings}
+    if "connection" in settings:
+        connection = settings["connection"]
+        options["fast_connection_candidates"] = [ConnectionParameters(**connection)] if connection else None
+    return options
+
+
+def controller_settings(controller):
+    """Profile settings currently in effect on a controller"""
+    candidates = controller.fast_connection_candidates
+    return {
+        "pkt_payload_size": controller.pkt_payload_size,
+        "pkt_receipt_interval": controller.pkt_receipt_interval,
+        "write_window": controller.write_window,
+        "connection": candidates[0].as_dict() if candidates else None,
+    }
+
+
+class CalibrationProfiles(object):
+    """Calibrated settings by profile_key(), optionally persisted as JSON"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.profiles = {}
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.profiles = json.load(f).get("profiles", {})
+            except (OSError, ValueError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable calibration profiles {path}: {e}")
+
+    # --------------------------------------------------------------------------
+    #  The profile for a model and bootloader version. Without one for that
+    #  exact bootloader, the most recently calibrated one for the model.
+    # --------------------------------------------------------------------------
+    def lookup(self, model, bootloader_version=None):
+        with self._lock:
+            profile = self.profiles.get(profile_key(model, bootloader_version))
+            if profile is not None:
+                return profile
+
+            prefix = profile_key(model)
+            same_model = [profile for key, profile in self.profiles.items()
+                          if key == prefix or key.startswith(prefix + "/")]
+            if not same_model:
+                return None
+            return max(same_model, key=lambda profile: profile.get("calibrated", 0))
+
+    def save(self, model, bootloader_version, settings, throughput, trials):
+        key = profile_key(model, bootloader_version)
+        profile = {
+            "key": key,
+            "settings": settings,
+            "throughput": throughput,
+            "trials": trials,
+            "calibrated": time.time(),
+        }
+        with self._lock:
+            self.profiles[key] = profile
+            if self.path is not None:
+                tmp = self.path + ".tmp"
+                with open(tmp, 'w') as f:
+                    json.dump({"profiles": self.profiles}, f, indent=2, sort_keys=True)
+                os.replace(tmp, self.path)
+        return profile
+
+
+class Calibrator(object):
+    """
+    Coordinate search over `space` ({setting: candidate values}) with trial
+    transfers of `objects` data objects each. A setting is only changed for a
+    gain of more than min_gain; trials with retransmits or errors do not count.
+    Trials are scored under the settings the controller actually used, so
+    candidates it adjusts to the same settings are only tried once.
+    """
+
+    SPACE = {
+        "connection": [params.as_dict() for params in FAST_CONNECTION_CANDIDATES] + [None],
+        "pkt_payload_size": [20],
+        "pkt_receipt_interval": [4, 8, 12, 16, 24],
+        "write_window": [None, 5, 10, 20],
+    }
+
+    def __init__(self, dfu, space=None, objects=3, passes=2, min_gain=0.02):
+        """dfu is a SecureDfu session for the device"""
+        self.dfu = dfu
+        self.space = space if space is not None else self.SPACE
+        self.objects = objects
+        self.passes = passes
+        self.min_gain = min_gain
+        self.trials = []
+        self._scores = {}
+
+    def run(self):
+        """Returns (best settings, their throughput, bootloader version)"""
+        controller = self.dfu.ble_dfu
+        if not self.dfu.connect():
+            raise Exception("Device skipped, nothing to calibrate")
+        try:
+            controller.prepare()
+            version = controller.bootloader_version()
+            # A fresh init packet also discards anything left from earlier sessions
+            controller._dfu_send_init(force=True)
+
+            (best_score, best) = self._trial(controller_settings(controller))
+
+            for _ in range(self.passes):
+                improved = False
+                for name, values in self.space.items():
+                    for value in values:
+                        (score, settings) = self._trial(dict(best, **{name: value}))
+                        if score > best_score * (1 + self.min_gain):
+                            best, best_score, improved = settings, score, True
+                if not improved:
+                    break
+        finally:
+            controller.close()
+
+        if best_score == 0:
+            raise Exception("No setting transferred without retransmits")
+        return best, best_score, version
+
+    # --------------------------------------------------------------------------
+    #  Score of a candidate and the settings in effect for it. Without send
+    #  complete reports the controller lowers the PRN interval to the write
+    #  window, so e.g. PRN 12, 16 and 24 with a window of 10 are one trial.
+    # --------------------------------------------------------------------------
+    def _trial(self, settings):
+        controller = self.dfu.ble_dfu
+        controller.configure(controller_options(settings))
+        settings = controller_settings(controller)
+        key = json.dumps(settings, sort_keys=True)
+        if key not in self._scores:
+            result = controller.trial_transfer({}, self.objects)
+            result["settings"] = controller_settings(controller)
+            score = result["throughput"] if result["retransmits"] == 0 and result["error"] is None else 0.0
+            logging.info(f"Trial {result['settings']}: {result['throughput']:.0f} B/s, "
+                         f"{result['retransmits']} retransmit(s), error: {result['error']}")
+            self.trials.append(result)
+            self._scores[key] = score
+        return self._scores[key], settings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate DFU transfer settings for a device model.")
+    parser.add_argument('-a', '--address', required=True, help='Address of a device of the model.')
+    parser.add_argument('-z', '--zip', dest='zipfile', default=None, help='DFU package for the model.')
+    parser.add_argument('-f', '--file', dest='hexfile', default=None, help='Firmware image (.hex or .bin).')
+    parser.add_argument('-d', '--dat', dest='datfile', default=None, help='Init packet (.dat).')
+    parser.add_argument('--profiles', default="calibration.json", help='Calibration profiles file to update.')
+    parser.add_argument('--objects', type=int, default=3, help='Data objects per trial transfer.')
+    parser.add_argument('--passes', type=int, default=2, help='Passes over the settings.')
+    parser.add_argument('--payload-sizes', default=None,
+                        help='Comma separated payload sizes to try (default 20, the ATT MTU of gatttool).')
+    parser.add_argument('--hw-version', type=int, default=None,
+                        help='Hardware version of the device, checked against the init packet.')
+    parser.add_argument('--simulate', action='store_true', help='Calibrate against a simulated device.')
+    parser.add_argument('--json', action='store_true', help='Print the profile and all trials as JSON.')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='More logging (-vv for debug).')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from ota_dfu_python.dfu import SecureDfu
+    from ota_dfu_python.unpacker import Unpacker
+
+    args = parse_args(argv)
+
+    level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)]
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S',
+                        level=level, stream=sys.stderr)
+
+    unpacker = None
+    if args.zipfile is not None:
+        unpacker = Unpacker()
+        hexfile, datfile = unpacker.unpack_zipfile(args.zipfile)
+    elif args.hexfile is not None and args.datfile is not None:
+        hexfile, datfile = args.hexfile, args.datfile
+    else:
+        logging.error("Either a zip file or both hex and dat files are required")
+        return 2
+
+    address = args.address.upper()
+    transport = None
+    if args.simulate:
+        from ota_dfu_python.simulator import SimulatedAir, SimulatedDevice, SimulatedTransport
+        transport = SimulatedTransport(address, SimulatedAir([SimulatedDevice(address)]))
+
+    space = dict(Calibrator.SPACE)
+    if args.payload_sizes is not None:
+        space["pkt_payload_size"] = [int(size) for size in args.payload_sizes.split(',')]
+
+    options = {} if args.hw_version is None else {"hw_version": args.hw_version}
+    try:
+        dfu = SecureDfu(address, hexfile, datfile, transport, **options)
+        calibrator = Calibrator(dfu, space, objects=args.objects, passes=args.passes)
+        settings, throughput, version = calibrator.run()
+    finally:
+        if unpacker is not None:
+            unpacker.delete()
+
+    model = dfu.ble_dfu.hw_version
+    if model is None and dfu.ble_dfu.init_packet is not None:
+        model = dfu.ble_dfu.init_packet.hw_version
+    profile = CalibrationProfiles(args.profiles).save(model, version, settings, throughput, len(calibrator.trials))
+
+    if args.json:
+        json.dump({"profile": profile, "trials": calibrator.trials}, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print("%s: %.0f bytes/s with %s (%d trials)" % (profile["key"], throughput, settings, len(calibrator.trials)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+------------------------------------------------------------------------------
+ Command line entry point (installed as `ota-dfu`).
+
+ Runs Secure DFU on one or more targets without interactive prompts:
+
+   ota-dfu -z app.zip -a AA:BB:CC:DD:EE:FF
+   ota-dfu -f app.hex -d app.dat --targets devices.txt -j 2 --json
+   ota-dfu -z app.zip -a AA:BB:CC:DD:EE:FF --simulate --json
+   ota-dfu -z app.zip -a 'tag-*' --stream --job-db tags.db
+------------------------------------------------------------------------------
+"""
+import argparse
+import json
+import logging
+import sys
+
+from ota_dfu_python.addresses import AddressMap
+from ota_dfu_python.jobs import JobStore, JobWorker, JobStates
+from ota_dfu_python.retry import RetryPolicy
+from ota_dfu_python.unpacker import Unpacker
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="ota-dfu", description="Secure DFU for nRF5 devices over BLE")
+    parser.add_argument('-a', '--address', action='append', dest="addresses", default=[],
+                        help='DFU target address, may be given multiple times.')
+    parser.add_argument('-t', '--targets', dest="targets", default=None,
+                        help='File with one target address per line (batch mode).')
+    parser.add_argument('-z', '--zipfile', dest="zipfile", default=None, help='Zip file to be used.')
+    parser.add_argument('-f', '--hexfile', dest="hexfile", default=None, help='Hex or bin file to be used.')
+    parser.add_argument('-d', '--datfile', dest="datfile", default=None, help='Dat file to be used.')
+    parser.add_argument('--catalogue', default=None,
+                        help='Firmware catalogue (JSON) to pick each device\'s package from, by its name, '
+                             'model or hardware revision.')
+    parser.add_argument('--device-attributes', default=None,
+                        help='JSON file remembering device attributes for --catalogue.')
+    parser.add_argument('-j', '--concurrency', type=int, default=1, help='Number of concurrent DFU sessions.')
+    parser.add_argument('-r', '--retries', type=int, default=3, help='Attempts per device before giving up.')
+    parser.add_argument('--payload-size', type=int, default=None, help='Override the packet payload size.')
+    parser.add_argument('--prn', type=int, default=None, help='Override the packet receipt notification interval.')
+    parser.add_argument('--hw-version', type=int, default=None,
+                        help='Hardware version of the targets, checked against the init packet.')
+    parser.add_argument('--sd-version', type=lambda value: int(value, 0), default=None,
+                        help='SoftDevice id of the targets (e.g. 0xB7), checked against the init packet.')
+    parser.add_argument('--firmware-revision', default=None,
+                        help='Firmware revision (Device Information Service) of the package; '
+                             'devices reporting it are skipped.')
+    parser.add_argument('--calibration', default=None,
+                        help='Calibration profiles (see ota-dfu-calibrate) to take transfer settings from.')
+    parser.add_argument('--address-map', default=None,
+                        help='JSON file remembering where each device\'s bootloader advertises.')
+    parser.add_argument('--stage-ahead', type=int, default=0,
+                        help='Reboot up to this many waiting devices into their bootloaders while transfers run.')
+    parser.add_argument('--bootloader-timeout', type=float, default=120.0,
+                        help='Seconds the targets\' bootloaders wait for a connection before returning to the '
+                             'application (for --stage-ahead).')
+    parser.add_argument('--schedule', action='store_true',
+                        help='Update the devices with the best signal and history first, and lower the concurrency '
+                             '(up to -j) per adapter while sessions retransmit a lot. Pays off for fleets much '
+                             'larger than -j; on small ones it lowers devices per hour.')
+    parser.add_argument('--device-history', default=None,
+                        help='JSON file remembering each device\'s signal and past sessions for --schedule.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Run until interrupted, updating devices as they are sighted. The targets are shell '
+                             'patterns matched against the address or name of each device heard.')
+    parser.add_argument('--sightings', default=None,
+                        help='Read sightings for --stream as JSON lines ({"address", "rssi", "name"}) from this '
+                             'file ("-" for stdin) instead of scanning.')
+    parser.add_argument('--scan-interval', type=float, default=2.0, help='Seconds per scan for --stream.')
+    parser.add_argument('--min-rssi', type=float, default=-85,
+                        help='Weakest RSSI (dBm) a device is sighted at to start a --stream session.')
+    parser.add_argument('--rssi-floor', type=float, default=None,
+                        help='Preempt --stream sessions whose RSSI falls below this (dBm). Defaults to 8 dB below '
+                             '--min-rssi.')
+    parser.add_argument('--rssi-drop', type=float, default=25,
+                        help='Preempt --stream sessions whose RSSI falls this much (dB) below its best.')
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='Sessions per device before --stream gives up on it; preempted sessions that made '
+                             'progress do not count.')
+    parser.add_argument('--job-db', default=":memory:",
+                        help='SQLite job database; reuse it to resume an interrupted batch.')
+    parser.add_argument('--bluez', action='store_true',
+                        help='Talk to BlueZ over D-Bus (needs jeepney) instead of driving gatttool.')
+    parser.add_argument('--att', action='store_true',
+                        help='Speak ATT over a raw L2CAP socket instead of driving gatttool (dedicated gateways).')
+    parser.add_argument('--adapter', default="hci0", help='Bluetooth adapter for --bluez and --att.')
+    parser.add_argument('--simulate', action='store_true',
+                        help='Dry run against simulated devices instead of gatttool.')
+    parser.add_argument('--record', metavar='DIR', default=None,
+                        help='Record each session to DIR/<address>.trace.')
+    parser.add_argument('--replay', metavar='TRACE', default=None,
+                        help='Replay a recorded trace instead of talking to a device.')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='Scale the link timing of a replayed trace.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this local port while running.')
+    parser.add_argument('--metrics-file', default=None, help='Write metrics snapshots (JSON) to this file.')
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help='Seconds between metrics snapshots.')
+    parser.add_argument('--profile', metavar='MODES', default=None,
+                        help='Profile each session: comma separated timers, cprofile, tracemalloc. '
+                             'The report is included in the JSON stats.')
+    parser.add_argument('--profile-dir', default=None, help='Write raw cProfile data per device to this directory.')
+    parser.add_argument('--json', action='store_true', help='Print per-device results and timings as JSON.')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='More logging (-vv for debug).')
+    return parser.parse_args(argv)
+
+
+def read_targets(args):
+    addresses = list(args.addresses)
+    if args.targets is not None:
+        with open(args.targets) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    addresses.append(line)
+    return [address.upper() for address in addresses]
+
+
+def simulated_transport_factory(addresses):
+    from ota_dfu_python.simulator import SimulatedAir, SimulatedDevice, SimulatedTransport
+
+    # Patterns given for --stream are not devices to simulate
+    air = SimulatedAir([SimulatedDevice(address) for address in addresses if not set("*?[") & set(address)])
+    return lambda address: SimulatedTransport(address, air)
+
+
+def bluez_transport_factory(adapter):
+    from ota_dfu_python.bluez import BluezTransport
+
+    return lambda address: BluezTransport(address, adapter=adapter)
+
+
+def att_transport_factory(adapter):
+    from ota_dfu_python.att import AttTransport
+
+    return lambda address: AttTransport(address, adapter=adapter)
+
+
+def replay_transport_factory(path, time_scale):
+    from ota_dfu_python.trace import ReplayTransport
+
+    return lambda address: ReplayTransport(path, time_scale=time_scale)
+
+
+def recording_transport_factory(directory, transport_factory=None):
+    import os
+    from ota_dfu_python.trace import RecordingTransport
+
+    if transport_factory is None:
+        from ota_dfu_python.transport import GatttoolTransport
+        transport_factory = GatttoolTransport
+
+    os.makedirs(directory, exist_ok=True)
+
+    def factory(address):
+        path = os.path.join(directory, address.replace(':', '_') + ".trace")
+        return RecordingTransport(transport_factory(address), path)
+
+    return factory
+
+
+def stream_sightings(args, transport_factory):
+    from ota_dfu_python.stream import SCAN_ADDRESS, read_sightings, scan_sightings
+
+    if args.sightings == "-":
+        yield from read_sightings(sys.stdin)
+    elif args.sightings is not None:
+        with open(args.sightings) as f:
+            yield from read_sightings(f)
+    else:
+        if transport_factory is None:
+            from ota_dfu_python.transport import GatttoolTransport
+            transport_factory = GatttoolTransport
+        with transport_factory(SCAN_ADDRESS) as transport:
+            yield from scan_sightings(transport, args.scan_interval)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)]
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S',
+                        level=level, stream=sys.stderr)
+
+    addresses = read_targets(args)
+    if not addresses:
+        logging.error("No target address given")
+        return 2
+
+    unpacker = None
+    router = None
+    digest = None
+    if args.catalogue is not None:
+        from ota_dfu_python.packages import Catalogue, VariantRouter
+        router = VariantRouter(Catalogue.load(args.catalogue), path=args.device_attributes)
+        # Jobs point at the catalogue, the package is picked per device. They
+        # are identified by the packages, not by the catalogue file.
+        hexfile = datfile = args.catalogue
+        digest = router.catalogue.digest()
+    elif args.zipfile is not None:
+        unpacker = Unpacker()
+        hexfile, datfile = unpacker.unpack_zipfile(args.zipfile)
+    elif args.hexfile is not None and args.datfile is not None:
+        hexfile, datfile = args.hexfile, args.datfile
+    else:
+        logging.error("Either a catalogue, a zip file or both hex and dat files are required")
+        return 2
+
+    controller_options = {}
+    if args.payload_size is not None:
+        controller_options["pkt_payload_size"] = args.payload_size
+    if args.prn is not None:
+        controller_options["pkt_receipt_interval"] = args.prn
+    if args.hw_version is not None:
+        controller_options["hw_version"] = args.hw_version
+    if args.sd_version is not None:
+        controller_options["sd_version"] = args.sd_version
+    if args.firmware_revision is not None:
+        controller_options["firmware_revision"] = args.firmware_revision
+    if args.calibration is not None:
+        from ota_dfu_python.calibration import CalibrationProfiles
+        controller_options["calibration"] = CalibrationProfiles(args.calibration)
+    if args.profile is not None:
+        controller_options["profile"] = args.profile
+        controller_options["profile_dir"] = args.profile_dir
+    if args.stream:
+        from ota_dfu_python.stream import RSSI_HYSTERESIS, RssiGuard
+        floor = args.rssi_floor if args.rssi_floor is not None else args.min_rssi - RSSI_HYSTERESIS
+        controller_options["link_guard"] = RssiGuard(floor, args.rssi_drop)
+
+    transport_factory = None
+    if args.replay is not None:
+        transport_factory = replay_transport_factory(args.replay, args.time_scale)
+    elif args.simulate:
+        transport_factory = simulated_transport_factory(addresses)
+    elif args.bluez:
+        transport_factory = bluez_transport_factory(args.adapter)
+    elif args.att:
+        transport_factory = att_transport_factory(args.adapter)
+    if args.record is not None:
+        transport_factory = recording_transport_factory(args.record, transport_factory)
+
+    exporters = []
+    if args.metrics_port is not None:
+        from ota_dfu_python.metrics import MetricsServer
+        exporters.append(MetricsServer(port=args.metrics_port).start())
+    if args.metrics_file is not None:
+        from ota_dfu_python.metrics import SnapshotWriter
+        exporters.append(SnapshotWriter(args.metrics_file, interval=args.metrics_interval).start())
+
+    scheduler = None
+    if args.schedule:
+        from ota_dfu_python.scheduler import AdaptiveConcurrency, DeviceHistory, FleetScheduler
+        scheduler = FleetScheduler(DeviceHistory(args.device_history), AdaptiveConcurrency(args.concurrency))
+
+    store = JobStore(args.job_db)
+    try:
+        if not args.stream:
+            for address in addresses:
+                store.add(address, hexfile, datfile, digest)
+
+        # Sessions retry in place, resuming the transfer, so a job gets one session. Devices passing
+        # by get one per sighting.
+        worker = JobWorker(store, concurrency=args.concurrency, max_attempts=args.sessions if args.stream else 1,
+                           transport_factory=transport_factory, controller_options=controller_options,
+                           address_map=AddressMap(args.address_map), retry=RetryPolicy(attempts=args.retries),
+                           stage_ahead=0 if args.stream else args.stage_ahead,
+                           bootloader_timeout=args.bootloader_timeout, router=router, scheduler=scheduler,
+                           adapter=args.adapter if args.bluez or args.att else None)
+        if args.stream:
+            from ota_dfu_python.stream import StreamingUpdater
+            updater = StreamingUpdater(worker, hexfile, datfile, patterns=addresses, min_rssi=args.min_rssi,
+                                       package_hash=digest)
+            try:
+                results = updater.run(stream_sightings(args, transport_factory))
+            except KeyboardInterrupt:
+                # The running sessions were let finish
+                results = updater.results
+        else:
+            results = worker.run()
+        jobs = store.jobs()
+        summary = store.summary()
+    finally:
+        store.close()
+        for exporter in exporters:
+            exporter.close()
+        if unpacker is not None:
+            unpacker.delete()
+        if router is not None:
+            router.catalogue.close()
+
+    if args.json:
+        json.dump({"results": results, "jobs": [job.as_dict() for job in jobs], "summary": summary},
+                  sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        for job in jobs:
+            line = "%s: %s after %d attempt(s)" % (job.address, job.state, job.attempts)
+            if job.error:
+                line += " (%s)" % job.error
+            print(line)
+
+    if any(job.state not in (JobStates.DONE, JobStates.SKIPPED) for job in jobs):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
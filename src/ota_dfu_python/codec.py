@@ -0,0 +1,332 @@
+"""
+------------------------------------------------------------------------------
+ Secure DFU control point codec.
+
+ Encodes control point requests and decodes responses (and Packet Receipt
+ Notifications, which share the CALC_CHECKSUM response format) from bytes,
+ using precompiled struct formats. Responses are small slotted objects;
+ unknown opcodes and result codes decode instead of raising.
+------------------------------------------------------------------------------
+"""
+import struct
+
+
+class CodecError(Exception):
+    pass
+
+
+class DfuResponseError(Exception):
+    """The peripheral answered a procedure with an error result"""
+
+    def __init__(self, response):
+        Exception.__init__(self, "Error in {} procedure, reason: {}".format(
+            Procedures.to_string(response.opcode), response.error_string()))
+        self.response = response
+
+
+class Procedures:
+    PROTOCOL_VERSION    = 0x00
+    CREATE              = 0x01
+    SET_PRN             = 0x02
+    CALC_CHECKSUM       = 0x03
+    EXECUTE             = 0x04
+    SELECT              = 0x06
+    MTU_GET             = 0x07
+    WRITE               = 0x08
+    PING                = 0x09
+    HARDWARE_VERSION    = 0x0A
+    FIRMWARE_VERSION    = 0x0B
+    ABORT               = 0x0C
+    RESPONSE            = 0x60
+    INVALID             = 0xFF
+
+    PARAM_COMMAND   = 0x01
+    PARAM_DATA      = 0x02
+
+    string_map = {
+        PROTOCOL_VERSION    : "PROTOCOL_VERSION",
+        CREATE              : "CREATE",
+        SET_PRN             : "SET_PRN",
+        CALC_CHECKSUM       : "CALC_CHECKSUM",
+        EXECUTE             : "EXECUTE",
+        SELECT              : "SELECT",
+        MTU_GET             : "MTU_GET",
+        WRITE               : "WRITE",
+        PING                : "PING",
+        HARDWARE_VERSION    : "HARDWARE_VERSION",
+        FIRMWARE_VERSION    : "FIRMWARE_VERSION",
+        ABORT               : "ABORT",
+        RESPONSE            : "RESPONSE",
+        INVALID             : "INVALID",
+    }
+
+    @staticmethod
+    def to_string(proc):
+        return Procedures.string_map.get(proc, "UNKNOWN(0x%02x)" % proc)
+
+    @staticmethod
+    def from_string(proc_str):
+        return int(proc_str, 16)
+
+
+class Results:
+    INVALID_CODE                = 0x00
+    SUCCESS                     = 0x01
+    OPCODE_NOT_SUPPORTED        = 0x02
+    INVALID_PARAMETER           = 0x03
+    INSUFF_RESOURCES            = 0x04
+    INVALID_OBJECT              = 0x05
+    UNSUPPORTED_TYPE            = 0x07
+    OPERATION_NOT_PERMITTED     = 0x08
+    OPERATION_FAILED            = 0x0A
+    EXT_ERROR                   = 0x0B
+
+    string_map = {
+        INVALID_CODE            : "INVALID_CODE",
+        SUCCESS                 : "SUCCESS",
+        OPCODE_NOT_SUPPORTED    : "OPCODE_NOT_SUPPORTED",
+        INVALID_PARAMETER       : "INVALID_PARAMETER",
+        INSUFF_RESOURCES        : "INSUFFICIENT_RESOURCES",
+        INVALID_OBJECT          : "INVALID_OBJECT",
+        UNSUPPORTED_TYPE        : "UNSUPPORTED_TYPE",
+        OPERATION_NOT_PERMITTED : "OPERATION_NOT_PERMITTED",
+        OPERATION_FAILED        : "OPERATION_FAILED",
+        EXT_ERROR               : "EXTENDED_ERROR",
+    }
+
+    @staticmethod
+    def to_string(res):
+        return Results.string_map.get(res, "UNKNOWN(0x%02x)" % res)
+
+    @staticmethod
+    def from_string(res_str):
+        return int(res_str, 16)
+
+
+class ExtendedErrors:
+    NO_ERROR                = 0x00
+    INVALID_ERROR_CODE      = 0x01
+    WRONG_COMMAND_FORMAT    = 0x02
+    UNKNOWN_COMMAND         = 0x03
+    INIT_COMMAND_INVALID    = 0x04
+    FW_VERSION_FAILURE      = 0x05
+    HW_VERSION_FAILURE      = 0x06
+    SD_VERSION_FAILURE      = 0x07
+    SIGNATURE_MISSING       = 0x08
+    WRONG_HASH_TYPE         = 0x09
+    HASH_FAILED             = 0x0A
+    WRONG_SIGNATURE_TYPE    = 0x0B
+    VERIFICATION_FAILED     = 0x0C
+    INSUFFICIENT_SPACE      = 0x0D
+
+    string_map = {
+        NO_ERROR                : "NO_ERROR",
+        INVALID_ERROR_CODE      : "INVALID_ERROR_CODE",
+        WRONG_COMMAND_FORMAT    : "WRONG_COMMAND_FORMAT",
+        UNKNOWN_COMMAND         : "UNKNOWN_COMMAND",
+        INIT_COMMAND_INVALID    : "INIT_COMMAND_INVALID",
+        FW_VERSION_FAILURE      : "FW_VERSION_FAILURE",
+        HW_VERSION_FAILURE      : "HW_VERSION_FAILURE",
+        SD_VERSION_FAILURE      : "SD_VERSION_FAILURE",
+        SIGNATURE_MISSING       : "SIGNATURE_MISSING",
+        WRONG_HASH_TYPE         : "WRONG_HASH_TYPE",
+        HASH_FAILED             : "HASH_FAILED",
+        WRONG_SIGNATURE_TYPE    : "WRONG_SIGNATURE_TYPE",
+        VERIFICATION_FAILED     : "VERIFICATION_FAILED",
+        INSUFFICIENT_SPACE      : "INSUFFICIENT_SPACE",
+    }
+
+    @staticmethod
+    def to_string(err):
+        return ExtendedErrors.string_map.get(err, "UNKNOWN(0x%02x)" % err)
+
+
+# ------------------------------------------------------------------------------
+#  Requests
+# ------------------------------------------------------------------------------
+_OPCODE = struct.Struct('<B')
+_OPCODE_U8 = struct.Struct('<BB')
+_OPCODE_U16 = struct.Struct('<BH')
+_CREATE = struct.Struct('<BBI')
+
+def encode_protocol_version():
+    return _OPCODE.pack(Procedures.PROTOCOL_VERSION)
+
+def encode_create(object_type, size):
+    return _CREATE.pack(Procedures.CREATE, object_type, size)
+
+def encode_set_prn(interval):
+    return _OPCODE_U16.pack(Procedures.SET_PRN, interval)
+
+def encode_calc_checksum():
+    return _OPCODE.pack(Procedures.CALC_CHECKSUM)
+
+def encode_execute():
+    return _OPCODE.pack(Procedures.EXECUTE)
+
+def encode_select(object_type):
+    return _OPCODE_U8.pack(Procedures.SELECT, object_type)
+
+def encode_mtu_get():
+    return _OPCODE.pack(Procedures.MTU_GET)
+
+def encode_ping(ping_id):
+    return _OPCODE_U8.pack(Procedures.PING, ping_id)
+
+def encode_hardware_version():
+    return _OPCODE.pack(Procedures.HARDWARE_VERSION)
+
+def encode_firmware_version(image):
+    return _OPCODE_U8.pack(Procedures.FIRMWARE_VERSION, image)
+
+def encode_abort():
+    return _OPCODE.pack(Procedures.ABORT)
+
+
+# ------------------------------------------------------------------------------
+#  Responses
+# ------------------------------------------------------------------------------
+class Response(object):
+    """Response without payload (CREATE, SET_PRN, EXECUTE, ABORT, errors)"""
+    __slots__ = ("opcode", "result", "extended_error")
+
+    FIELDS = ()
+
+    def __init__(self, opcode, result, extended_error=None):
+        self.opcode = opcode
+        self.result = result
+        self.extended_error = extended_error
+
+    @property
+    def success(self):
+        return self.result == Results.SUCCESS
+
+    def error_string(self):
+        if self.result == Results.EXT_ERROR and self.extended_error is not None:
+            return "{} ({})".format(Results.to_string(self.result), ExtendedErrors.to_string(self.extended_error))
+        return Results.to_string(self.result)
+
+    def __repr__(self):
+        fields = "".join(", %s=%r" % (name, getattr(self, name)) for name in self.FIELDS)
+        return "%s(%s, %s%s)" % (type(self).__name__, Procedures.to_string(self.opcode), self.error_string(), fields)
+
+
+class ProtocolVersionResponse(Response):
+    __slots__ = ("version",)
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<B')
+
+    def __init__(self, opcode, result, version):
+        Response.__init__(self, opcode, result)
+        self.version = version
+
+
+class SelectResponse(Response):
+    __slots__ = ("max_size", "offset", "crc32")
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<III')
+
+    def __init__(self, opcode, result, max_size, offset, crc32):
+        Response.__init__(self, opcode, result)
+        self.max_size = max_size
+        self.offset = offset
+        self.crc32 = crc32
+
+
+class ChecksumResponse(Response):
+    """CALC_CHECKSUM response, also the format of Packet Receipt Notifications"""
+    __slots__ = ("offset", "crc32")
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<II')
+
+    def __init__(self, opcode, result, offset, crc32):
+        Response.__init__(self, opcode, result)
+        self.offset = offset
+        self.crc32 = crc32
+
+
+class MtuResponse(Response):
+    __slots__ = ("mtu",)
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<H')
+
+    def __init__(self, opcode, result, mtu):
+        Response.__init__(self, opcode, result)
+        self.mtu = mtu
+
+
+class PingResponse(Response):
+    __slots__ = ("ping_id",)
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<B')
+
+    def __init__(self, opcode, result, ping_id):
+        Response.__init__(self, opcode, result)
+        self.ping_id = ping_id
+
+
+class HardwareVersionResponse(Response):
+    __slots__ = ("part", "variant", "rom_size", "ram_size", "rom_page_size")
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<IIIII')
+
+    def __init__(self, opcode, result, part, variant, rom_size, ram_size, rom_page_size):
+        Response.__init__(self, opcode, result)
+        self.part = part
+        self.variant = variant
+        self.rom_size = rom_size
+        self.ram_size = ram_size
+        self.rom_page_size = rom_page_size
+
+
+class FirmwareVersionResponse(Response):
+    __slots__ = ("fw_type", "version", "addr", "length")
+    FIELDS = __slots__
+    FORMAT = struct.Struct('<BIII')
+
+    def __init__(self, opcode, result, fw_type, version, addr, length):
+        Response.__init__(self, opcode, result)
+        self.fw_type = fw_type
+        self.version = version
+        self.addr = addr
+        self.length = length
+
+
+_RESPONSE_TYPES = {
+    Procedures.PROTOCOL_VERSION : ProtocolVersionResponse,
+    Procedures.SELECT           : SelectResponse,
+    Procedures.CALC_CHECKSUM    : ChecksumResponse,
+    Procedures.MTU_GET          : MtuResponse,
+    Procedures.PING             : PingResponse,
+    Procedures.HARDWARE_VERSION : HardwareVersionResponse,
+    Procedures.FIRMWARE_VERSION : FirmwareVersionResponse,
+}
+
+_HEADER = struct.Struct('<BBB')
+
+
+def decode_response(data):
+    """
+    Decode a control point notification. Raises CodecError if it is not a
+    response or a successful response is too short for its payload; extra
+    trailing bytes are ignored.
+    """
+    if len(data) < _HEADER.size:
+        raise CodecError("Response too short: {} byte(s)".format(len(data)))
+
+    (response, opcode, result) = _HEADER.unpack_from(data)
+    if response != Procedures.RESPONSE:
+        raise CodecError("Not a response: opcode 0x{:02x}".format(response))
+
+    if result != Results.SUCCESS:
+        extended_error = data[3] if result == Results.EXT_ERROR and len(data) > 3 else None
+        return Response(opcode, result, extended_error)
+
+    cls = _RESPONSE_TYPES.get(opcode)
+    if cls is None:
+        return Response(opcode, result)
+
+    if len(data) < _HEADER.size + cls.FORMAT.size:
+        raise CodecError("{} response too short: {} byte(s)".format(Procedures.to_string(opcode), len(data)))
+
+    return cls(opcode, result, *cls.FORMAT.unpack_from(data, _HEADER.size))
@@ -5,50 +5,176 @@
  Conforms to nRF51_SDK 11.0 BLE_DFU requirements.
 ------------------------------------------------------------------------------
 """
-import os, re
-import sys
-import optparse
-import time
-import math
-import traceback
-import asyncio
 import logging
 
 from ota_dfu_python.ble_secure_dfu_controller import BleDfuControllerSecure
+from ota_dfu_python.addresses import offset_address
+from ota_dfu_python.events import Phases, PhaseEvent, ErrorEvent, RetryEvent
+from ota_dfu_python.retry import RetryPolicy, LinkLostError, classify
 
 class SecureDfu():
-    def __init__(self, address, hexfile, datfile):
+    def __init__(self, address, hexfile, datfile, transport=None, address_map=None, retry=None, router=None,
+                 **options):
+        """options are set on the controller, e.g. pkt_receipt_interval=12 or hw_version=52.
+        address_map (ota_dfu_python.addresses.AddressMap) learns where the bootloader advertises.
+        retry (ota_dfu_python.retry.RetryPolicy) sets the attempts perform_dfu makes.
+        router (ota_dfu_python.packages.VariantRouter) picks the package once connected; hexfile
+        and datfile are not used then."""
         self.address = address
         self.hexfile = hexfile
         self.datfile = datfile
+        self.address_map = address_map
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.router = router
 
-        self.ble_dfu = BleDfuControllerSecure(self.address.upper(), self.hexfile, self.datfile)
-        # Initialize inputs
-        self.ble_dfu.input_setup()
+        self.ble_dfu = BleDfuControllerSecure(self.address.upper(), self.hexfile, self.datfile, transport)
+        try:
+            for name, value in options.items():
+                setattr(self.ble_dfu, name, value)
+            # Settings given here win over calibration profiles
+            self.ble_dfu.calibration_pinned = set(options)
+            # Initialize inputs. Routed sessions load theirs once the device is known.
+            if router is None:
+                self.ble_dfu.input_setup()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Disconnect and close the transport. Safe to call on any exit path."""
+        self.ble_dfu.close()
+
+    def subscribe(self, callback, event_types=None, min_interval=0.0):
+        """Register callback(event) for session events, see ota_dfu_python.events"""
+        return self.ble_dfu.subscribe(callback, event_types, min_interval)
 
     def perform_dfu(self):
-        """Perform OTA DFU on BLE device with selected address"""
+        """Perform OTA DFU on BLE device with selected address. Retriable failures
+        are retried on the same controller, resuming where the device left off."""
+        dfu = self.ble_dfu
+        attempt = 1
+        while True:
+            started = dfu.transport.clock()
+            try:
+                self._perform_dfu()
+                return
+            except Exception as e:
+                if not self.retry.should_retry(attempt, e):
+                    dfu.events.emit(ErrorEvent(e))
+                    dfu.events.emit(PhaseEvent(Phases.FAILED))
+                    self._disconnect()
+                    raise
+
+                kind = classify(e)
+                delay = self.retry.delay(attempt)
+                logging.warning(f"DFU attempt {attempt} failed ({kind}): {e}, retrying in {delay:.1f} s")
+                dfu.events.emit(RetryEvent(attempt, kind, dfu.transport.clock() - started, delay, e))
+
+            self._disconnect()
+            dfu.transport.sleep(delay)
+            attempt += 1
+
+    def _perform_dfu(self):
+        if not self.connect():
+            return
+
+        self.ble_dfu.start()
+
+        # Disconnect from peer device if not done already and clean up.
+        self.ble_dfu.disconnect()
+
+        if self.router is not None:
+            # The bootloader took the package, so it fits the device
+            self.router.remember(self.address, hw_version=self.ble_dfu.model)
+
+    def _disconnect(self):
+        try:
+            self.ble_dfu.disconnect()
+        except Exception as e:
+            logging.debug(f"Disconnect from {self.ble_dfu.target_mac} failed: {e}")
+
+    def stage(self):
+        """Reboot the device into its bootloader and leave it advertising there, so that a
+        later perform_dfu (with a new SecureDfu) starts right away. Returns False if the
+        device already runs the firmware. Not a session: the metrics are left alone."""
+        self.ble_dfu.unsubscribe(self.ble_dfu.metrics_subscription)
+        if not self.connect():
+            return False
+        self.ble_dfu.disconnect()
+        return True
+
+    def connect(self):
+        """Connect to the device's bootloader, rebooting it into DFU mode if needed.
+        Returns False if the device already runs the firmware (see firmware_revision)."""
+        dfu = self.ble_dfu
+        app_mac = self.address.upper()
+        if dfu.target_mac != app_mac:
+            # Retrying after the bootloader was reached
+            dfu.retarget(app_mac)
+        model = dfu.model
+        if self.address_map is not None:
+            dfu.bootloader_offsets = self.address_map.offsets(app_mac, model)
+        bootloader = [offset for offset in dfu.bootloader_offsets if offset != 0]
+
+        dfu.events.emit(PhaseEvent(Phases.CONNECT))
+
+        # Listen for both the application and the bootloader addresses. If
+        # only a bootloader advertises, the device is already in DFU mode.
+        candidates = [offset_address(app_mac, offset) for offset in bootloader]
+        seen = dfu.scan([app_mac] + candidates)
+        in_bootloader = bool(seen) and app_mac not in seen and any(address in seen for address in candidates)
+
         # Connect to peer device. Assume application mode.
-        if self.ble_dfu.scan_and_connect():  # works
-            dfu_mode = self.ble_dfu.check_DFU_mode()
-            # assume false: 
-            # dfu_mode = False
+        if not in_bootloader and dfu.scan_and_connect():
+            dfu_mode = dfu.check_DFU_mode()
             logging.info(f"Device dfu mode: {dfu_mode}")
-            if not dfu_mode:
+            if self.router is not None:
+                self._route(None if dfu_mode else dfu.read_device_info())
+            if not dfu_mode and dfu.is_current():
+                # Already updated, no need to reboot into the bootloader
+                logging.info("Device already runs the firmware, skipping DFU")
+                dfu.stats.skipped = "firmware revision"
+                dfu.events.emit(PhaseEvent(Phases.COMPLETE))
+                dfu.disconnect()
+                return False
+
+            if dfu_mode:
+                # The bootloader advertises at the application address
+                offset = 0
+            else:
                 logging.info("Need to switch to DFU mode")
-                success = self.ble_dfu.switch_to_dfu_mode()
-                if not success:
-                    logging.info("Couldn't reconnect")
+                dfu.events.emit(PhaseEvent(Phases.DFU_MODE))
+                offset = dfu.switch_to_dfu_mode()
+                if offset is None:
+                    raise LinkLostError("Couldn't reconnect to the bootloader")
         else:
-            # The device might already be in DFU mode (MAC + 1)
-            self.ble_dfu.target_mac_increase(1)
-
-            # Try connection with new address
+            # The device might already be in DFU mode
             logging.info("Couldn't connect, will try DFU MAC")
-            if not self.ble_dfu.scan_and_connect():
-                raise Exception("Can't connect to device")
+            if self.router is not None:
+                self._route(None)
+            offset = dfu.connect_bootloader(app_mac, bootloader, seen if in_bootloader else None)
+            if offset is None:
+                raise LinkLostError("Can't connect to device")
 
-        self.ble_dfu.start()
+        logging.info(f"Bootloader at {dfu.target_mac} (application address + {offset})")
+        if self.address_map is not None:
+            self.address_map.record(app_mac, offset, dfu.model if model is None else model)
+        return True
 
-        # Disconnect from peer device if not done already and clean up.
-        self.ble_dfu.disconnect()
\ No newline at end of file
+    def _route(self, reported):
+        """Load the package of the device's variant into the controller"""
+        dfu = self.ble_dfu
+        (variant, package) = self.router.route(self.address, reported)
+        logging.info(f"Firmware variant for {self.address}: {variant.name}")
+
+        dfu.package = package
+        if variant.firmware_revision is not None and "firmware_revision" not in dfu.calibration_pinned:
+            dfu.firmware_revision = variant.firmware_revision
+        dfu.input_setup()
+        dfu.stats.package = variant.name
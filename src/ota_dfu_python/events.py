@@ -0,0 +1,184 @@
+"""
+------------------------------------------------------------------------------
+ DFU session events.
+
+ Controllers publish typed events through an EventDispatcher instead of
+ writing to stdout. Subscribers may ask for high-frequency events to be
+ coalesced so that a slow consumer never throttles the send loop.
+------------------------------------------------------------------------------
+"""
+import logging
+import time
+
+from ota_dfu_python.util import print_progress
+
+
+class Phases:
+    CONNECT     = "connect"
+    DFU_MODE    = "dfu_mode"
+    INIT        = "init"
+    IMAGE       = "image"
+    COMPLETE    = "complete"
+    FAILED      = "failed"
+
+
+class DfuEvent(object):
+    __slots__ = ("timestamp",)
+
+    def __init__(self):
+        self.timestamp = None
+
+    def __repr__(self):
+        fields = ", ".join("%s=%r" % (name, getattr(self, name)) for name in self._fields())
+        return "%s(%s)" % (type(self).__name__, fields)
+
+    def _fields(self):
+        return [name for cls in type(self).__mro__ for name in getattr(cls, "__slots__", ())]
+
+
+class PhaseEvent(DfuEvent):
+    """The session moved to a new phase (see Phases)"""
+    __slots__ = ("phase",)
+
+    def __init__(self, phase):
+        DfuEvent.__init__(self)
+        self.phase = phase
+
+
+class ProgressEvent(DfuEvent):
+    """Bytes of the firmware image acknowledged by the peripheral"""
+    __slots__ = ("bytes_sent", "total")
+
+    def __init__(self, bytes_sent, total):
+        DfuEvent.__init__(self)
+        self.bytes_sent = bytes_sent
+        self.total = total
+
+
+class ObjectCommittedEvent(DfuEvent):
+    """A data object was executed (written to flash) by the peripheral"""
+    __slots__ = ("offset", "size")
+
+    def __init__(self, offset, size):
+        DfuEvent.__init__(self)
+        self.offset = offset
+        self.size = size
+
+
+class RetransmitEvent(DfuEvent):
+    """A data object has to be sent again"""
+    __slots__ = ("offset", "reason")
+
+    def __init__(self, offset, reason):
+        DfuEvent.__init__(self)
+        self.offset = offset
+        self.reason = reason
+
+
+class ErrorEvent(DfuEvent):
+    """The session failed with the given exception"""
+    __slots__ = ("error",)
+
+    def __init__(self, error):
+        DfuEvent.__init__(self)
+        self.error = error
+
+
+class RetryEvent(DfuEvent):
+    """Attempt number `attempt` failed after `elapsed` seconds with a retriable
+    error of the given kind (see ota_dfu_python.retry); the next one starts
+    after `delay` seconds"""
+    __slots__ = ("attempt", "kind", "elapsed", "delay", "error")
+
+    def __init__(self, attempt, kind, elapsed, delay, error):
+        DfuEvent.__init__(self)
+        self.attempt = attempt
+        self.kind = kind
+        self.elapsed = elapsed
+        self.delay = delay
+        self.error = error
+
+
+class _Subscription(object):
+    __slots__ = ("callback", "event_types", "min_interval", "last_delivery", "pending")
+
+    def __init__(self, callback, event_types, min_interval):
+        self.callback = callback
+        self.event_types = event_types
+        self.min_interval = min_interval
+        self.last_delivery = None
+        self.pending = None
+
+
+class EventDispatcher(object):
+    """
+    Fan out events to subscribers.
+
+    ProgressEvents are coalesced per subscriber: a subscriber registered with
+    min_interval > 0 receives at most one progress update per interval, the
+    latest one winning. A held-back update is flushed before any other event
+    and the final (bytes_sent == total) update is always delivered.
+
+    Events are timestamped with clock() when emitted.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._subscriptions = []
+
+    def __bool__(self):
+        return len(self._subscriptions) > 0
+
+    def subscribe(self, callback, event_types=None, min_interval=0.0):
+        """Register callback(event). Returns a handle for unsubscribe()"""
+        if event_types is not None:
+            event_types = tuple(event_types)
+        subscription = _Subscription(callback, event_types, min_interval)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, handle):
+        if handle in self._subscriptions:
+            self._subscriptions.remove(handle)
+
+    def emit(self, event):
+        event.timestamp = self.clock()
+        for subscription in self._subscriptions:
+            if subscription.event_types is not None and not isinstance(event, subscription.event_types):
+                continue
+
+            if isinstance(event, ProgressEvent) and subscription.min_interval > 0:
+                if event.bytes_sent < event.total and subscription.last_delivery is not None and \
+                        event.timestamp - subscription.last_delivery < subscription.min_interval:
+                    subscription.pending = event
+                    continue
+            elif subscription.pending is not None:
+                self._deliver(subscription, subscription.pending)
+
+            self._deliver(subscription, event)
+
+    def flush(self):
+        """Deliver any coalesced progress update still held back"""
+        for subscription in self._subscriptions:
+            if subscription.pending is not None:
+                self._deliver(subscription, subscription.pending)
+
+    def _deliver(self, subscription, event):
+        subscription.pending = None
+        subscription.last_delivery = event.timestamp
+        try:
+            subscription.callback(event)
+        except Exception as e:
+            # A misbehaving subscriber must never abort a firmware update
+            logging.error(f"Event subscriber {subscription.callback!r} failed: {e}")
+
+
+class ProgressBar(object):
+    """Subscriber drawing the classic terminal progress bar"""
+
+    def __init__(self, bar_length=50):
+        self.bar_length = bar_length
+
+    def __call__(self, event):
+        if isinstance(event, ProgressEvent):
+            print_progress(event.bytes_sent, event.total, barLength=self.bar_length)
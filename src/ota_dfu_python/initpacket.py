@@ -0,0 +1,296 @@
+"""
+------------------------------------------------------------------------------
+ Secure DFU init packet (*.dat) decoding and pre-flight validation.
+
+ The init packet is a protobuf message (dfu-cc.proto from the nRF5 SDK /
+ nrfutil). Only the fields needed to validate a package on the host are
+ decoded, with a small wire format reader instead of a protobuf dependency:
+
+   Packet        { Command command = 1; SignedCommand signed_command = 2; }
+   SignedCommand { Command command = 1; SignatureType signature_type = 2; bytes signature = 3; }
+   Command       { OpCode op_code = 1; InitCommand init = 2; }
+   InitCommand   { uint32 fw_version = 1; uint32 hw_version = 2; repeated uint32 sd_req = 3;
+                   FwType type = 4; uint32 sd_size = 5; uint32 bl_size = 6; uint32 app_size = 7;
+                   Hash hash = 8; bool is_debug = 9; }
+   Hash          { HashType hash_type = 1; bytes hash = 2; }
+------------------------------------------------------------------------------
+"""
+import functools
+import logging
+import os
+
+
+class InitPacketError(Exception):
+    pass
+
+
+class FwTypes:
+    APPLICATION             = 0
+    SOFTDEVICE              = 1
+    BOOTLOADER              = 2
+    SOFTDEVICE_BOOTLOADER   = 3
+    EXTERNAL_APPLICATION    = 4
+
+    string_map = {
+        APPLICATION             : "APPLICATION",
+        SOFTDEVICE              : "SOFTDEVICE",
+        BOOTLOADER              : "BOOTLOADER",
+        SOFTDEVICE_BOOTLOADER   : "SOFTDEVICE_BOOTLOADER",
+        EXTERNAL_APPLICATION    : "EXTERNAL_APPLICATION",
+    }
+
+    @staticmethod
+    def to_string(fw_type):
+        return FwTypes.string_map.get(fw_type, "UNKNOWN(%d)" % fw_type)
+
+
+class HashTypes:
+    NO_HASH = 0
+    CRC     = 1
+    SHA128  = 2
+    SHA256  = 3
+    SHA512  = 4
+
+
+# sd_req value accepting any (or no) SoftDevice
+SD_REQ_ANY = 0xFFFE
+
+OPCODE_INIT = 1
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH = 2
+WIRE_FIXED32 = 5
+
+
+class InitPacket(object):
+    __slots__ = ("signed", "fw_version", "hw_version", "sd_req", "fw_type",
+                 "sd_size", "bl_size", "app_size", "hash_type", "hash", "is_debug")
+
+    def __init__(self):
+        self.signed = False
+        self.fw_version = None
+        self.hw_version = None
+        self.sd_req = []
+        self.fw_type = FwTypes.APPLICATION
+        self.sd_size = 0
+        self.bl_size = 0
+        self.app_size = 0
+        self.hash_type = HashTypes.NO_HASH
+        self.hash = b''
+        self.is_debug = False
+
+    @property
+    def image_size(self):
+        """Size of the binary this init packet describes"""
+        return self.sd_size + self.bl_size + self.app_size
+
+    def __repr__(self):
+        return "InitPacket(type=%s, fw_version=%r, hw_version=%r, sd_req=%s, size=%d, signed=%r)" % (
+            FwTypes.to_string(self.fw_type), self.fw_version, self.hw_version,
+            ["0x%04x" % sd for sd in self.sd_req], self.image_size, self.signed)
+
+
+# ------------------------------------------------------------------------------
+#  Protobuf wire format
+# ------------------------------------------------------------------------------
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise InitPacketError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise InitPacketError("Varint too long")
+
+
+def _fields(data):
+    """Yield (field number, wire type, value) for each field of a message"""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x07
+
+        if wire_type == WIRE_VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == WIRE_LENGTH:
+            length, pos = _read_varint(data, pos)
+            if pos + length > len(data):
+                raise InitPacketError("Truncated field %d" % number)
+            value = bytes(data[pos:pos + length])
+            pos += length
+        elif wire_type == WIRE_FIXED32:
+            value = bytes(data[pos:pos + 4])
+            pos += 4
+        elif wire_type == WIRE_FIXED64:
+            value = bytes(data[pos:pos + 8])
+            pos += 8
+        else:
+            raise InitPacketError("Unsupported wire type %d" % wire_type)
+
+        if pos > len(data):
+            raise InitPacketError("Truncated field %d" % number)
+
+        yield number, wire_type, value
+
+
+def _packed_varints(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = _read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def _decode_init(data, packet):
+    for number, wire_type, value in _fields(data):
+        if number == 1:
+            packet.fw_version = value
+        elif number == 2:
+            packet.hw_version = value
+        elif number == 3:
+            # Repeated field, packed or not
+            if wire_type == WIRE_LENGTH:
+                packet.sd_req.extend(_packed_varints(value))
+            else:
+                packet.sd_req.append(value)
+        elif number == 4:
+            packet.fw_type = value
+        elif number == 5:
+            packet.sd_size = value
+        elif number == 6:
+            packet.bl_size = value
+        elif number == 7:
+            packet.app_size = value
+        elif number == 8:
+            for hash_number, _, hash_value in _fields(value):
+                if hash_number == 1:
+                    packet.hash_type = hash_value
+                elif hash_number == 2:
+                    packet.hash = hash_value
+        elif number == 9:
+            packet.is_debug = bool(value)
+
+
+def _decode_command(data, packet):
+    opcode = None
+    init = None
+    for number, _, value in _fields(data):
+        if number == 1:
+            opcode = value
+        elif number == 2:
+            init = value
+
+    if opcode not in (None, OPCODE_INIT) or init is None:
+        raise InitPacketError("Not an init command")
+
+    _decode_init(init, packet)
+
+
+def decode_init_packet(data):
+    """Decode the contents of a *.dat file into an InitPacket"""
+    packet = InitPacket()
+    command = None
+
+    for number, wire_type, value in _fields(bytes(data)):
+        if wire_type != WIRE_LENGTH:
+            continue
+        if number == 1:
+            command = value
+        elif number == 2:
+            packet.signed = True
+            for signed_number, _, signed_value in _fields(value):
+                if signed_number == 1:
+                    command = signed_value
+
+    if command is None:
+        raise InitPacketError("No command in init packet")
+
+    _decode_command(command, packet)
+    return packet
+
+
+# ------------------------------------------------------------------------------
+#  Pre-flight validation
+# ------------------------------------------------------------------------------
+def _file_key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_init_packet(key):
+    with open(key[0], 'rb') as f:
+        return decode_init_packet(f.read())
+
+
+def load_init_packet(path):
+    """Decode a *.dat file, cached per file (path, mtime and size)"""
+    return _load_init_packet(_file_key(path))
+
+
+@functools.lru_cache(maxsize=32)
+def _validate(init_key, image_key, image_digest, hw_version, sd_version):
+    packet = _load_init_packet(init_key)
+    problems = []
+
+    if packet.fw_type not in FwTypes.string_map:
+        problems.append("unknown image type %d" % packet.fw_type)
+
+    if packet.image_size != image_key[2]:
+        problems.append("init packet describes %d bytes of %s, image has %d" % (
+            packet.image_size, FwTypes.to_string(packet.fw_type), image_key[2]))
+
+    if packet.hash_type == HashTypes.SHA256:
+        # nrfutil stores the digest byte-reversed (little endian)
+        if packet.hash not in (image_digest, image_digest[::-1]):
+            problems.append("SHA-256 of image does not match init packet")
+    elif packet.hash_type != HashTypes.NO_HASH:
+        logging.debug(f"Init packet hash type {packet.hash_type} not checked on the host")
+
+    if hw_version is not None and packet.hw_version is not None and packet.hw_version != hw_version:
+        problems.append("init packet requires hw_version %d, device has %d" % (packet.hw_version, hw_version))
+
+    if sd_version is not None and packet.sd_req and SD_REQ_ANY not in packet.sd_req and sd_version not in packet.sd_req:
+        problems.append("init packet requires SoftDevice %s, device has 0x%04x" % (
+            ", ".join("0x%04x" % sd for sd in packet.sd_req), sd_version))
+
+    if problems:
+        raise InitPacketError("Invalid DFU package: " + "; ".join(problems))
+
+    return packet
+
+
+def validate_package(datfile_path, firmware_path, image, hw_version=None, sd_version=None):
+    """
+    Check an init packet against the image it is sent with, and optionally
+    against the device's hardware version and SoftDevice id. Raises
+    InitPacketError on mismatch, returns the decoded InitPacket otherwise.
+    Results are cached per (init packet, image) file pair.
+    """
+    init_key = _file_key(datfile_path)
+    image_key = _file_key(firmware_path)
+    # The image may have been converted (hex -> bin), so key on its actual size
+    image_key = image_key[:2] + (len(image),)
+    return _validate(init_key, image_key, _image_digest(image_key, image), hw_version, sd_version)
+
+
+_digests = {}
+
+def _image_digest(image_key, image):
+    digest = _digests.get(image_key)
+    if digest is None:
+        import hashlib
+
+        digest = hashlib.sha256(bytes(image)).digest()
+        if len(_digests) > 32:
+            _digests.clear()
+        _digests[image_key] = digest
+    return digest
@@ -0,0 +1,565 @@
+"""
+------------------------------------------------------------------------------
+ Persistent DFU job queue.
+
+ JobStore keeps DFU jobs (target device + firmware package) in a local
+ SQLite database so that unattended campaigns survive crashes and reboots.
+ JobWorker drains the store with a bounded number of concurrent sessions.
+------------------------------------------------------------------------------
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+from ota_dfu_python.addresses import AddressMap
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.events import ObjectCommittedEvent
+from ota_dfu_python.metrics import DfuMetrics
+from ota_dfu_python.packages import PackageCache
+from ota_dfu_python.retry import RetryPolicy, PreemptedError, is_retriable
+
+
+class JobStates:
+    PENDING     = "pending"
+    IN_PROGRESS = "in_progress"
+    DONE        = "done"
+    SKIPPED     = "skipped"     # device already had the package
+    FAILED      = "failed"
+
+
+class Job(object):
+    __slots__ = ("id", "address", "firmware_path", "datfile_path", "package_hash", "state",
+                 "offset", "attempts", "created", "started", "finished", "duration", "error")
+
+    def __init__(self, row):
+        for name in self.__slots__:
+            setattr(self, name, row[name])
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "Job(%d, %s, %s)" % (self.id, self.address, self.state)
+
+
+def package_hash(firmware_path, datfile_path):
+    """SHA-256 over the image and init packet, identifying a package"""
+    sha = hashlib.sha256()
+    for path in (firmware_path, datfile_path):
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class JobStore(object):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            address         TEXT NOT NULL,
+            firmware_path   TEXT NOT NULL,
+            datfile_path    TEXT NOT NULL,
+            package_hash    TEXT NOT NULL,
+            state           TEXT NOT NULL,
+            offset          INTEGER NOT NULL DEFAULT 0,
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            created         REAL NOT NULL,
+            started         REAL,
+            finished        REAL,
+            duration        REAL,
+            error           TEXT,
+            UNIQUE (address, package_hash)
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        # Each state change is committed before it is acted upon
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(self.SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    # --------------------------------------------------------------------------
+    #  Queue a DFU of the given package to address. A device already queued
+    #  for the same package is not queued twice; its job id is returned.
+    #  `digest` identifies the package instead of package_hash() of the
+    #  files, e.g. Catalogue.digest() for jobs pointing at a catalogue.
+    # --------------------------------------------------------------------------
+    def add(self, address, firmware_path, datfile_path, digest=None):
+        if digest is None:
+            digest = package_hash(firmware_path, datfile_path)
+        address = address.upper()
+
+        self._execute("INSERT OR IGNORE INTO jobs (address, firmware_path, datfile_path, package_hash, state, created) "
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      (address, firmware_path, datfile_path, digest, JobStates.PENDING, time.time()))
+        row = self._execute("SELECT id FROM jobs WHERE address = ? AND package_hash = ?", (address, digest)).fetchone()
+        return row["id"]
+
+    def get(self, job_id):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(row) if row is not None else None
+
+    def jobs(self, state=None):
+        if state is None:
+            rows = self._execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        else:
+            rows = self._execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,)).fetchall()
+        return [Job(row) for row in rows]
+
+    # --------------------------------------------------------------------------
+    #  Jobs left in progress by a previous run were interrupted. Put them back
+    #  in the queue; the bootloader resumes from the recorded offset.
+    # --------------------------------------------------------------------------
+    def recover(self):
+        cursor = self._execute("UPDATE jobs SET state = ? WHERE state = ?", (JobStates.PENDING, JobStates.IN_PROGRESS))
+        if cursor.rowcount:
+            logging.info(f"Recovered {cursor.rowcount} interrupted DFU job(s)")
+        return cursor.rowcount
+
+    # --------------------------------------------------------------------------
+    #  Atomically take the oldest pending job, preferring the ids in `prefer`
+    #  and leaving out those in `exclude`. With `rank` (a key function of a
+    #  Job) the pending job ranked lowest is taken instead of the oldest.
+    #  Returns None if there is none.
+    # --------------------------------------------------------------------------
+    def claim(self, prefer=(), exclude=(), rank=None):
+        prefer = [job_id for job_id in prefer if job_id not in exclude]
+        exclude = list(exclude)
+        sql = "SELECT * FROM jobs WHERE state = ?"
+        if exclude:
+            sql += " AND id NOT IN ({})".format(", ".join("?" * len(exclude)))
+        if rank is None:
+            sql += " ORDER BY {}id LIMIT 1".format(
+                "id IN ({}) DESC, ".format(", ".join("?" * len(prefer))) if prefer else "")
+            params = [JobStates.PENDING] + exclude + prefer
+        else:
+            params = [JobStates.PENDING] + exclude
+
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if rank is None:
+                    row = self._db.execute(sql, params).fetchone()
+                else:
+                    rows = self._db.execute(sql, params).fetchall()
+                    row = min(rows, key=lambda row: (row["id"] not in prefer, rank(Job(row)), row["id"]),
+                              default=None)
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ?, error = NULL "
+                                     "WHERE id = ?", (JobStates.IN_PROGRESS, time.time(), row["id"]))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+        return self.get(row["id"])
+
+    # --------------------------------------------------------------------------
+    #  Atomically take the given job if it is pending. Returns it, or None
+    #  if it is not pending (any more).
+    # --------------------------------------------------------------------------
+    def take(self, job_id):
+        cursor = self._execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started = ?, error = NULL "
+                               "WHERE id = ? AND state = ?", (JobStates.IN_PROGRESS, time.time(), job_id,
+                                                              JobStates.PENDING))
+        if not cursor.rowcount:
+            return None
+        return self.get(job_id)
+
+    def update_offset(self, job_id, offset):
+        self._execute("UPDATE jobs SET offset = ? WHERE id = ?", (offset, job_id))
+
+    def complete(self, job_id, duration, state=JobStates.DONE):
+        self._execute("UPDATE jobs SET state = ?, finished = ?, duration = ? WHERE id = ?",
+                      (state, time.time(), duration, job_id))
+
+    # --------------------------------------------------------------------------
+    #  Record a failed attempt. The job is queued again until max_attempts,
+    #  unless the error is not worth retrying.
+    # --------------------------------------------------------------------------
+    def fail(self, job_id, error, max_attempts, retriable=True):
+        job = self.get(job_id)
+        state = JobStates.FAILED if job.attempts >= max_attempts or not retriable else JobStates.PENDING
+        self._execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                      (state, time.time(), str(error), job_id))
+        return state
+
+    # --------------------------------------------------------------------------
+    #  The session gave way (see PreemptedError) after making progress rather
+    #  than failed: queue the job again without counting the attempt
+    # --------------------------------------------------------------------------
+    def release(self, job_id, error):
+        self._execute("UPDATE jobs SET state = ?, attempts = MAX(0, attempts - 1), finished = ?, error = ? "
+                      "WHERE id = ?", (JobStates.PENDING, time.time(), str(error), job_id))
+        return JobStates.PENDING
+
+    # --------------------------------------------------------------------------
+    #  Campaign summary: jobs per state, attempts and throughput
+    # --------------------------------------------------------------------------
+    def summary(self):
+        states = {state: 0 for state in (JobStates.PENDING, JobStates.IN_PROGRESS, JobStates.DONE,
+                                         JobStates.SKIPPED, JobStates.FAILED)}
+        for row in self._execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall():
+            states[row["state"]] = row["n"]
+
+        row = self._execute("SELECT SUM(attempts) AS attempts, MIN(started) AS first, MAX(finished) AS last, "
+                            "AVG(duration) AS mean_duration FROM jobs").fetchone()
+        done = self._execute("SELECT COUNT(*) AS n, MAX(finished) AS last FROM jobs WHERE state IN (?, ?)",
+                             (JobStates.DONE, JobStates.SKIPPED)).fetchone()
+
+        elapsed = (done["last"] - row["first"]) if done["last"] is not None and row["first"] is not None else 0.0
+        return {
+            "states": states,
+            "attempts": row["attempts"] or 0,
+            "mean_duration": row["mean_duration"],
+            "elapsed": elapsed,
+            "devices_per_hour": done["n"] * 3600.0 / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class JobWorker(object):
+    """
+    Drain a JobStore with up to `concurrency` DFU sessions at a time.
+    transport_factory(address) may supply the transport for each session
+    (e.g. simulated); by default every session spawns gatttool.
+    controller_options are set as attributes on each session's controller,
+    e.g. {"pkt_receipt_interval": 12}. Job outcomes are counted in the
+    metrics registry (the default one unless given). Bootloader addresses
+    are learned in address_map, an in-memory AddressMap unless given.
+    retry (RetryPolicy) sets the attempts within each session; max_attempts
+    counts sessions per job. With stage_ahead, up to that many of the next
+    devices are rebooted into their bootloaders while transfers run (see
+    Stager). Packages are parsed once into `packages` (a PackageCache) and
+    shared by all sessions. With a router (VariantRouter) each device gets
+    the package of its variant and the jobs' package paths are not used.
+    With a scheduler (FleetScheduler) pending jobs are taken in its order
+    rather than oldest first, and if it has an AdaptiveConcurrency, that
+    limits the sessions run at once on the worker's `adapter` (up to its
+    maximum, which then replaces `concurrency`). A job is only taken once
+    there is a slot for its session. A session preempted by a link_guard after
+    committing objects queues its job again without counting the attempt.
+    """
+
+    def __init__(self, store, concurrency=1, max_attempts=3, transport_factory=None, controller_options=None,
+                 metrics_registry=None, address_map=None, retry=None, stage_ahead=0, bootloader_timeout=120.0,
+                 router=None, packages=None, scheduler=None, adapter=None):
+        self.store = store
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.transport_factory = transport_factory
+        self.controller_options = controller_options or {}
+        self.metrics = DfuMetrics(metrics_registry)
+        self.address_map = address_map if address_map is not None else AddressMap()
+        self.retry = retry
+        self.router = router
+        self.scheduler = scheduler
+        self.adapter = adapter or "default"
+        if scheduler is not None and scheduler.concurrency is not None:
+            self.concurrency = scheduler.concurrency.maximum
+        if packages is None:
+            packages = router.cache if router is not None else PackageCache()
+        self.packages = packages
+        self.results = []
+        self._results_lock = threading.Lock()
+        # Claiming and picking a job to stage must not interleave
+        self._claim_lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self.stager = Stager(self, stage_ahead, bootloader_timeout) if stage_ahead > 0 else None
+
+    def run(self):
+        """Process jobs until the queue is empty. Returns per-job result dicts."""
+        self.store.recover()
+
+        if self.stager is not None:
+            self.stager.start()
+        threads = [threading.Thread(target=self._work, name=f"dfu-worker-{i}") for i in range(self.concurrency)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if self.stager is not None:
+                self.stager.close()
+
+        return self.results
+
+    def _claim(self):
+        rank = None
+        if self.scheduler is not None:
+            # One thread scans. Before the first scan the others wait for its
+            # ranking, later they carry on with the last one meanwhile.
+            if self.scheduler.scan_due() and self._scan_lock.acquire(blocking=not self.scheduler.scanned):
+                try:
+                    if self.scheduler.scan_due():
+                        self._scan()
+                finally:
+                    self._scan_lock.release()
+            rank = self.scheduler.rank
+
+        if self.stager is None:
+            return self.store.claim(rank=rank)
+
+        while True:
+            with self._claim_lock:
+                job = self.store.claim(prefer=self.stager.staged_ids(), exclude=self.stager.staging_ids(), rank=rank)
+                busy = self.stager.busy()
+            if job is not None or not busy:
+                return job
+            # The remaining jobs are being staged right now
+            time.sleep(self.stager.poll_interval)
+
+    def _scan(self):
+        """Scan for the pending devices, for the scheduler's ranking"""
+        addresses = [job.address for job in self.store.jobs(JobStates.PENDING)]
+        if not addresses:
+            self.scheduler.scan(None, addresses)
+            return
+
+        if self.transport_factory is not None:
+            transport = self.transport_factory(addresses[0])
+        else:
+            # hcitool scans by itself, gatttool is not needed for it
+            from ota_dfu_python.transport import HcitoolScanner
+            transport = HcitoolScanner(None if self.adapter == "default" else self.adapter)
+        try:
+            self.scheduler.scan(transport, addresses)
+        finally:
+            transport.close()
+
+    def _work(self):
+        while True:
+            # Wait for a session slot first, so the job is ranked and claimed
+            # when it can run rather than held in progress meanwhile
+            if self.scheduler is not None:
+                self.scheduler.acquire(self.adapter)
+            job = self._claim()
+            if job is None:
+                if self.scheduler is not None:
+                    self.scheduler.cancel(self.adapter)
+                return
+            result = self.run_job(job, acquired=True)
+            with self._results_lock:
+                self.results.append(result)
+
+    def run_job(self, job, acquired=False):
+        """Run a claimed job. With a scheduler, takes a session slot unless `acquired` already."""
+        logging.info(f"DFU job {job.id}: {job.address} attempt {job.attempts}")
+        result = {"job": job.id, "address": job.address, "attempt": job.attempts}
+        if self.stager is not None:
+            result["staged"] = self.stager.take(job.id)
+
+        if self.scheduler is not None and not acquired:
+            self.scheduler.acquire(self.adapter)
+
+        dfu = None
+        try:
+            dfu = self.session(job, self.retry)
+            dfu.subscribe(lambda event: self.store.update_offset(job.id, event.offset + event.size),
+                          event_types=[ObjectCommittedEvent])
+            dfu.perform_dfu()
+
+            stats = dfu.ble_dfu.stats
+            if stats.skipped is None and stats.bytes_committed < stats.image_size:
+                raise Exception("Transfer incomplete: {} of {} bytes".format(stats.bytes_committed, stats.image_size))
+
+            state = JobStates.DONE if stats.skipped is None else JobStates.SKIPPED
+            self.store.complete(job.id, stats.duration, state)
+            if self.stager is not None and state == JobStates.DONE:
+                self.stager.durations.append(stats.duration)
+            result.update(state=state, stats=stats.as_dict())
+        except PreemptedError as e:
+            logging.warning(f"DFU job {job.id} ({job.address}) preempted: {e}")
+            # Only sessions that got objects through gave way for free, the job is not retried forever
+            if dfu.ble_dfu.stats.objects_committed:
+                state = self.store.release(job.id, e)
+            else:
+                state = self.store.fail(job.id, e, self.max_attempts)
+            result.update(state=state, error=str(e), preempted=True)
+            if dfu is not None:
+                result["stats"] = dfu.ble_dfu.stats.as_dict()
+        except Exception as e:
+            logging.error(f"DFU job {job.id} ({job.address}) failed: {e}")
+            # A rejected package, e.g. by the pre-flight check, fails the same way every time
+            state = self.store.fail(job.id, e, self.max_attempts, retriable=is_retriable(e))
+            result.update(state=state, error=str(e))
+            if dfu is not None:
+                result["stats"] = dfu.ble_dfu.stats.as_dict()
+        finally:
+            self.metrics.jobs.labels(result.get("state", JobStates.FAILED)).inc()
+            if self.scheduler is not None:
+                if dfu is not None:
+                    self.scheduler.session_finished(job.address, self.adapter, dfu.ble_dfu.stats,
+                                                    result.get("state") in (JobStates.DONE, JobStates.SKIPPED))
+                else:
+                    self.scheduler.history.record(job.address, False)
+                    self.scheduler.cancel(self.adapter)
+            if dfu is not None:
+                dfu.close()
+
+        return result
+
+    def session(self, job, retry=None):
+        """A SecureDfu for the job"""
+        transport = self.transport_factory(job.address) if self.transport_factory else None
+        if self.router is not None:
+            return SecureDfu(job.address, None, None, transport, self.address_map, retry, self.router,
+                             **self.controller_options)
+
+        try:
+            package = self.packages.get(job.firmware_path, job.datfile_path)
+        except Exception:
+            if transport is not None:
+                transport.close()
+            raise
+        return SecureDfu(job.address, job.firmware_path, job.datfile_path, transport, self.address_map, retry,
+                         package=package, **self.controller_options)
+
+
+class Stager(object):
+    """
+    Pipelined staging for a JobWorker. While transfers run, the next pending
+    devices are connected to and rebooted into their bootloaders (buttonless),
+    so their sessions find the bootloader advertising and skip the connect,
+    mode check, switch and reboot wait. At most `ahead` devices are staged at
+    a time.
+
+    A bootloader returns to the application after `bootloader_timeout`
+    seconds without a connection. Devices are therefore only staged if their
+    transfer is expected to start (from the mean transfer duration so far)
+    within `refresh_after` of that timeout, and a staged device still waiting
+    by then is connected to again, which restarts the timeout.
+    """
+
+    poll_interval = 0.2
+
+    def __init__(self, worker, ahead, bootloader_timeout=120.0, refresh_after=0.75, clock=time.monotonic):
+        self.worker = worker
+        self.ahead = ahead
+        self.bootloader_timeout = bootloader_timeout
+        self.refresh_after = refresh_after
+        self.clock = clock
+
+        self.durations = []
+        self._staged = {}       # job id -> (job, time staged)
+        self._staging = set()   # job ids being staged or refreshed
+        self._passed = set()    # job ids not to stage (again)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="dfu-stager", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def staged_ids(self):
+        with self._lock:
+            return list(self._staged)
+
+    def staging_ids(self):
+        with self._lock:
+            return list(self._staging)
+
+    def busy(self):
+        with self._lock:
+            return bool(self._staging)
+
+    def take(self, job_id):
+        """The job's session starts. Returns the seconds it was staged, None if it was not."""
+        with self._lock:
+            self._passed.add(job_id)
+            entry = self._staged.pop(job_id, None)
+        if entry is None:
+            return None
+        return self.clock() - entry[1]
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not (self._refresh_one() or self._stage_one()):
+                self._stop.wait(self.poll_interval)
+
+    def _expected_wait(self, position):
+        """Seconds until the transfer of the device staged at `position` starts"""
+        if not self.durations:
+            return 0.0
+        mean = sum(self.durations) / len(self.durations)
+        return (position // self.worker.concurrency + 1) * mean
+
+    def _stage_one(self):
+        with self.worker._claim_lock, self._lock:
+            position = len(self._staged) + len(self._staging)
+            if position >= self.ahead:
+                return False
+            if self._expected_wait(position) > self.refresh_after * self.bootloader_timeout:
+                return False
+
+            skip = set(self._staged) | self._staging | self._passed
+            jobs = self.worker.store.jobs(JobStates.PENDING)
+            if self.worker.scheduler is not None:
+                # Stage in the order the jobs will be claimed
+                jobs.sort(key=lambda job: (self.worker.scheduler.rank(job), job.id))
+            job = next((job for job in jobs if job.id not in skip), None)
+            if job is None:
+                return False
+            self._staging.add(job.id)
+
+        self._stage(job, "staged")
+        return True
+
+    def _refresh_one(self):
+        now = self.clock()
+        with self.worker._claim_lock, self._lock:
+            due = [job for job, staged in self._staged.values()
+                   if now - staged > self.refresh_after * self.bootloader_timeout]
+            if not due:
+                return False
+            job = due[0]
+            del self._staged[job.id]
+            self._staging.add(job.id)
+
+        self._stage(job, "refreshed")
+        return True
+
+    def _stage(self, job, outcome):
+        worker = self.worker
+        logging.info(f"Staging {job.address} (job {job.id}) in its bootloader")
+        dfu = None
+        try:
+            dfu = worker.session(job, RetryPolicy(attempts=1))
+            if not dfu.stage():
+                outcome = "current"
+        except Exception as e:
+            logging.warning(f"Staging {job.address} failed: {e}")
+            outcome = "failed"
+        finally:
+            if dfu is not None:
+                dfu.close()
+
+        worker.metrics.staged.labels(outcome).inc()
+        with self._lock:
+            self._staging.discard(job.id)
+            if outcome in ("staged", "refreshed"):
+                self._staged[job.id] = (job, self.clock())
+            else:
+                # Up to date or unreachable: its own session will find out
+                self._passed.add(job.id)
@@ -0,0 +1,369 @@
+"""
+------------------------------------------------------------------------------
+ Campaign metrics.
+
+ A small metrics registry (counters, gauges, histograms) in the Prometheus
+ data model. Controllers feed it through a MetricsCollector subscribed to
+ their events, plus one pre-bound counter increment per packet in the send
+ loop; the job worker adds job outcomes. The registry can be served in the
+ Prometheus text format over HTTP (MetricsServer) and written to a JSON
+ snapshot file periodically (SnapshotWriter).
+
+ Counter and histogram updates are not locked: an increment is a plain
+ attribute update, cheap enough for the send loop. Concurrent sessions may
+ in rare cases lose an update, which is acceptable for monitoring. Gauges
+ go up and down, so a lost update would stay wrong for good (e.g. sessions
+ active that never return to 0); they are locked, and updated rarely.
+------------------------------------------------------------------------------
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+
+from ota_dfu_python.events import PhaseEvent, ObjectCommittedEvent, RetransmitEvent, ErrorEvent, RetryEvent, Phases
+
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(object):
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated within its bucket"""
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class MetricFamily(object):
+    """A named metric with its children, one per combination of label values"""
+
+    def __init__(self, name, documentation, kind, labelnames, factory):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+
+    def labels(self, *values):
+        """The child for the given label values. Bind it once outside loops."""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise Exception("{} expects labels {}".format(self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(key, self._factory())
+        return child
+
+    def children(self):
+        return sorted(self._children.items())
+
+    # Unlabelled families behave like their only child
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name, documentation, kind, labelnames, factory):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = MetricFamily(name, documentation, kind, labelnames, factory)
+            elif family.kind != kind or family.labelnames != tuple(labelnames):
+                raise Exception("Metric {} already registered differently".format(name))
+            return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(name, documentation, "counter", labelnames, Counter)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(name, documentation, "gauge", labelnames, Gauge)
+
+    def histogram(self, name, documentation, buckets, labelnames=()):
+        buckets = sorted(buckets)
+        return self._register(name, documentation, "histogram", labelnames, lambda: Histogram(buckets))
+
+    def families(self):
+        with self._lock:
+            return sorted(self._families.values(), key=lambda family: family.name)
+
+    # --------------------------------------------------------------------------
+    #  Prometheus text exposition format (version 0.0.4)
+    # --------------------------------------------------------------------------
+    def render(self):
+        lines = []
+        for family in self.families():
+            lines.append("# HELP %s %s" % (family.name, family.documentation))
+            lines.append("# TYPE %s %s" % (family.name, family.kind))
+            for values, child in family.children():
+                labels = list(zip(family.labelnames, values))
+                if family.kind != "histogram":
+                    lines.append("%s%s %s" % (family.name, _format_labels(labels), _format_value(child.value)))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(child.buckets + [float("inf")], child.counts):
+                    cumulative += count
+                    le = labels + [("le", "+Inf" if bound == float("inf") else _format_value(bound))]
+                    lines.append("%s_bucket%s %d" % (family.name, _format_labels(le), cumulative))
+                lines.append("%s_sum%s %s" % (family.name, _format_labels(labels), _format_value(child.sum)))
+                lines.append("%s_count%s %d" % (family.name, _format_labels(labels), child.count))
+        return "\n".join(lines) + "\n"
+
+    # --------------------------------------------------------------------------
+    #  Plain dict of all values; histograms as count, sum and percentiles
+    # --------------------------------------------------------------------------
+    def snapshot(self):
+        snapshot = {}
+        for family in self.families():
+            entries = []
+            for values, child in family.children():
+                entry = {"labels": dict(zip(family.labelnames, values))}
+                if family.kind == "histogram":
+                    entry.update(count=child.count, sum=child.sum,
+                                 p50=child.quantile(0.5), p90=child.quantile(0.9), p99=child.quantile(0.99))
+                else:
+                    entry["value"] = child.value
+                entries.append(entry)
+            snapshot[family.name] = entries
+        return snapshot
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# Registry used by controllers and workers unless told otherwise
+REGISTRY = Registry()
+
+
+class DfuMetrics(object):
+    """The DFU metric families in a registry"""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, registry=None):
+        registry = registry if registry is not None else REGISTRY
+        self.registry = registry
+
+        self.sessions_active = registry.gauge("ota_dfu_sessions_active", "DFU sessions in progress")
+        self.sessions = registry.counter("ota_dfu_sessions_total", "Finished DFU sessions", ["adapter", "outcome"])
+        self.bytes_sent = registry.counter("ota_dfu_bytes_sent_total",
+                                           "Image bytes written, including retransmissions", ["adapter"])
+        self.bytes_committed = registry.counter("ota_dfu_bytes_committed_total",
+                                                "Image bytes executed by the peripherals", ["adapter"])
+        self.objects_committed = registry.counter("ota_dfu_objects_committed_total", "Data objects executed",
+                                                  ["adapter"])
+        self.retransmits = registry.counter("ota_dfu_retransmits_total", "Data objects sent again", ["reason"])
+        self.failures = registry.counter("ota_dfu_failures_total", "Failed DFU sessions by reason", ["reason"])
+        self.retries = registry.counter("ota_dfu_retries_total", "Failed attempts retried within a session",
+                                        ["kind"])
+        self.notification_latency = registry.histogram("ota_dfu_notification_latency_seconds",
+                                                       "Time waited for control point notifications",
+                                                       self.LATENCY_BUCKETS)
+        self.jobs = registry.counter("ota_dfu_jobs_total", "DFU job attempts by resulting state", ["state"])
+        self.staged = registry.counter("ota_dfu_staged_total",
+                                       "Devices rebooted into the bootloader ahead of their transfer", ["outcome"])
+
+
+def failure_reason(error):
+    """Label for a session failure: the DFU result code if the peripheral gave one"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.error_string()
+    return type(error).__name__
+
+
+class MetricsCollector(object):
+    """Event subscriber feeding a session's events into DfuMetrics"""
+
+    EVENT_TYPES = (PhaseEvent, ObjectCommittedEvent, RetransmitEvent, ErrorEvent, RetryEvent)
+
+    def __init__(self, metrics, adapter):
+        self.metrics = metrics
+        self.adapter = adapter
+        self.active = False
+
+        # Bound once, so the send loop only increments
+        self.bytes_sent = metrics.bytes_sent.labels(adapter)
+        self._bytes_committed = metrics.bytes_committed.labels(adapter)
+        self._objects_committed = metrics.objects_committed.labels(adapter)
+
+    def __call__(self, event):
+        if isinstance(event, PhaseEvent):
+            if event.phase == Phases.CONNECT and not self.active:
+                self.active = True
+                self.metrics.sessions_active.inc()
+            elif event.phase in (Phases.COMPLETE, Phases.FAILED) and self.active:
+                self.active = False
+                self.metrics.sessions_active.dec()
+                self.metrics.sessions.labels(self.adapter, event.phase).inc()
+        elif isinstance(event, ObjectCommittedEvent):
+            self._objects_committed.inc()
+            self._bytes_committed.inc(event.size)
+        elif isinstance(event, RetransmitEvent):
+            self.metrics.retransmits.labels(event.reason).inc()
+        elif isinstance(event, ErrorEvent):
+            self.metrics.failures.labels(failure_reason(event.error)).inc()
+        elif isinstance(event, RetryEvent):
+            self.metrics.retries.labels(event.kind).inc()
+
+
+# ------------------------------------------------------------------------------
+#  Exporters
+# ------------------------------------------------------------------------------
+class MetricsServer(object):
+    """Serves the registry in the Prometheus text format on http://host:port/metrics"""
+
+    def __init__(self, registry=None, port=9464, host="127.0.0.1"):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+
+        registry = registry if registry is not None else REGISTRY
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('UTF-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format % args)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logging.info(f"Serving metrics on port {self.port}")
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SnapshotWriter(object):
+    """Writes registry snapshots as JSON to path every `interval` seconds"""
+
+    def __init__(self, path, registry=None, interval=10.0):
+        self.path = path
+        self.registry = registry if registry is not None else REGISTRY
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        import json
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"time": time.time(), "metrics": self.registry.snapshot()}, f, indent=2)
+        # Readers never see a partially written file
+        os.replace(tmp, self.path)
+
+    def close(self):
+        """Stop and write a final snapshot"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.write()
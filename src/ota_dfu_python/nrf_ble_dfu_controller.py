@@ -1,12 +1,15 @@
 import os
-import pexpect
-import re
 import logging
-import time
 
 from abc   import ABCMeta, abstractmethod
-from array import array
-from ota_dfu_python.util  import *
+from ota_dfu_python.util  import mac_string_to_uint, uint_to_mac_string
+from ota_dfu_python.events import EventDispatcher
+from ota_dfu_python.stats import SessionStats
+from ota_dfu_python.metrics import DfuMetrics, MetricsCollector
+from ota_dfu_python.addresses import DEFAULT_OFFSETS, offset_address
+from ota_dfu_python.retry import LinkLostError
+from ota_dfu_python.packages import load_image
+from ota_dfu_python.transport import GatttoolTransport, CreditWindow, RttEstimator, FAST_CONNECTION_CANDIDATES, CONSERVATIVE_CONNECTION
 
 verbose = False
 
@@ -18,6 +21,42 @@ class NrfBleDfuController(object, metaclass=ABCMeta):
     pkt_receipt_interval = 10
     pkt_payload_size     = 20
 
+    # Maximum write commands in flight on the data path. None disables flow
+    # control.
+    write_window         = 10
+
+    # Connection parameters requested for the image transfer (first accepted
+    # candidate wins) and restored afterwards. None disables tuning.
+    fast_connection_candidates = FAST_CONNECTION_CANDIDATES
+    idle_connection            = CONSERVATIVE_CONNECTION
+
+    # Adaptive timeouts per kind of wait: (initial, floor, ceiling) in seconds.
+    # "write" covers write acknowledgements, "notify" control point responses.
+    timeout_limits = {
+        "connect"  : (2.0, 1.0, 10.0),
+        "discover" : (2.0, 1.0, 10.0),
+        "write"    : (3.0, 0.5, 10.0),
+        "notify"   : (2.0, 0.5, 6.0),
+    }
+
+    # Fixed timeouts replacing the adaptive ones in a phase,
+    # e.g. {(Phases.INIT, "notify"): 5.0}
+    timeout_overrides = {}
+
+    # Registry the session metrics go to, None for the default registry
+    metrics_registry = None
+
+    # Offsets of the bootloader address from the application address, most
+    # likely first, and how long to listen for advertisements to find out
+    # which one the device uses
+    bootloader_offsets   = DEFAULT_OFFSETS
+    scan_timeout         = 1.0
+
+    # Seconds a reboot into the bootloader takes at least and at most. With a
+    # transport that can scan, the wait ends when the bootloader advertises.
+    reboot_min_delay     = 0.5
+    reboot_delay         = 2.0
+
     # --------------------------------------------------------------------------
     #  Start the firmware update process
     # --------------------------------------------------------------------------
@@ -54,7 +93,7 @@ class NrfBleDfuController(object, metaclass=ABCMeta):
     def _wait_and_parse_notify(self):
         pass
 
-    def __init__(self, target_mac, firmware_path, datfile_path):
+    def __init__(self, target_mac, firmware_path, datfile_path, transport=None):
         self.target_mac = target_mac
 
         self.firmware_path = firmware_path
@@ -62,29 +101,37 @@ class NrfBleDfuController(object, metaclass=ABCMeta):
 
         logging.debug(f"Firmware path: {firmware_path}")
 
-        self.ble_conn = pexpect.spawn("gatttool -b '%s' -t random --interactive" % target_mac)
-        self.ble_conn.delaybeforesend = 0
+        if transport is None:
+            transport = GatttoolTransport(target_mac)
+        self.transport = transport
 
-    # --------------------------------------------------------------------------
-    #  Start the firmware update process
-    # --------------------------------------------------------------------------
-    def start(self):
-        (_, self.ctrlpt_handle, self.ctrlpt_cccd_handle) = self._get_handles(self.UUID_CONTROL_POINT)
-        (_, self.data_handle, _) = self._get_handles(self.UUID_PACKET)
+        self.events = EventDispatcher(self.transport.clock)
+        self.stats = SessionStats()
+        self.events.subscribe(self.stats, SessionStats.EVENT_TYPES)
 
-        logging.debug('Control Point Handle: 0x%04x, CCCD: 0x%04x' % (self.ctrlpt_handle, self.ctrlpt_cccd_handle))
-        logging.debug('Packet handle: 0x%04x' % (self.data_handle))
+        self.metrics = DfuMetrics(self.metrics_registry)
+        collector = MetricsCollector(self.metrics, getattr(self.transport, "adapter", None) or "default")
+        self.metrics_subscription = self.events.subscribe(collector, MetricsCollector.EVENT_TYPES)
+        self._bytes_sent = collector.bytes_sent
 
-        # Subscribe to notifications from Control Point characteristic
-        self._enable_notifications(self.ctrlpt_cccd_handle)
+        self.credits = CreditWindow(self.write_window)
 
-        # Set the Packet Receipt Notification interval
-        prn = uint16_to_bytes_le(self.pkt_receipt_interval)
-        self._dfu_send_command(Procedures.SET_PRN, prn)
+        # Discovered handles by (address, UUID), kept across reconnects
+        self._handles = {}
 
-        self._dfu_send_init()
+        # Estimators are created on first use, after options are applied
+        self.timeouts = {}
+        self.stats.timeouts = self.timeouts
 
-        self._dfu_send_image()
+    # --------------------------------------------------------------------------
+    #  Register callback(event) for session events (see ota_dfu_python.events).
+    #  Progress updates are coalesced to at most one per min_interval seconds.
+    # --------------------------------------------------------------------------
+    def subscribe(self, callback, event_types=None, min_interval=0.0):
+        return self.events.subscribe(callback, event_types, min_interval)
+
+    def unsubscribe(self, handle):
+        self.events.unsubscribe(handle)
 
     # --------------------------------------------------------------------------
     # Initialize: 
@@ -94,65 +141,192 @@ class NrfBleDfuController(object, metaclass=ABCMeta):
     def input_setup(self):
         logging.debug("Sending file " + os.path.split(self.firmware_path)[1] + " to " + self.target_mac)
 
-        if self.firmware_path == None:
-            raise Exception("input invalid")
+        self.bin_array = load_image(self.firmware_path)
+        self.image_size = len(self.bin_array)
+        self.stats.image_size = self.image_size
 
-        name, extent = os.path.splitext(self.firmware_path)
+    # --------------------------------------------------------------------------
+    # Perform a scan and connect via the transport.
+    # Will return True if a connection was established, False otherwise
+    # --------------------------------------------------------------------------
+    def scan_and_connect(self, timeout=None):
+        """Try to connect to device"""
+        logging.info("Connecting to %s" % (self.target_mac))
 
-        if extent == ".bin":
-            self.bin_array = array('B', open(self.firmware_path, 'rb').read())
+        if timeout is not None:
+            return self.transport.connect(timeout=timeout)
 
-            self.image_size = len(self.bin_array)
+        start = self.transport.clock()
+        timeout = self._timeout("connect")
+        connected = self.transport.connect(timeout=timeout)
+        self._sample("connect", start, timeout, connected)
+        return connected
 
-            return
+    # --------------------------------------------------------------------------
+    #  Disconnect from the peripheral and close the transport
+    # --------------------------------------------------------------------------
+    def disconnect(self):
+        self.transport.disconnect()
 
-        if extent == ".hex":
-            intelhex = IntelHex(self.firmware_path)
-            self.bin_array = intelhex.tobinarray()
-            self.image_size = len(self.bin_array)
-            logging.debug("Bin array size: ", self.image_size)
+    # --------------------------------------------------------------------------
+    #  Close the transport for good (e.g. stop gatttool). Errors are logged,
+    #  so that close() can run on any exit path, as in a with statement.
+    # --------------------------------------------------------------------------
+    def close(self):
+        try:
+            self.transport.close()
+        except Exception as e:
+            logging.debug(f"Closing the transport to {self.target_mac} failed: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def target_mac_increase(self, inc):
+        self.retarget(uint_to_mac_string(mac_string_to_uint(self.target_mac) + inc))
+
+    def retarget(self, target_mac):
+        self.target_mac = target_mac
+
+        # Point the transport at the new address
+        self.transport.set_target(self.target_mac)
+
+    # --------------------------------------------------------------------------
+    #  Which of the addresses are advertising. Returns {address: rssi} or
+    #  None if the transport cannot scan.
+    # --------------------------------------------------------------------------
+    def scan(self, addresses):
+        seen = self.transport.scan(addresses, timeout=self.scan_timeout)
+        if seen is not None:
+            logging.debug(f"Advertising: {', '.join(seen) or 'none'} of {', '.join(addresses)}")
+        return seen
+
+    # --------------------------------------------------------------------------
+    #  Connect to the bootloader of the device with application address
+    #  app_mac. Addresses heard advertising are tried first, then the
+    #  others in the order of `offsets`. `seen` is a scan result to use
+    #  instead of scanning again. Returns the offset of the address connected
+    #  to, or None.
+    # --------------------------------------------------------------------------
+    def connect_bootloader(self, app_mac, offsets=None, seen=None):
+        candidates = [(offset, offset_address(app_mac, offset))
+                      for offset in (self.bootloader_offsets if offsets is None else offsets)]
+
+        if seen is None:
+            seen = self.scan([address for _, address in candidates])
+        if seen:
+            candidates.sort(key=lambda candidate: candidate[1] not in seen)
+
+        for offset, address in candidates:
+            self.retarget(address)
+            if self.scan_and_connect():
+                return offset
+
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Timeout for the next wait of the given kind: a per-phase override if
+    #  there is one, otherwise derived from the round trip times so far.
+    # --------------------------------------------------------------------------
+    def _timeout(self, kind):
+        override = self.timeout_overrides.get((self.stats.current_phase, kind))
+        if override is not None:
+            return override
+
+        return self._estimator(kind).timeout()
+
+    def _estimator(self, kind):
+        estimator = self.timeouts.get(kind)
+        if estimator is None:
+            estimator = self.timeouts[kind] = RttEstimator(*self.timeout_limits[kind])
+        return estimator
+
+    # --------------------------------------------------------------------------
+    #  Feed the outcome of a wait that started at `start` back into its
+    #  estimator. Failures that return early (e.g. link loss) say nothing
+    #  about the round trip time and are not counted.
+    # --------------------------------------------------------------------------
+    def _sample(self, kind, start, timeout, success):
+        elapsed = self.transport.clock() - start
+        if success:
+            self._estimator(kind).sample(elapsed)
+        elif elapsed >= timeout:
+            self._estimator(kind).expired()
+
+    # --------------------------------------------------------------------------
+    #  Write request to the peripheral, timed against the write estimator
+    # --------------------------------------------------------------------------
+    def _write_request(self, handle, data):
+        start = self.transport.clock()
+        timeout = self._timeout("write")
+        res = self.transport.write_request(handle, data, timeout=timeout)
+        self._sample("write", start, timeout, res)
+        return res
+
+    # --------------------------------------------------------------------------
+    #  Set up credit based flow control for the data path. Without send
+    #  complete reports from the transport, credits only come back with PRN
+    #  notifications, so the PRN interval must fit into the window.
+    # --------------------------------------------------------------------------
+    def _setup_flow_control(self):
+        self.credits = CreditWindow(self.write_window)
+
+        if self.write_window is None or self.transport.supports_send_complete:
             return
 
-        raise Exception("Input invalid")
+        if self.pkt_receipt_interval == 0 or self.pkt_receipt_interval > self.write_window:
+            logging.debug(f"Lowering PRN interval to the write window of {self.write_window}")
+            self.pkt_receipt_interval = self.write_window
 
     # --------------------------------------------------------------------------
-    # Perform a scan and connect via gatttool.
-    # Will return True if a connection was established, False otherwise
+    #  Block until the transport reports written packets sent
     # --------------------------------------------------------------------------
-    def scan_and_connect(self, timeout=2):
-        """Try to connect to device"""
-        logging.info("Connecting to %s" % (self.target_mac))
+    def _wait_for_credits(self):
+        self.credits.stalls += 1
 
-        try:
-            self.ble_conn.expect('\[LE\]>', timeout=timeout)
-        except pexpect.TIMEOUT as e:
-            logging.warning(f"Timeout during scan: {e}")
-            return False
+        completed = self.transport.wait_for_send_complete(timeout=self._timeout("notify"))
+        if completed == 0:
+            # Nothing reported; carry on and let the PRN CRC check catch losses
+            logging.debug("No send complete report, releasing all credits")
+            self.credits.release()
+        else:
+            self.credits.release(completed)
 
-        self.ble_conn.sendline('connect')
+    # --------------------------------------------------------------------------
+    #  Request a short connection interval (and LE 2M PHY) for the image
+    #  transfer. Candidates are tried in order until one is accepted; the
+    #  outcome is recorded in the session stats.
+    # --------------------------------------------------------------------------
+    def _tune_connection(self):
+        if not self.fast_connection_candidates:
+            return None
 
-        try:
-            res = self.ble_conn.expect('.*Connection successful.*', timeout=timeout)
-        except pexpect.TIMEOUT as e:
-            logging.warning(f"Timeout during connect: {e}")
-            return False
+        for fallbacks, params in enumerate(self.fast_connection_candidates):
+            achieved = self.transport.request_connection_parameters(params)
+            if achieved is not None:
+                logging.info(f"Connection parameters for transfer: {achieved}")
+                self.stats.record_connection(params, achieved, fallbacks)
+                return achieved
 
-        return True
+        logging.info("Connection parameter update rejected, keeping current parameters")
+        self.stats.record_connection(self.fast_connection_candidates[0], None, len(self.fast_connection_candidates))
+        return None
 
     # --------------------------------------------------------------------------
-    #  Disconnect from the peripheral and close the gatttool connection
+    #  Go back to conservative connection parameters. The peripheral usually
+    #  resets after the last object, in which case there is nothing to restore.
     # --------------------------------------------------------------------------
-    def disconnect(self):
-        self.ble_conn.sendline('exit')
-        self.ble_conn.close()
+    def _restore_connection(self):
+        if self.idle_connection is None or self.stats.connection_achieved is None:
+            return
 
-    def target_mac_increase(self, inc):
-        self.target_mac = uint_to_mac_string(mac_string_to_uint(self.target_mac) + inc)
+        if not self.transport.is_alive():
+            return
 
-        # Re-start gatttool with the new address
-        self.disconnect()
-        self.ble_conn = pexpect.spawn("gatttool -b '%s' -t random --interactive" % self.target_mac)
-        self.ble_conn.delaybeforesend = 0
+        if self.transport.request_connection_parameters(self.idle_connection) is None:
+            logging.debug("Could not restore conservative connection parameters")
 
     # --------------------------------------------------------------------------
     #  Fetch handles for a given UUID.
@@ -160,104 +334,71 @@ class NrfBleDfuController(object, metaclass=ABCMeta):
     #  Will raise an exception if the UUID is not found
     # --------------------------------------------------------------------------
     def _get_handles(self, uuid):
-        self.ble_conn.before = ""
-        self.ble_conn.sendline('characteristics')
-
-        try:
-            self.ble_conn.expect([uuid], timeout=10)
-            handles = re.findall(b'.*handle: (0x....),.*char value handle: (0x....)', self.ble_conn.before)
-            (handle, value_handle) = handles[-1]
-        except pexpect.TIMEOUT as e:
+        handles = self._handles.get((self.target_mac, uuid))
+        if handles is not None:
+            return handles
+
+        start = self.transport.clock()
+        timeout = self._timeout("discover")
+        handles = self.transport.find_characteristic(uuid, timeout=timeout)
+        self._sample("discover", start, timeout, handles is not None)
+        if handles is None:
+            if not self.transport.is_alive():
+                raise LinkLostError("Connection lost")
             raise Exception("UUID not found: {}".format(uuid))
 
-        return (int(handle, 16), int(value_handle, 16), int(value_handle, 16)+1)
+        self._handles[(self.target_mac, uuid)] = handles
+        return handles
 
     # --------------------------------------------------------------------------
     #  Wait for notification to arrive.
-    #  Example format: "Notification handle = 0x0019 value: 10 01 01"
+    #  Returns the notification value as bytes, e.g. b'\x60\x01\x01',
+    #  or None on timeout / link loss
     # --------------------------------------------------------------------------
     def _dfu_wait_for_notify(self):
-        while True:
-            if not self.ble_conn.isalive():
-                logging.warning("Connection not alive")
-                return None
-
-            try:
-                index = self.ble_conn.expect('Notification handle = .*? \r\n', timeout=2)
-
-            except pexpect.TIMEOUT as e:
-                #
-                # The gatttool does not report link-lost directly.
-                # The only way found to detect it is monitoring the prompt '[CON]'
-                # and if it goes to '[   ]' this indicates the connection has
-                # been broken.
-                # In order to get a updated prompt string, issue an empty
-                # sendline('').  If it contains the '[   ]' string, then
-                # raise an exception. Otherwise, if not a link-lost condition,
-                # continue to wait.
-                #
-                self.ble_conn.sendline('')
-                string = self.ble_conn.before
-                try:
-                    if '[   ]' in string:
-                        logging.warning('Connection lost!')
-                        raise Exception('Connection Lost')
-                except Exception as e:
-                    logging.error(f"An exception occured when trying to read string: {e}")
-                return None
-
-            if index == 0:
-                after = self.ble_conn.after
-                hxstr = after.split()[3:]
-                handle = int(float.fromhex(hxstr[0].decode('UTF-8')))
-                return hxstr[2:]
-
-            else:
-                logging.warning(f"Unexpeced index: {index}")
-                return None
+        start = self.transport.clock()
+        timeout = self._timeout("notify")
+        value = self.transport.wait_for_notification(timeout=timeout)
+        self._sample("notify", start, timeout, value is not None)
+        if value is None:
+            return None
+
+        self.metrics.notification_latency.observe(self.transport.clock() - start)
+
+        # The peripheral has processed everything sent before it answered.
+        # Transports reporting send complete return credits themselves.
+        if not self.transport.supports_send_complete:
+            self.credits.release()
+
+        return value
 
     # --------------------------------------------------------------------------
     #  Send a procedure + any parameters required
     # --------------------------------------------------------------------------
     def _dfu_send_command(self, procedure, params=[]):
+        self._dfu_send_request(bytes([procedure]) + bytes(params))
 
-        cmd  = 'char-write-req 0x%04x %02x' % (self.ctrlpt_handle, procedure)
-        cmd += array_to_hex_string(params)
-
-        logging.debug(f"Sending command {cmd}")
-
-        self.ble_conn.sendline(cmd)
-
-        # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=10)
-        except pexpect.TIMEOUT as e:
-            logging.error(f"State timeout when writing characteristic: {e}")
+    # --------------------------------------------------------------------------
+    #  Send an encoded control point request (see ota_dfu_python.codec)
+    # --------------------------------------------------------------------------
+    def _dfu_send_request(self, request):
+        self._write_request(self.ctrlpt_handle, request)
 
     # --------------------------------------------------------------------------
     #  Send an array of bytes
     # --------------------------------------------------------------------------
     def _dfu_send_data(self, data):
-        cmd  = 'char-write-cmd 0x%04x' % (self.data_handle)
-        cmd += ' '
-        cmd += array_to_hex_string(data)
+        if self.credits.full():
+            self._wait_for_credits()
 
-        logging.debug(f"Sending data command {cmd}")
-
-        self.ble_conn.sendline(cmd)
+        self.transport.write_command(self.data_handle, data)
+        self.credits.consume()
 
     # --------------------------------------------------------------------------
     #  Enable notifications from the Control Point Handle
     # --------------------------------------------------------------------------
     def _enable_notifications(self, cccd_handle):
-        cmd  = 'char-write-req 0x%04x %s' % (cccd_handle, '0100')
-
-        logging.debug(f"Enable notifications: {cmd}")
+        logging.debug(f"Enable notifications on handle 0x{cccd_handle:04x}")
 
-        self.ble_conn.sendline(cmd)
-
-        # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('Characteristic value was written successfully.*', timeout=10)
-        except pexpect.TIMEOUT as e:
-            logging.error(f"State timeout in enable notifications: {e}")
+        if not self._write_request(cccd_handle, [0x01, 0x00]):
+            logging.error("State timeout in enable notifications")
@@ -0,0 +1,356 @@
+"""
+------------------------------------------------------------------------------
+ Firmware packages and variant routing.
+
+ FirmwarePackage holds a parsed package: the image, the init packet and its
+ CRC, CRCs of image prefixes (extended incrementally as receipts arrive)
+ and the image split into payloads. It is read-only once built, so all
+ sessions sending the same package share one. PackageCache keeps them in a
+ least recently used cache bounded by memory.
+
+ A fleet with several hardware variants lists its packages in a Catalogue
+ (JSON), each with the device attributes it is for. VariantRouter picks a
+ device's package from what it reports in application mode (GAP device
+ name, DIS model number and hardware revision), or from what it reported
+ in an earlier session when it is found in its bootloader:
+
+   {"variants": [
+      {"name": "v2", "zip": "app_v2.zip", "match": {"model": "SNS-2*"}, "firmware_revision": "2.1.0"},
+      {"name": "v1", "firmware": "app_v1.bin", "init_packet": "app_v1.dat", "match": {"hw_version": 51}}
+   ]}
+
+ String attributes match as shell patterns. A variant without "match"
+ fits any device; the first variant that fits is used.
+------------------------------------------------------------------------------
+"""
+import binascii
+import bisect
+import collections
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+from array import array
+
+from ota_dfu_python.initpacket import InitPacketError, _file_key
+
+
+class NoVariantError(InitPacketError):
+    """No package in the catalogue fits the device"""
+
+
+def load_image(path):
+    """The firmware image of a .bin or .hex file as array('B')"""
+    if path is None:
+        raise Exception("input invalid")
+
+    extent = os.path.splitext(path)[1]
+
+    if extent == ".bin":
+        with open(path, 'rb') as f:
+            return array('B', f.read())
+
+    if extent == ".hex":
+        # The HEX parser is an optional dependency, only needed for *.hex
+        from intelhex import IntelHex
+
+        return IntelHex(path).tobinarray()
+
+    raise Exception("Input invalid")
+
+
+class FirmwarePackage(object):
+
+    def __init__(self, firmware_path, datfile_path, name=None):
+        self.firmware_path = firmware_path
+        self.datfile_path = datfile_path
+        self.name = name if name is not None else os.path.basename(firmware_path)
+
+        self.bin_array = load_image(firmware_path)
+        self.image_size = len(self.bin_array)
+        self.image = self.bin_array.tobytes()
+
+        with open(datfile_path, 'rb') as f:
+            self.init_data = f.read()
+        self.init_crc = binascii.crc32(self.init_data)
+
+        self._lock = threading.Lock()
+        self._crc_lengths = [0]
+        self._crcs = {0: 0}
+        self._payloads = {}
+        self._nbytes = sys.getsizeof(self.bin_array) + sys.getsizeof(self.image) + sys.getsizeof(self.init_data)
+        # Called with the package after it grew, e.g. by its PackageCache
+        self.on_grow = None
+
+    # --------------------------------------------------------------------------
+    #  CRC32 of the first `length` bytes of the image, continued from the
+    #  longest prefix computed so far that is not longer
+    # --------------------------------------------------------------------------
+    def crc(self, length):
+        crc = self._crcs.get(length)
+        if crc is not None:
+            return crc
+
+        with self._lock:
+            start = self._crc_lengths[bisect.bisect_right(self._crc_lengths, length) - 1]
+            crc = binascii.crc32(memoryview(self.image)[start:length], self._crcs[start])
+            bisect.insort(self._crc_lengths, length)
+            self._crcs[length] = crc
+        return crc
+
+    # --------------------------------------------------------------------------
+    #  The image split into data objects of object_size, and these into
+    #  payloads of payload_size: {offset: bytes}
+    # --------------------------------------------------------------------------
+    def payloads(self, object_size, payload_size):
+        key = (object_size, payload_size)
+        payloads = self._payloads.get(key)
+        if payloads is None:
+            image = self.image
+            payloads = {}
+            for start in range(0, self.image_size, object_size):
+                end = min(start + object_size, self.image_size)
+                for offset in range(start, end, payload_size):
+                    payloads[offset] = image[offset:min(offset + payload_size, end)]
+            size = sys.getsizeof(payloads) + sum(sys.getsizeof(payload) for payload in payloads.values())
+            with self._lock:
+                added = key not in self._payloads
+                if added:
+                    self._payloads[key] = payloads
+                    self._nbytes += size
+                payloads = self._payloads[key]
+            if added and self.on_grow is not None:
+                self.on_grow(self)
+        return payloads
+
+    @property
+    def nbytes(self):
+        """Approximate memory held"""
+        return self._nbytes + 100 * len(self._crcs)
+
+    def __repr__(self):
+        return "FirmwarePackage(%s, %d bytes)" % (self.name, self.image_size)
+
+
+class PackageCache(object):
+    """
+    Parsed packages by file, least recently used first out once they hold
+    more than max_bytes, also counting the payloads they build later. The
+    package just asked for, or just grown, is always kept.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._packages = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, firmware_path, datfile_path, name=None):
+        key = tuple(_file_key(path) for path in (firmware_path, datfile_path))
+        with self._lock:
+            package = self._packages.get(key)
+            if package is not None:
+                self._packages.move_to_end(key)
+                self.hits += 1
+                return package
+
+            # Loading under the lock: sessions needing the package wait for it
+            # instead of loading it once each
+            package = FirmwarePackage(firmware_path, datfile_path, name)
+            logging.info(f"Loaded {package}")
+            package.on_grow = self._grown
+            self._packages[key] = package
+            self.misses += 1
+            self._evict(package)
+            return package
+
+    def _grown(self, package):
+        """A cached package built payloads: the bound may be exceeded now"""
+        with self._lock:
+            if any(cached is package for cached in self._packages.values()):
+                self._evict(package)
+
+    def _evict(self, keep):
+        while len(self._packages) > 1 and self.nbytes() > self.max_bytes:
+            key = next(key for key, package in self._packages.items() if package is not keep)
+            package = self._packages.pop(key)
+            package.on_grow = None
+            self.evictions += 1
+            logging.info(f"Evicted {package} from the package cache")
+
+    def nbytes(self):
+        return sum(package.nbytes for package in self._packages.values())
+
+    def __len__(self):
+        return len(self._packages)
+
+    def as_dict(self):
+        with self._lock:
+            return {"packages": [package.name for package in self._packages.values()], "bytes": self.nbytes(),
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class Variant(object):
+    __slots__ = ("name", "firmware", "init_packet", "zip", "match", "firmware_revision")
+
+    def __init__(self, name, firmware=None, init_packet=None, zip=None, match=None, firmware_revision=None):
+        if zip is None and (firmware is None or init_packet is None):
+            raise Exception(f"Variant {name} needs a zip or both firmware and init_packet")
+        self.name = name
+        self.firmware = firmware
+        self.init_packet = init_packet
+        self.zip = zip
+        self.match = match or {}
+        self.firmware_revision = firmware_revision
+
+    def fits(self, attributes):
+        for name, wanted in self.match.items():
+            value = attributes.get(name)
+            if value is None:
+                return False
+            if isinstance(wanted, str):
+                if not fnmatch.fnmatchcase(str(value), wanted):
+                    return False
+            elif value != wanted:
+                return False
+        return True
+
+    def __repr__(self):
+        return "Variant(%s)" % self.name
+
+
+class Catalogue(object):
+    """The packages of a campaign. Zipped ones are unpacked on first use."""
+
+    def __init__(self, variants, path=None):
+        self.variants = list(variants)
+        self.path = path
+        self._lock = threading.Lock()
+        self._unpacker = None
+        self._paths = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+
+        variants = []
+        for i, entry in enumerate(data.get("variants", [])):
+            files = {key: os.path.join(base, entry[key]) for key in ("firmware", "init_packet", "zip") if key in entry}
+            variants.append(Variant(entry.get("name", "variant%d" % i), match=entry.get("match"),
+                                    firmware_revision=entry.get("firmware_revision"), **files))
+        return cls(variants, path)
+
+    def digest(self):
+        """SHA-256 over the variants' names and package files, identifying the catalogue's packages"""
+        sha = hashlib.sha256()
+        for variant in self.variants:
+            sha.update(variant.name.encode() + b'\0')
+            paths = [variant.zip] if variant.zip is not None else [variant.firmware, variant.init_packet]
+            for path in paths:
+                with open(path, 'rb') as f:
+                    sha.update(f.read())
+        return sha.hexdigest()
+
+    def match(self, attributes):
+        for variant in self.variants:
+            if variant.fits(attributes):
+                return variant
+        return None
+
+    def files(self, variant):
+        """(firmware path, init packet path) of a variant"""
+        if variant.zip is None:
+            return variant.firmware, variant.init_packet
+
+        with self._lock:
+            files = self._paths.get(variant.zip)
+            if files is None:
+                from ota_dfu_python.unpacker import Unpacker
+
+                if self._unpacker is None:
+                    self._unpacker = Unpacker()
+                files = self._paths[variant.zip] = self._unpacker.unpack_zipfile(variant.zip)
+            return files
+
+    def close(self):
+        with self._lock:
+            if self._unpacker is not None:
+                self._unpacker.delete()
+                self._unpacker = None
+            self._paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class VariantRouter(object):
+    """
+    Picks packages from a catalogue by device attributes, remembered per
+    address (and persisted to `path` if given) for devices found in their
+    bootloader later. Attributes: "name", "model", "hw_revision" as read in
+    application mode, and "hw_version" of the last package a device took.
+    """
+
+    def __init__(self, catalogue, cache=None, path=None):
+        self.catalogue = catalogue
+        self.cache = cache if cache is not None else PackageCache()
+        self.path = path
+        self._lock = threading.Lock()
+        self.devices = {}   # address -> attributes
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.devices = json.load(f).get("devices", {})
+            except (OSError, ValueError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable device attributes {path}: {e}")
+
+    def attributes(self, address):
+        with self._lock:
+            return dict(self.devices.get(address.upper(), {}))
+
+    def remember(self, address, **attributes):
+        address = address.upper()
+        attributes = {name: value for name, value in attributes.items() if value is not None}
+        with self._lock:
+            known = self.devices.setdefault(address, {})
+            if all(known.get(name) == value for name, value in attributes.items()):
+                return
+            known.update(attributes)
+            self._save()
+
+    # --------------------------------------------------------------------------
+    #  The variant and package for a device, after adding the attributes it
+    #  reported now (None if it could not be asked). Raises NoVariantError.
+    # --------------------------------------------------------------------------
+    def route(self, address, reported=None):
+        if reported:
+            self.remember(address, **reported)
+        attributes = self.attributes(address)
+
+        variant = self.catalogue.match(attributes)
+        if variant is None:
+            raise NoVariantError(f"No firmware variant for {address} ({attributes or 'nothing known'})")
+
+        (firmware_path, datfile_path) = self.catalogue.files(variant)
+        return variant, self.cache.get(firmware_path, datfile_path, variant.name)
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"devices": self.devices}, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
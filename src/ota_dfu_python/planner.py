@@ -0,0 +1,377 @@
+"""
+------------------------------------------------------------------------------
+ Campaign duration planning (installed as `ota-dfu-plan`).
+
+ Predicts how long updating a site takes, before going there. Each device's
+ update is estimated from what past sessions measured (see DeviceHistory):
+ its own throughput, overhead and success rate, or else those of its model,
+ scaled by its last RSSI. Success rates of few sessions lean on the
+ model's, and those on the fleet's. A discrete-event simulation then runs
+ the fleet through the FleetScheduler on a simulated clock: jobs are picked
+ in its order, AdaptiveConcurrency holds the sessions per adapter, and
+ sessions on an adapter share its throughput. Runs are repeated with random
+ failures for each concurrency up to the maximum, to predict the duration
+ and recommend a concurrency:
+
+   ota-dfu-plan --devices site.txt --image-size 180000 --history devices.json -j 6
+   ota-dfu-plan --devices site.txt -z app.zip --history devices.json --adapter hci0 --adapter hci1 --window 2h
+------------------------------------------------------------------------------
+"""
+import argparse
+import heapq
+import json
+import logging
+import random
+import sys
+
+from ota_dfu_python.scheduler import AdaptiveConcurrency, DeviceHistory, DeviceRecord, FleetScheduler
+
+# Assumed for devices whose model was never measured
+DEFAULT_THROUGHPUT = 2500.0     # image bytes per second
+DEFAULT_OVERHEAD   = 20.0       # seconds of an update not sending the image
+DEFAULT_SUCCESS    = 0.9
+
+# Sessions' worth of weight of the prior a success rate is estimated from:
+# the fleet's rate for a model, the model's rate for a device
+PRIOR_SESSIONS = 4.0
+
+
+class PlannedJob(object):
+    """A device to update, as seen by FleetScheduler.rank"""
+    __slots__ = ("address", "attempts")
+
+    def __init__(self, address):
+        self.address = address
+        self.attempts = 0
+
+
+class DeviceEstimate(object):
+    __slots__ = ("address", "model", "throughput", "overhead", "success", "source")
+
+    def __init__(self, address, model, throughput, overhead, success, source):
+        self.address = address
+        self.model = model
+        self.throughput = throughput    # image bytes per second on an adapter of its own
+        self.overhead = overhead
+        self.success = success          # chance a session (with its retries) updates it
+        self.source = source            # "device", "model" or "default"
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def read_devices(path):
+    """Devices of a site, one per line: address, then optionally the last RSSI and the model"""
+    devices = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            rssi = int(fields[1]) if len(fields) > 1 and fields[1] not in ("-", "?") else None
+            model = " ".join(fields[2:]) or None
+            devices.append({"address": fields[0].upper(), "rssi": rssi, "model": model})
+    return devices
+
+
+class CampaignPlanner(object):
+    """
+    devices: [{"address", "rssi", "model"}] of the site. history: the
+    DeviceHistory of past campaigns. models: {address: model} for devices
+    in the history (e.g. from --device-attributes), to learn per model.
+    adapters: names of the adapters to use. capacity: image bytes per second
+    an adapter moves in total, shared by its sessions (None: no limit).
+    max_attempts: sessions per device, as for JobWorker. retries: attempts
+    per session, as for RetryPolicy.
+    """
+
+    def __init__(self, devices, image_size, history=None, models=None, adapters=("default",), capacity=None,
+                 max_attempts=1, scheduler_options=None, retries=3):
+        self.devices = devices
+        self.image_size = image_size
+        self.history = history if history is not None else DeviceHistory()
+        self.adapters = list(adapters)
+        self.capacity = capacity
+        self.max_attempts = max_attempts
+        self.retries = max(1, retries)
+        self.scheduler_options = scheduler_options or {}
+
+        self.models = dict(models or {})
+        for device in devices:
+            if device.get("model") is not None:
+                self.models[device["address"]] = device["model"]
+        self.profiles = self._model_profiles()
+        records = self.history.devices.values()
+        self.fleet_success = _shrunk(sum(record.successes for record in records),
+                                     sum(record.sessions for record in records), DEFAULT_SUCCESS)
+
+    def _model_profiles(self):
+        """{model: (throughput, overhead, sessions, successes)} over the devices of each model with history"""
+        grouped = {}
+        for address, record in self.history.devices.items():
+            model = self.models.get(address)
+            if model is None:
+                continue
+            grouped.setdefault(model, []).append(record)
+
+        profiles = {}
+        for model, records in grouped.items():
+            timed = [record for record in records if record.throughput]
+            throughput = sum(record.throughput for record in timed) / len(timed) if timed else None
+            overhead = sum(record.overhead for record in timed) / len(timed) if timed else None
+            profiles[model] = (throughput, overhead, sum(record.sessions for record in records),
+                               sum(record.successes for record in records))
+        return profiles
+
+    def estimate(self, device, scheduler):
+        """DeviceEstimate of one device's update"""
+        address = device["address"]
+        model = self.models.get(address)
+        record = self.history.get(address)
+
+        # A few sessions of the device say little: its rate leans on its
+        # model's, which leans on the fleet's
+        (throughput, overhead, sessions, successes) = self.profiles.get(model, (None, None, 0, 0))
+        success = _shrunk(successes, sessions, self.fleet_success)
+        if record is not None:
+            success = _shrunk(record.successes, record.sessions, success)
+
+        if record is not None and record.throughput:
+            return DeviceEstimate(address, model, record.throughput, record.overhead, success, "device")
+
+        # Measured for the model, or assumed, at the device's signal
+        source = "model" if throughput is not None else "default"
+        throughput = (throughput or DEFAULT_THROUGHPUT) * scheduler.signal_factor(scheduler.history.get(address))
+        return DeviceEstimate(address, model, throughput, overhead if overhead is not None else DEFAULT_OVERHEAD,
+                              success, source)
+
+    def _scheduler(self, concurrency, clock):
+        """A FleetScheduler on the simulated clock, knowing what the real one would at the start"""
+        history = DeviceHistory(clock=clock)
+        for device in self.devices:
+            record = self.history.get(device["address"])
+            copy = history.devices[device["address"]] = DeviceRecord()
+            if record is not None:
+                for name in DeviceRecord.__slots__:
+                    setattr(copy, name, getattr(record, name))
+            if device.get("rssi") is not None:
+                (copy.rssi, copy.seen, copy.missed) = (device["rssi"], clock(), 0)
+        return FleetScheduler(history, AdaptiveConcurrency(concurrency), clock=clock, **self.scheduler_options)
+
+    # --------------------------------------------------------------------------
+    #  One simulated campaign with up to `concurrency` sessions per adapter.
+    #  Returns (seconds until the last session ended, devices updated,
+    #  {address: seconds when updated}). The history counts sessions, so
+    #  the retries of sessions that updated are in the success rate and in
+    #  the overhead measured. A failing session spends all `retries`
+    #  attempts, each reconnecting and starting over its overhead.
+    # --------------------------------------------------------------------------
+    def simulate(self, concurrency, rng):
+        clock = _Clock()
+        scheduler = self._scheduler(concurrency, clock)
+        limits = scheduler.concurrency
+        estimates = {device["address"]: self.estimate(device, scheduler) for device in self.devices}
+
+        pending = [PlannedJob(device["address"]) for device in self.devices]
+        sessions = []       # [job, adapter, estimate, overhead end, bytes left, fails]
+        done = {}
+        events = []         # heap of overhead ends: (time, id)
+
+        while pending or sessions:
+            # Fill the free slots, best ranked job first, like JobWorker
+            for adapter in self.adapters:
+                while pending and limits.active[adapter] < limits.limit(adapter):
+                    job = min(pending, key=lambda job: (scheduler.rank(job), job.address))
+                    pending.remove(job)
+                    job.attempts += 1
+                    limits.active[adapter] += 1
+                    estimate = estimates[job.address]
+                    fails = rng.random() >= estimate.success
+                    overhead = estimate.overhead * (self.retries if fails else 1)
+                    session = [job, adapter, estimate, clock.now + overhead, float(self.image_size), fails]
+                    sessions.append(session)
+                    heapq.heappush(events, (session[3], id(session)))
+
+            # The next session to end its overhead or its transfer
+            rates = self._rates(sessions, clock.now)
+            step = min([left / rate for (session, rate, left) in rates if rate > 0] or [float('inf')])
+            if events:
+                step = min(step, events[0][0] - clock.now)
+            if step == float('inf'):
+                break
+            step = max(step, 0.0)
+
+            clock.now += step
+            for (session, rate, _) in rates:
+                session[4] -= rate * step
+            while events and events[0][0] <= clock.now:
+                heapq.heappop(events)
+
+            for session in [session for session in sessions if session[3] <= clock.now and session[4] <= 1e-6]:
+                sessions.remove(session)
+                (job, adapter, estimate, _, _, fails) = session
+                scheduler.history.record(job.address, not fails)
+                limits.release(adapter)
+                if not fails:
+                    done[job.address] = clock.now
+                elif job.attempts < self.max_attempts:
+                    pending.append(job)
+
+        return clock.now, len(done), done
+
+    def _rates(self, sessions, now):
+        """[(session, image bytes per second, bytes left)] of the sessions sending the image"""
+        sending = [session for session in sessions if session[3] <= now and session[4] > 1e-6]
+        per_adapter = {}
+        for session in sending:
+            per_adapter[session[1]] = per_adapter.get(session[1], 0) + 1
+
+        rates = []
+        for session in sending:
+            rate = session[2].throughput
+            if self.capacity is not None:
+                rate = min(rate, self.capacity / float(per_adapter[session[1]]))
+            rates.append((session, rate, session[4]))
+        return rates
+
+    # --------------------------------------------------------------------------
+    #  Simulate `runs` campaigns per concurrency from 1 to maximum. The
+    #  recommendation is the lowest concurrency whose mean duration is within
+    #  `tolerance` of the shortest: more sessions buy little beyond it.
+    # --------------------------------------------------------------------------
+    def plan(self, maximum, runs=20, window=None, tolerance=0.05, seed=1):
+        results = []
+        for concurrency in range(1, maximum + 1):
+            rng = random.Random(seed)
+            outcomes = [self.simulate(concurrency, rng) for _ in range(runs)]
+            durations = sorted(outcome[0] for outcome in outcomes)
+            result = {
+                "concurrency": concurrency,
+                "mean_duration": sum(durations) / len(durations),
+                "p90_duration": durations[min(len(durations) - 1, int(0.9 * len(durations)))],
+                "mean_updated": sum(outcome[1] for outcome in outcomes) / float(len(outcomes)),
+            }
+            if window is not None:
+                result["window_fits"] = sum(1 for duration in durations if duration <= window) / float(runs)
+                result["mean_updated_in_window"] = sum(
+                    sum(1 for finished in outcome[2].values() if finished <= window) for outcome in outcomes) / float(runs)
+            results.append(result)
+
+        best = min(result["mean_duration"] for result in results)
+        recommended = next(result for result in results if result["mean_duration"] <= best * (1 + tolerance))
+        scheduler = self._scheduler(maximum, _Clock())
+        return {
+            "devices": len(self.devices),
+            "image_size": self.image_size,
+            "adapters": self.adapters,
+            "recommended": recommended["concurrency"],
+            "results": results,
+            "estimates": [self.estimate(device, scheduler).as_dict() for device in self.devices],
+        }
+
+
+def _shrunk(successes, sessions, prior):
+    """Success rate of `sessions`, drawn towards `prior` by PRIOR_SESSIONS sessions at it"""
+    return (successes + PRIOR_SESSIONS * prior) / (sessions + PRIOR_SESSIONS)
+
+
+class _Clock(object):
+    """Simulated time, callable like time.monotonic"""
+    __slots__ = ("now",)
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def parse_duration(value):
+    """Seconds from "90", "90s", "45m" or "2h" """
+    units = {"s": 1, "m": 60, "h": 3600}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="ota-dfu-plan", description="Predict how long a DFU campaign takes.")
+    parser.add_argument('--devices', required=True,
+                        help='File with one device per line: address, last RSSI and model (both optional).')
+    parser.add_argument('--image-size', type=int, default=None, help='Firmware image size in bytes.')
+    parser.add_argument('-z', '--zipfile', dest="zipfile", default=None, help='Zip file, for its image size.')
+    parser.add_argument('--history', default=None, help='Device history (see --device-history of ota-dfu).')
+    parser.add_argument('--device-attributes', default=None,
+                        help='Device attributes (see ota-dfu --catalogue), for the models of devices in the history.')
+    parser.add_argument('--adapter', action='append', dest="adapters", default=[],
+                        help='Adapter to use, may be given multiple times (default: one).')
+    parser.add_argument('-j', '--concurrency', type=int, default=4, help='Maximum concurrent sessions per adapter.')
+    parser.add_argument('--capacity', type=float, default=None,
+                        help='Image bytes per second an adapter moves in total, shared by its sessions.')
+    parser.add_argument('-r', '--attempts', type=int, default=1, help='Sessions per device, as for ota-dfu.')
+    parser.add_argument('--retries', type=int, default=3, help='Attempts per session, as -r of ota-dfu.')
+    parser.add_argument('--window', type=parse_duration, default=None,
+                        help='Maintenance window (e.g. 2h or 45m) to check the campaign against.')
+    parser.add_argument('--runs', type=int, default=20, help='Simulated campaigns per concurrency.')
+    parser.add_argument('--json', action='store_true', help='Print the plan, with per-device estimates, as JSON.')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='More logging (-vv for debug).')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)]
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S',
+                        level=level, stream=sys.stderr)
+
+    image_size = args.image_size
+    if image_size is None and args.zipfile is not None:
+        from ota_dfu_python.packages import PackageCache
+        from ota_dfu_python.unpacker import Unpacker
+        with Unpacker() as unpacker:
+            hexfile, datfile = unpacker.unpack_zipfile(args.zipfile)
+            image_size = len(PackageCache().get(hexfile, datfile).image)
+    if image_size is None:
+        logging.error("Either an image size or a zip file is required")
+        return 2
+
+    devices = read_devices(args.devices)
+    if not devices:
+        logging.error("No device in " + args.devices)
+        return 2
+
+    models = {}
+    if args.device_attributes is not None:
+        with open(args.device_attributes) as f:
+            models = {address: attributes["model"] for address, attributes in json.load(f).get("devices", {}).items()
+                      if attributes.get("model") is not None}
+
+    planner = CampaignPlanner(devices, image_size, DeviceHistory(args.history) if args.history else None, models,
+                              args.adapters or ["default"], args.capacity, args.attempts, retries=args.retries)
+    plan = planner.plan(args.concurrency, args.runs, args.window)
+
+    if args.json:
+        json.dump(plan, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 0
+
+    sources = {}
+    for estimate in plan["estimates"]:
+        sources[estimate["source"]] = sources.get(estimate["source"], 0) + 1
+    print("%d devices, %d image bytes, adapters: %s; estimates from %s" % (
+        plan["devices"], image_size, ", ".join(plan["adapters"]),
+        ", ".join("%s %d" % item for item in sorted(sources.items()))))
+    for result in plan["results"]:
+        line = "-j %d: %.0f min (p90 %.0f min), %.1f devices updated" % (
+            result["concurrency"], result["mean_duration"] / 60, result["p90_duration"] / 60, result["mean_updated"])
+        if args.window is not None:
+            line += ", %.1f within the window, fits in %.0f%% of runs" % (result["mean_updated_in_window"],
+                                                                          result["window_fits"] * 100)
+        print(line)
+    print("Recommended concurrency: %d per adapter" % plan["recommended"])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
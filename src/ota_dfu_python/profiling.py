@@ -0,0 +1,161 @@
+"""
+------------------------------------------------------------------------------
+ Opt-in session profiling.
+
+ SessionProfiler wraps the controller's hot path (data writes, control point
+ requests, notification waits and parsing, CRC, event dispatch) with timers
+ accumulated per phase, and can additionally run cProfile and tracemalloc for
+ the session. Nothing is wrapped unless profiling is enabled, so the normal
+ send loop pays nothing for it.
+
+ cProfile only sees the thread the session runs in. tracemalloc traces the
+ whole process, so with concurrent sessions its figures cover all of them.
+------------------------------------------------------------------------------
+"""
+import logging
+import time
+
+
+class ProfileModes:
+    TIMERS      = "timers"
+    CPROFILE    = "cprofile"
+    TRACEMALLOC = "tracemalloc"
+
+    ALL = (TIMERS, CPROFILE, TRACEMALLOC)
+
+    @staticmethod
+    def parse(modes):
+        """Accepts True, "timers,cprofile" or an iterable of modes"""
+        if modes is True:
+            return {ProfileModes.TIMERS}
+        if isinstance(modes, str):
+            modes = modes.split(',')
+        modes = {mode.strip().lower() for mode in modes if mode.strip()}
+        unknown = modes - set(ProfileModes.ALL)
+        if unknown:
+            raise Exception("Unknown profiling mode(s): {}".format(", ".join(sorted(unknown))))
+        return modes
+
+
+class SessionProfiler(object):
+
+    def __init__(self, modes=True, phase=lambda: None, top=20):
+        self.modes = ProfileModes.parse(modes)
+        self.phase = phase
+        self.top = top
+
+        # (phase, section) -> [calls, seconds]
+        self.sections = {}
+
+        self._profile = None
+        self._tracing = False
+        self._snapshot = None
+        self._started = None
+        self.duration = 0.0
+        self.memory = None
+
+    def wrap(self, section, func):
+        """Return func timed under `section` (only in timers mode)"""
+        if ProfileModes.TIMERS not in self.modes:
+            return func
+
+        sections = self.sections
+        phase = self.phase
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                key = (phase(), section)
+                entry = sections.get(key)
+                if entry is None:
+                    entry = sections[key] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += clock() - start
+
+        return timed
+
+    def start(self):
+        self._started = time.perf_counter()
+
+        if ProfileModes.TRACEMALLOC in self.modes:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._tracing = True
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            self._snapshot = tracemalloc.take_snapshot()
+
+        if ProfileModes.CPROFILE in self.modes:
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if self._started is None:
+            return
+
+        if self._profile is not None:
+            self._profile.disable()
+
+        self.duration = time.perf_counter() - self._started
+        self._started = None
+
+        if ProfileModes.TRACEMALLOC in self.modes:
+            import tracemalloc
+
+            current, peak = tracemalloc.get_traced_memory()
+            growth = tracemalloc.take_snapshot().compare_to(self._snapshot, 'lineno')
+            self.memory = {
+                "current": current,
+                "peak": peak,
+                "top": [{"location": str(stat.traceback), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                        for stat in growth[:self.top]],
+            }
+            self._snapshot = None
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+
+    def dump(self, path):
+        """Write the raw cProfile data (for pstats, snakeviz, ...)"""
+        if self._profile is not None:
+            self._profile.dump_stats(path)
+            logging.info(f"Profile written to {path}")
+
+    def functions(self):
+        """Top functions by cumulative time from cProfile"""
+        if self._profile is None:
+            return None
+
+        import pstats
+
+        stats = pstats.Stats(self._profile)
+        rows = []
+        for (filename, line, name), (calls, _, tottime, cumtime, _) in stats.stats.items():
+            rows.append({"function": "%s:%d(%s)" % (filename, line, name), "calls": calls,
+                         "tottime": tottime, "cumtime": cumtime})
+        rows.sort(key=lambda row: row["tottime"], reverse=True)
+        return rows[:self.top]
+
+    def report(self):
+        phases = {}
+        for (phase, section), (calls, seconds) in sorted(self.sections.items(), key=lambda item: str(item[0])):
+            phases.setdefault(str(phase), {})[section] = {
+                "calls": calls,
+                "seconds": seconds,
+                "mean_us": seconds / calls * 1e6 if calls else 0.0,
+            }
+
+        return {
+            "modes": sorted(self.modes),
+            "duration": self.duration,
+            "phases": phases,
+            "functions": self.functions(),
+            "memory": self.memory,
+        }
@@ -0,0 +1,86 @@
+"""
+------------------------------------------------------------------------------
+ Tracked external resources.
+
+ Sessions hold resources the garbage collector alone does not clean up in
+ time: gatttool child processes (with their pty) and unpacked packages in
+ the temp directory. Their owners release them in close()/delete() or as
+ context managers. Each one is also tracked here with a finalizer, so that
+ a resource whose owner is dropped without that, e.g. after an exception
+ in a constructor, is released when the owner is collected or at exit at
+ the latest. reap() releases everything still open.
+------------------------------------------------------------------------------
+"""
+import logging
+import threading
+import weakref
+
+_lock = threading.Lock()
+_open = {}          # id -> Resource
+_leaked = {}        # kind -> resources released by their finalizer
+
+
+class Resource(object):
+    """
+    A resource of `kind` that release(*args) frees, owned by `owner`. The
+    arguments must not refer to the owner, or it is never collected.
+    """
+    __slots__ = ("kind", "_finalizer", "__weakref__")
+
+    def __init__(self, owner, kind, release, *args):
+        self.kind = kind
+        self._finalizer = weakref.finalize(owner, _release, id(self), kind, release, args, leaked=True)
+        with _lock:
+            _open[id(self)] = self
+
+    @property
+    def alive(self):
+        return self._finalizer.alive
+
+    def release(self):
+        """Free the resource now. Later calls do nothing."""
+        info = self._finalizer.detach()
+        if info is not None:
+            _release(*info[2], leaked=False)
+
+
+def _release(key, kind, release, args, leaked):
+    with _lock:
+        _open.pop(key, None)
+        if leaked:
+            _leaked[kind] = _leaked.get(kind, 0) + 1
+
+    if leaked:
+        logging.warning(f"Releasing a leaked {kind}")
+    try:
+        release(*args)
+    except Exception as e:
+        logging.warning(f"Releasing {kind} failed: {e}")
+
+
+def track(owner, kind, release, *args):
+    return Resource(owner, kind, release, *args)
+
+
+def live():
+    """Open resources by kind"""
+    counts = {}
+    with _lock:
+        for resource in _open.values():
+            counts[resource.kind] = counts.get(resource.kind, 0) + 1
+    return counts
+
+
+def leaked():
+    """Resources released by their finalizer instead of their owner, by kind"""
+    with _lock:
+        return dict(_leaked)
+
+
+def reap():
+    """Release every open resource. Returns how many there were."""
+    with _lock:
+        resources = list(_open.values())
+    for resource in resources:
+        resource.release()
+    return len(resources)
@@ -0,0 +1,107 @@
+"""
+------------------------------------------------------------------------------
+ In-session retries.
+
+ Failures are classified by kind. SecureDfu.perform_dfu reconnects after a
+ retriable one, with exponential backoff and jitter, keeping the parsed
+ firmware, the discovered handles and the timeout estimates; the bootloader
+ keeps what it already received, so the transfer resumes from the last
+ executed object. Only failures of a known transient kind are retried:
+ link loss, timeouts, CRC mismatches and the result codes in
+ RETRIABLE_RESULTS. Rejected packages, other protocol rejections and
+ anything unclassified (most likely a bug) fail the same way every time
+ and end the session at once.
+------------------------------------------------------------------------------
+"""
+from ota_dfu_python.codec import Results, CodecError, DfuResponseError
+from ota_dfu_python.initpacket import InitPacketError
+
+
+class LinkLostError(Exception):
+    """The connection dropped, or could not be established"""
+
+
+class DfuTimeoutError(Exception):
+    """The peripheral did not answer in time"""
+
+
+class CrcMismatchError(Exception):
+    """The peripheral kept reporting a CRC that does not match the image"""
+
+
+class PreemptedError(Exception):
+    """The session gave way, e.g. to a link about to be lost. It is not retried
+    in place; the job is queued again and resumes where the device left off."""
+
+
+class FailureKinds:
+    LINK_LOST       = "link_lost"
+    TIMEOUT         = "timeout"
+    CRC_MISMATCH    = "crc_mismatch"
+    PREEMPTED       = "preempted"
+    REJECTED        = "rejected"
+    INVALID_PACKAGE = "invalid_package"
+    OTHER           = "other"
+
+
+# Result codes after which sending the object again can succeed
+RETRIABLE_RESULTS = (Results.INVALID_OBJECT, Results.INSUFF_RESOURCES, Results.OPERATION_FAILED)
+
+
+def classify(error):
+    if isinstance(error, LinkLostError):
+        return FailureKinds.LINK_LOST
+    if isinstance(error, DfuTimeoutError):
+        return FailureKinds.TIMEOUT
+    if isinstance(error, CrcMismatchError):
+        return FailureKinds.CRC_MISMATCH
+    if isinstance(error, PreemptedError):
+        return FailureKinds.PREEMPTED
+    if isinstance(error, (DfuResponseError, CodecError)):
+        return FailureKinds.REJECTED
+    if isinstance(error, InitPacketError):
+        return FailureKinds.INVALID_PACKAGE
+    # pexpect raises EOF when gatttool goes away
+    if type(error).__module__.startswith("pexpect"):
+        return FailureKinds.LINK_LOST
+    return FailureKinds.OTHER
+
+
+# Kinds of failure a new attempt can get past
+RETRIABLE_KINDS = (FailureKinds.LINK_LOST, FailureKinds.TIMEOUT, FailureKinds.CRC_MISMATCH, FailureKinds.PREEMPTED)
+
+
+def is_retriable(error):
+    if isinstance(error, DfuResponseError):
+        return error.response.result in RETRIABLE_RESULTS
+    return classify(error) in RETRIABLE_KINDS
+
+
+class RetryPolicy(object):
+    """
+    Up to `attempts` tries per session. Before try n+1 the session waits
+    base_delay * 2^(n-1) seconds, at most max_delay, shortened by a random
+    fraction of up to `jitter` so that devices failing together do not
+    reconnect in lockstep.
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0, jitter=0.5, rng=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.rng = rng
+
+    def delay(self, attempt):
+        """Seconds to wait after failed attempt number `attempt` (from 1)"""
+        if self.rng is None:
+            import random
+
+            self.rng = random.Random()
+
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1.0 - self.jitter * self.rng.random())
+
+    def should_retry(self, attempt, error):
+        # A preempted session gave way on purpose, reconnecting would undo it
+        return attempt < self.attempts and is_retriable(error) and not isinstance(error, PreemptedError)
@@ -0,0 +1,335 @@
+"""
+------------------------------------------------------------------------------
+ Fleet scheduling.
+
+ A campaign that starts with weak-signal devices spends adapter time on
+ retransmits and lost links while strong devices wait. FleetScheduler ranks
+ pending jobs by the expected rate of successful updates: recent RSSI from
+ scans, and each device's past session durations and outcomes kept in a
+ DeviceHistory. AdaptiveConcurrency lowers the number of sessions run at
+ once on an adapter while its sessions retransmit a lot, and raises it
+ again while they do not.
+------------------------------------------------------------------------------
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from ota_dfu_python.events import Phases
+
+
+class DeviceRecord(object):
+    __slots__ = ("rssi", "seen", "missed", "sessions", "successes", "duration", "retransmit_rate", "throughput",
+                 "overhead")
+
+    def __init__(self, rssi=None, seen=None, missed=0, sessions=0, successes=0, duration=None, retransmit_rate=None,
+                 throughput=None, overhead=None):
+        self.rssi = rssi                        # last RSSI heard, dBm
+        self.seen = seen                        # when it was heard (wall clock)
+        self.missed = missed                    # scans since, that did not hear it
+        self.sessions = sessions
+        self.successes = successes
+        self.duration = duration                # smoothed duration of updates, seconds
+        self.retransmit_rate = retransmit_rate  # smoothed retransmits and retries per object
+        self.throughput = throughput            # smoothed image bytes per second while sending
+        self.overhead = overhead                # smoothed seconds of updates spent not sending the image
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class DeviceHistory(object):
+    """
+    What was heard from and learned about each device: last RSSI, sessions,
+    successes and smoothed (EWMA, weight `smoothing`) update durations and
+    retransmit rates. With a path it is persisted as JSON, so the next
+    campaign starts from it.
+    """
+
+    def __init__(self, path=None, smoothing=0.3, clock=time.time):
+        self.path = path
+        self.smoothing = smoothing
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.devices = {}   # app address -> DeviceRecord
+        self._mean_duration = None
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.devices = {address: DeviceRecord(**record) for address, record in data.get("devices", {}).items()}
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logging.warning(f"Ignoring unreadable device history {path}: {e}")
+
+    def get(self, address):
+        with self._lock:
+            return self.devices.get(address.upper())
+
+    def _record(self, address):
+        return self.devices.setdefault(address.upper(), DeviceRecord())
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    # --------------------------------------------------------------------------
+    #  Record a scan for `addresses` that heard `heard` ({address: RSSI})
+    # --------------------------------------------------------------------------
+    def observe_scan(self, addresses, heard):
+        heard = {address.upper(): rssi for address, rssi in heard.items()}
+        now = self.clock()
+        with self._lock:
+            for address in addresses:
+                record = self._record(address)
+                rssi = heard.get(address.upper())
+                if rssi is None:
+                    record.missed += 1
+                else:
+                    (record.rssi, record.seen, record.missed) = (rssi, now, 0)
+            self._save()
+
+    # --------------------------------------------------------------------------
+    #  Record a finished session. duration, throughput and overhead are only
+    #  learned from updates that sent the image, skipped devices say nothing
+    #  about the link.
+    # --------------------------------------------------------------------------
+    def record(self, address, success, duration=None, retransmit_rate=None, throughput=None, overhead=None):
+        with self._lock:
+            record = self._record(address)
+            record.sessions += 1
+            if success:
+                record.successes += 1
+            for name, value in (("duration", duration), ("retransmit_rate", retransmit_rate),
+                                ("throughput", throughput), ("overhead", overhead)):
+                if value is not None:
+                    setattr(record, name, self._smooth(getattr(record, name), value))
+            self._mean_duration = None
+            self._save()
+
+    def mean_duration(self):
+        # Asked for on every rank, so kept until the next session is recorded
+        with self._lock:
+            if self._mean_duration is None:
+                durations = [record.duration for record in self.devices.values() if record.duration is not None]
+                self._mean_duration = (sum(durations) / len(durations) if durations else None,)
+            return self._mean_duration[0]
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        data = {"devices": {address: record.as_dict() for address, record in self.devices.items()}}
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Per-adapter limit on concurrent sessions, between `minimum` and `maximum`.
+    After every `window` sessions on an adapter, their aggregate retransmit
+    rate (object retransmits plus retried failures, per committed object)
+    lowers the limit by one above `high` and raises it by one below `low`.
+    Adapters are named by the JobWorker's `adapter`, "default" unless given.
+    """
+
+    def __init__(self, maximum, minimum=1, high=0.5, low=0.1, window=4, initial=None):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.high = high
+        self.low = low
+        self.window = window
+        self.initial = maximum if initial is None else initial
+
+        self.limits = {}
+        self.active = collections.Counter()
+        self.changes = []   # (adapter, limit, rate)
+        self._samples = {}  # adapter -> [(retransmits, objects)]
+        self._condition = threading.Condition()
+
+    def limit(self, adapter):
+        with self._condition:
+            return self.limits.get(adapter, self.initial)
+
+    def acquire(self, adapter):
+        """Wait for a session slot on the adapter"""
+        with self._condition:
+            while self.active[adapter] >= self.limits.setdefault(adapter, self.initial):
+                self._condition.wait()
+            self.active[adapter] += 1
+
+    # --------------------------------------------------------------------------
+    #  Free the slot of a finished session and adapt the limit to the
+    #  retransmits (and retries) it needed for the objects it committed
+    # --------------------------------------------------------------------------
+    def release(self, adapter, retransmits=0, objects=0):
+        with self._condition:
+            self.active[adapter] -= 1
+            samples = self._samples.setdefault(adapter, [])
+            # Sessions without objects say nothing about the adapter's load
+            if objects:
+                samples.append((retransmits, objects))
+            if objects and len(samples) >= self.window:
+                rate = sum(sample[0] for sample in samples) / float(max(1, sum(sample[1] for sample in samples)))
+                limit = self.limits.get(adapter, self.initial)
+                if rate > self.high and limit > self.minimum:
+                    limit -= 1
+                elif rate < self.low and limit < self.maximum:
+                    limit += 1
+                if limit != self.limits.get(adapter, self.initial):
+                    logging.info(f"Adapter {adapter}: {limit} concurrent session(s) at {rate:.2f} retransmits per object")
+                    self.limits[adapter] = limit
+                    self.changes.append((adapter, limit, rate))
+                # The next decision only counts sessions run at the new limit
+                del samples[:]
+            self._condition.notify_all()
+
+    def cancel(self, adapter):
+        """Free a slot no session ran in"""
+        with self._condition:
+            self.active[adapter] -= 1
+            self._condition.notify_all()
+
+
+def retransmit_rate(stats):
+    """Object retransmits plus retried failures per committed object of a session"""
+    return (stats.retransmits + len(stats.retries)) / float(max(1, stats.objects_committed))
+
+
+class FleetScheduler(object):
+    """
+    Orders a JobWorker's pending jobs by the expected rate of successful
+    updates, p(success) / expected duration, best first:
+
+    - p(success) is (successes + 1) / (sessions + 2) from the device's history
+    - the expected duration is the device's smoothed update duration, or the
+      fleet's mean duration (`base_duration` before any) divided by a signal
+      factor: 1 at `strong_rssi` or better, falling linearly to `weak_factor`
+      at `weak_rssi`. Devices not heard in the last scans, or not within
+      `rssi_max_age` seconds, get `unheard_factor`.
+
+    Pending addresses are scanned for when the worker starts, and again once
+    `scan_interval` seconds have passed (never with None).
+    """
+
+    def __init__(self, history=None, concurrency=None, strong_rssi=-60, weak_rssi=-90, weak_factor=0.25,
+                 unheard_factor=0.1, rssi_max_age=600.0, base_duration=60.0, scan_timeout=3.0, scan_interval=None,
+                 clock=time.monotonic):
+        self.history = history if history is not None else DeviceHistory()
+        self.concurrency = concurrency
+        self.strong_rssi = strong_rssi
+        self.weak_rssi = weak_rssi
+        self.weak_factor = weak_factor
+        self.unheard_factor = unheard_factor
+        self.rssi_max_age = rssi_max_age
+        self.base_duration = base_duration
+        self.scan_timeout = scan_timeout
+        self.scan_interval = scan_interval
+        self.clock = clock
+        self._scanned = None
+
+    def signal_factor(self, record):
+        if record is None or record.rssi is None or record.missed:
+            return self.unheard_factor
+        if record.seen is not None and self.history.clock() - record.seen > self.rssi_max_age:
+            return self.unheard_factor
+        if record.rssi >= self.strong_rssi:
+            return 1.0
+        if record.rssi <= self.weak_rssi:
+            return self.weak_factor
+        share = (self.strong_rssi - record.rssi) / float(self.strong_rssi - self.weak_rssi)
+        return 1.0 - share * (1.0 - self.weak_factor)
+
+    def expected_duration(self, address):
+        record = self.history.get(address)
+        if record is not None and record.duration is not None:
+            return record.duration
+        base = self.history.mean_duration() or self.base_duration
+        return base / self.signal_factor(record)
+
+    def success_probability(self, address):
+        record = self.history.get(address)
+        if record is None:
+            return 0.5
+        return (record.successes + 1.0) / (record.sessions + 2.0)
+
+    def rank(self, job):
+        """Sort key of a pending job, lowest first"""
+        return -self.success_probability(job.address) / self.expected_duration(job.address)
+
+    # --------------------------------------------------------------------------
+    #  Scan for the pending addresses if none was made, or the last one is
+    #  older than scan_interval
+    # --------------------------------------------------------------------------
+    def scan_due(self):
+        if self._scanned is None:
+            return True
+        return self.scan_interval is not None and self.clock() - self._scanned >= self.scan_interval
+
+    @property
+    def scanned(self):
+        """Whether a scan finished yet"""
+        return self._scanned is not None
+
+    def scan(self, transport, addresses):
+        if not addresses:
+            self._scanned = self.clock()
+            return {}
+        try:
+            heard = transport.scan(addresses, self.scan_timeout)
+        except Exception as e:
+            logging.warning(f"Scan for {len(addresses)} pending device(s) failed: {e}")
+            return {}
+        finally:
+            # Due again scan_interval after the end of this one
+            self._scanned = self.clock()
+        if heard is None:
+            # The transport cannot scan: rank by history alone
+            return {}
+        self.history.observe_scan(addresses, heard)
+        logging.info(f"Scan heard {len(heard)} of {len(addresses)} pending device(s)")
+        return heard
+
+    def acquire(self, adapter):
+        if self.concurrency is not None:
+            self.concurrency.acquire(adapter)
+
+    def cancel(self, adapter):
+        if self.concurrency is not None:
+            self.concurrency.cancel(adapter)
+
+    # --------------------------------------------------------------------------
+    #  A session on adapter finished: learn from its stats (None if it never
+    #  started) and free its slot. Retransmits the device needed in earlier
+    #  sessions anyway are its own signal's doing, not the adapter's load,
+    #  so only those beyond its usual rate count for the adapter. Without a
+    #  usual rate only devices heard at `strong_rssi` or better count: weak
+    #  ones retransmit at any concurrency.
+    # --------------------------------------------------------------------------
+    def session_finished(self, address, adapter, stats, success):
+        excess = objects = 0
+        if stats is None:
+            self.history.record(address, success)
+        else:
+            record = self.history.get(address)
+            if record is not None and record.retransmit_rate is not None:
+                objects = stats.objects_committed
+                excess = max(0.0, stats.retransmits + len(stats.retries) - record.retransmit_rate * objects)
+            elif self.signal_factor(record) >= 1.0:
+                objects = stats.objects_committed
+                excess = stats.retransmits + len(stats.retries)
+
+            sent = success and stats.skipped is None
+            timed = sent and stats.throughput > 0
+            image = stats.phase_durations.get(Phases.IMAGE, 0.0)
+            self.history.record(address, success, stats.duration if sent else None,
+                                retransmit_rate(stats) if stats.objects_committed else None,
+                                stats.throughput if timed else None, stats.duration - image if timed else None)
+        if self.concurrency is not None:
+            self.concurrency.release(adapter, excess, objects)
@@ -0,0 +1,590 @@
+"""
+------------------------------------------------------------------------------
+ Simulated Secure DFU target.
+
+ SimulatedDevice implements the nRF5 Secure DFU bootloader (and a buttonless
+ application) in memory, SimulatedTransport connects a controller to it.
+ Time is virtual: every operation advances the transport clock by what it
+ would cost on air according to LinkModel, so transfers of whole images run
+ in milliseconds while still reporting realistic durations. Set time_scale
+ to also sleep for (a fraction of) the simulated time.
+------------------------------------------------------------------------------
+"""
+import binascii
+import collections
+import logging
+import random
+import struct
+import time
+
+from ota_dfu_python.initpacket import decode_init_packet, InitPacketError
+from ota_dfu_python.transport import Transport, CONSERVATIVE_CONNECTION
+from ota_dfu_python.util import mac_string_to_uint, uint_to_mac_string
+
+UUID_BUTTONLESS      = '8ec90003-f315-4f60-9fb8-838830daea50'
+UUID_CONTROL_POINT   = '8ec90001-f315-4f60-9fb8-838830daea50'
+UUID_PACKET          = '8ec90002-f315-4f60-9fb8-838830daea50'
+UUID_FIRMWARE_REVISION = '00002a26-0000-1000-8000-00805f9b34fb'
+UUID_DEVICE_NAME     = '00002a00-0000-1000-8000-00805f9b34fb'
+UUID_MODEL_NUMBER    = '00002a24-0000-1000-8000-00805f9b34fb'
+UUID_HARDWARE_REVISION = '00002a27-0000-1000-8000-00805f9b34fb'
+
+OP_CREATE           = 0x01
+OP_SET_PRN          = 0x02
+OP_CALC_CHECKSUM    = 0x03
+OP_EXECUTE          = 0x04
+OP_SELECT           = 0x06
+OP_FIRMWARE_VERSION = 0x0B
+OP_RESPONSE         = 0x60
+
+RES_SUCCESS                 = 0x01
+RES_OPCODE_NOT_SUPPORTED    = 0x02
+RES_INVALID_PARAMETER       = 0x03
+RES_OPERATION_NOT_PERMITTED = 0x08
+RES_EXT_ERROR               = 0x0B
+
+EXT_HW_VERSION_FAILURE      = 0x06
+
+OBJ_COMMAND         = 0x01
+OBJ_DATA            = 0x02
+
+FW_TYPE_BOOTLOADER  = 0x02
+
+
+class LinkModel(object):
+    """Airtime of write commands and round trips for given connection parameters"""
+
+    IFS                 = 150e-6
+    BYTES_PER_US        = {"1M": 1.0 / 8, "2M": 2.0 / 8, "Coded": 1.0 / 64}     # Coded at S=8
+    PREAMBLE            = {"1M": 1, "2M": 2, "Coded": 1.25}
+    LL_OVERHEAD         = 4 + 2 + 3     # access address, LL header, CRC
+    ATT_WRITE_OVERHEAD  = 4 + 3         # L2CAP header, ATT opcode and handle
+
+    def __init__(self, params=CONSERVATIVE_CONNECTION, max_packets_per_event=16):
+        self.params = params
+        self.max_packets_per_event = max_packets_per_event
+
+    @property
+    def interval(self):
+        return self.params.interval_min / 1000.0
+
+    def _pdu_time(self, length):
+        phy = self.params.phy
+        return (self.PREAMBLE[phy] + self.LL_OVERHEAD + length) / self.BYTES_PER_US[phy] * 1e-6
+
+    def packet_time(self, payload_size):
+        """Air time of one write command including the empty ack and both IFS"""
+        return self._pdu_time(self.ATT_WRITE_OVERHEAD + payload_size) + self._pdu_time(0) + 2 * self.IFS
+
+    def packets_per_event(self, payload_size):
+        fit = int(self.interval / self.packet_time(payload_size))
+        return max(1, min(self.max_packets_per_event, fit))
+
+    def write_command_time(self, payload_size):
+        return self.interval / self.packets_per_event(payload_size)
+
+    def round_trip_time(self):
+        """Request in one connection event, response in the next"""
+        return 2 * self.interval
+
+
+class SimulatedDevice(object):
+    """An nRF5 peripheral running a buttonless application or the Secure DFU bootloader"""
+
+    # GATT table: uuid -> (char handle, value handle, cccd handle)
+    APP_CHARACTERISTICS = {
+        UUID_BUTTONLESS     : (0x0010, 0x0011, 0x0012),
+    }
+    BOOTLOADER_CHARACTERISTICS = {
+        UUID_PACKET         : (0x000b, 0x000c, 0x000d),
+        UUID_CONTROL_POINT  : (0x000e, 0x000f, 0x0010),
+    }
+
+    def __init__(self, address, app_mode=True, bootloader_address_offset=1, supports_2m=True,
+                 min_interval=7.5, command_max_size=256, data_max_size=4096, image_size=None,
+                 firmware_revision=None, advertising_interval=0.1, rssi=-60, link_losses=(),
+                 bootloader_version=None, name=None, model=None, hardware_revision=None, hw_version=None,
+                 packet_loss=0.0):
+        self.address = address.upper()
+        self.app_mode = app_mode
+        self.bootloader_address_offset = bootloader_address_offset
+        self.supports_2m = supports_2m
+        self.min_interval = min_interval
+        self.command_max_size = command_max_size
+        self.data_max_size = data_max_size
+        # Expected image size, taken from the init packet when it can be
+        # decoded. Without it an object shorter than data_max_size is taken
+        # to be the last one.
+        self.image_size = image_size
+
+        # Device Information Service firmware revision in app mode. After an
+        # update it becomes the fw_version of the init packet.
+        self.firmware_revision = firmware_revision
+        self._pending_revision = None
+
+        # GAP device name and Device Information Service strings in app
+        # mode. Init packets for another hw_version are rejected.
+        self.info = {UUID_DEVICE_NAME: name, UUID_MODEL_NUMBER: model, UUID_HARDWARE_REVISION: hardware_revision}
+        self.hw_version = hw_version
+
+        self.advertising_interval = advertising_interval
+        self.rssi = rssi
+        # Share of write commands lost on air, e.g. for a weak signal. Lost
+        # packets are missing from the object, whose CRC then mismatches.
+        self.packet_loss = packet_loss
+
+        # Reported through FIRMWARE_VERSION (image 0), None for bootloaders
+        # without the procedure
+        self.bootloader_version = bootloader_version
+
+        # Numbers of the packet characteristic writes (counted over the
+        # device's lifetime) on whose arrival the link drops
+        self.link_losses = set(link_losses)
+        self.packets = 0
+
+        self.firmware = None
+        self.connected = False
+        self.reboots = 0
+        self.reset_bootloader_state()
+
+    @property
+    def advertised_address(self):
+        if self.app_mode:
+            return self.address
+        return uint_to_mac_string(mac_string_to_uint(self.address) + self.bootloader_address_offset)
+
+    @property
+    def characteristics(self):
+        return self.APP_CHARACTERISTICS if self.app_mode else self.BOOTLOADER_CHARACTERISTICS
+
+    def reset_bootloader_state(self):
+        self.prn = 0
+        self.prn_counter = 0
+        self.object_type = OBJ_COMMAND
+        self.command = bytearray()
+        self.command_valid = False
+        self.received = bytearray()
+        self.committed = 0
+        self.object_end = 0
+
+    def reboot(self, app_mode):
+        self.app_mode = app_mode
+        self.connected = False
+        self.reboots += 1
+        self.prn_counter = 0
+
+    def read(self, uuid):
+        if not self.app_mode:
+            return None
+        value = self.firmware_revision if uuid == UUID_FIRMWARE_REVISION else self.info.get(uuid)
+        return value.encode() if value is not None else None
+
+    # --------------------------------------------------------------------------
+    #  Writes from the central. Return a list of notification values.
+    # --------------------------------------------------------------------------
+    def write(self, handle, data):
+        data = bytes(data)
+        if self.app_mode:
+            if handle == self.APP_CHARACTERISTICS[UUID_BUTTONLESS][1] and data[:1] == b'\x01':
+                logging.debug(f"Simulated device {self.address} entering bootloader")
+                self.reboot(app_mode=False)
+            return []
+
+        if handle == self.BOOTLOADER_CHARACTERISTICS[UUID_CONTROL_POINT][1]:
+            return [self._control_point(data)]
+
+        if handle == self.BOOTLOADER_CHARACTERISTICS[UUID_PACKET][1]:
+            return self._packet(data)
+
+        return []
+
+    def _object(self):
+        if self.object_type == OBJ_COMMAND:
+            return self.command
+        return self.received
+
+    def _response(self, opcode, result, payload=b''):
+        return bytes([OP_RESPONSE, opcode, result]) + payload
+
+    def _control_point(self, data):
+        opcode = data[0]
+
+        if opcode == OP_SET_PRN and len(data) == 3:
+            self.prn = struct.unpack_from('<H', data, 1)[0]
+            self.prn_counter = 0
+            return self._response(opcode, RES_SUCCESS)
+
+        if opcode == OP_SELECT and len(data) == 2 and data[1] in (OBJ_COMMAND, OBJ_DATA):
+            self.object_type = data[1]
+            obj = self._object()
+            max_size = self.command_max_size if self.object_type == OBJ_COMMAND else self.data_max_size
+            return self._response(opcode, RES_SUCCESS, struct.pack('<III', max_size, len(obj), crc32(obj)))
+
+        if opcode == OP_CREATE and len(data) == 6 and data[1] in (OBJ_COMMAND, OBJ_DATA):
+            (size,) = struct.unpack_from('<I', data, 2)
+            self.object_type = data[1]
+            self.prn_counter = 0
+            if self.object_type == OBJ_COMMAND:
+                if size > self.command_max_size:
+                    return self._response(opcode, RES_INVALID_PARAMETER)
+                # A new init packet starts the update over
+                self.command = bytearray()
+                self.command_valid = False
+                self.received = bytearray()
+                self.committed = 0
+                self.object_end = 0
+            else:
+                if size > self.data_max_size or not self.command_valid:
+                    return self._response(opcode, RES_OPERATION_NOT_PERMITTED)
+                # Anything past the last executed object is discarded
+                del self.received[self.committed:]
+                self.object_end = self.committed + size
+            return self._response(opcode, RES_SUCCESS)
+
+        if opcode == OP_CALC_CHECKSUM:
+            obj = self._object()
+            return self._response(opcode, RES_SUCCESS, struct.pack('<II', len(obj), crc32(obj)))
+
+        if opcode == OP_EXECUTE:
+            return self._execute()
+
+        if opcode == OP_FIRMWARE_VERSION and len(data) == 2 and self.bootloader_version is not None:
+            if data[1] != 0:
+                return self._response(opcode, RES_INVALID_PARAMETER)
+            return self._response(opcode, RES_SUCCESS, struct.pack('<BIII', FW_TYPE_BOOTLOADER,
+                                                                   self.bootloader_version, 0x78000, 0x6000))
+
+        return self._response(opcode, RES_OPCODE_NOT_SUPPORTED)
+
+    def _execute(self):
+        if self.object_type == OBJ_COMMAND:
+            if len(self.command) == 0:
+                return self._response(OP_EXECUTE, RES_OPERATION_NOT_PERMITTED)
+            try:
+                packet = decode_init_packet(self.command)
+            except InitPacketError:
+                packet = None
+            if packet is not None:
+                if self.hw_version is not None and packet.hw_version is not None and packet.hw_version != self.hw_version:
+                    return self._response(OP_EXECUTE, RES_EXT_ERROR, bytes([EXT_HW_VERSION_FAILURE]))
+                self.image_size = packet.image_size
+                self._pending_revision = packet.fw_version
+            self.command_valid = True
+            return self._response(OP_EXECUTE, RES_SUCCESS)
+
+        if len(self.received) != self.object_end or self.object_end == self.committed:
+            return self._response(OP_EXECUTE, RES_OPERATION_NOT_PERMITTED)
+
+        object_size = self.object_end - self.committed
+        self.committed = self.object_end
+
+        if self.image_size is not None:
+            complete = self.committed >= self.image_size
+        else:
+            complete = object_size < self.data_max_size
+
+        if complete:
+            # Activate the new image and reboot into the application
+            self.firmware = bytes(self.received)
+            if self._pending_revision is not None:
+                self.firmware_revision = str(self._pending_revision)
+            self.reset_bootloader_state()
+            self.reboot(app_mode=True)
+
+        return self._response(OP_EXECUTE, RES_SUCCESS)
+
+    def _packet(self, data):
+        self.packets += 1
+        if self.packets in self.link_losses:
+            logging.debug(f"Simulated device {self.address} dropping the link")
+            self.connected = False
+            self.prn_counter = 0
+            return []
+
+        obj = self._object()
+        if self.object_type == OBJ_DATA and len(obj) + len(data) > self.object_end:
+            # Overflowing the created object, the bootloader drops the data
+            return []
+        obj.extend(data)
+
+        if self.prn == 0:
+            return []
+
+        self.prn_counter += 1
+        if self.prn_counter < self.prn:
+            return []
+
+        self.prn_counter = 0
+        return [self._response(OP_CALC_CHECKSUM, RES_SUCCESS, struct.pack('<II', len(obj), crc32(obj)))]
+
+
+class SimulatedAir(object):
+    """
+    The set of simulated devices around the adapter. Devices whose rssi is
+    below `sensitivity` are out of range: they are not heard, cannot be
+    connected to and lose their link, so a device moving away can be
+    modelled by lowering its rssi. With more than `capacity` devices
+    connected at once, each one beyond it adds `congestion_loss` to the
+    share of write commands lost on every link, as on an adapter scheduling
+    too many connections.
+    """
+
+    def __init__(self, devices=(), capacity=None, congestion_loss=0.0, seed=1, sensitivity=-100):
+        self.devices = list(devices)
+        self.capacity = capacity
+        self.congestion_loss = congestion_loss
+        self.sensitivity = sensitivity
+        self._random = random.Random(seed)
+
+    def add(self, device):
+        self.devices.append(device)
+        return device
+
+    def find(self, address):
+        for device in self.devices:
+            if device.advertised_address == address.upper():
+                return device
+        return None
+
+    def in_range(self, device):
+        return device.rssi >= self.sensitivity
+
+    def loss(self, device):
+        """Share of write commands to device lost now"""
+        loss = device.packet_loss
+        if self.capacity is not None and self.congestion_loss:
+            connected = sum(1 for other in self.devices if other.connected)
+            loss += self.congestion_loss * max(0, connected - self.capacity)
+        return loss
+
+    def lost(self, device):
+        loss = self.loss(device)
+        return loss > 0 and self._random.random() < loss
+
+
+class SimulatedTransport(Transport):
+    """
+    Write commands go through a model of the local controller's transmit
+    buffer: the host queues them in HOST_WRITE_TIME and they leave at link
+    rate. With tx_buffer_size set, writes arriving at a full buffer are
+    silently dropped, as on hosts without flow control.
+    """
+
+    CONNECT_EVENTS      = 6         # connection events to establish a link
+    DISCOVERY_EVENTS    = 10        # connection events for a characteristics discovery
+    PARAM_UPDATE_EVENTS = 6         # instant of the connection update procedure
+    HOST_WRITE_TIME     = 0.0001    # host cost of queueing one write command
+    MIN_SLEEP           = 0.001     # shortest real sleep with time_scale
+
+    supports_send_complete = True
+
+    def __init__(self, target_mac, air, time_scale=0.0, tx_buffer_size=None):
+        self.target_mac = target_mac
+        self.air = air
+        self.time_scale = time_scale
+        self.tx_buffer_size = tx_buffer_size
+
+        self.device = None
+        self.link = LinkModel()
+        self.elapsed = 0.0
+        self.dropped = 0
+        self.lost = 0
+        self.notifications_enabled = False
+        self._notifications = collections.deque()
+        self._tx_queue = collections.deque()    # (time on air done, handle, data)
+        self._air_free_at = 0.0
+        self._completed = 0
+        self._sleep_due = 0.0
+
+    def _advance(self, seconds):
+        self.elapsed += seconds
+        if self.time_scale > 0:
+            # Short waits are added up: a sleep costs more than a packet's time
+            self._sleep_due += seconds * self.time_scale
+            if self._sleep_due >= self.MIN_SLEEP:
+                time.sleep(self._sleep_due)
+                self._sleep_due = 0.0
+
+    def _advance_to(self, timestamp):
+        if timestamp > self.elapsed:
+            self._advance(timestamp - self.elapsed)
+
+    def _deliver_until(self, timestamp):
+        while self._tx_queue and self._tx_queue[0][0] <= timestamp:
+            if not self._connected():
+                self._tx_queue.clear()
+                return
+            (_, handle, data) = self._tx_queue.popleft()
+            self._completed += 1
+            if self.air.lost(self.device):
+                self.lost += 1
+                continue
+            self._notify(self.device.write(handle, data))
+
+    def _flush(self):
+        if self._tx_queue:
+            self._advance_to(self._tx_queue[-1][0])
+            self._deliver_until(self.elapsed)
+
+    def _connected(self):
+        if self.device is None or not self.device.connected:
+            return False
+        if not self.air.in_range(self.device):
+            logging.debug(f"Simulated device {self.device.address} out of range")
+            self.device.connected = False
+            self.device.prn_counter = 0
+            return False
+        return True
+
+    def connect(self, timeout=2):
+        device = self.air.find(self.target_mac)
+        if device is None or device.connected or not self.air.in_range(device):
+            self._advance(timeout)
+            logging.warning(f"Timeout during connect to {self.target_mac}")
+            return False
+
+        self.link = LinkModel(CONSERVATIVE_CONNECTION)
+        self._advance(self.CONNECT_EVENTS * self.link.interval)
+        self.device = device
+        self.device.connected = True
+        self.notifications_enabled = False
+        self._notifications.clear()
+        self._air_free_at = self.elapsed
+        return True
+
+    def disconnect(self):
+        if self._connected():
+            self.device.connected = False
+        self.device = None
+        self._tx_queue.clear()
+        self._completed = 0
+
+    def set_target(self, target_mac):
+        self.disconnect()
+        self.target_mac = target_mac
+
+    def scan(self, addresses, timeout=1.0):
+        wanted = None if addresses is None else {address.upper() for address in addresses}
+        heard = [device for device in self.air.devices
+                 if not device.connected and self.air.in_range(device)
+                 and (wanted is None or device.advertised_address in wanted)]
+
+        # A few advertising intervals to hear every device, or the whole timeout
+        listen = max([3 * device.advertising_interval for device in heard] or [timeout])
+        self._advance(min(listen, timeout))
+        return {device.advertised_address: device.rssi for device in heard}
+
+    def find_characteristic(self, uuid, timeout=10):
+        if not self._connected():
+            self._advance(timeout)
+            return None
+
+        handles = self.device.characteristics.get(uuid)
+        if handles is None:
+            # gatttool waits for the whole timeout before giving up
+            self._advance(timeout)
+            return None
+
+        self._advance(self.DISCOVERY_EVENTS * self.link.interval)
+        return handles
+
+    def read_characteristic(self, uuid, timeout=10):
+        if not self._connected():
+            self._advance(timeout)
+            return None
+
+        self._flush()
+        self._advance(self.link.round_trip_time())
+        return self.device.read(uuid)
+
+    def write_request(self, handle, data, timeout=10):
+        if not self._connected():
+            self._advance(timeout)
+            return False
+
+        # Queued write commands leave before the request
+        self._flush()
+        self._advance(self.link.round_trip_time())
+
+        if handle == self.device.characteristics.get(UUID_CONTROL_POINT, (0, 0, None))[2]:
+            self.notifications_enabled = bytes(data)[:1] == b'\x01'
+            return True
+
+        self._notify(self.device.write(handle, data))
+        return True
+
+    def write_command(self, handle, data):
+        if not self._connected():
+            return
+
+        self._advance(self.HOST_WRITE_TIME)
+        self._deliver_until(self.elapsed)
+
+        if self.tx_buffer_size is not None and len(self._tx_queue) >= self.tx_buffer_size:
+            self.dropped += 1
+            return
+
+        self._air_free_at = max(self.elapsed, self._air_free_at) + self.link.write_command_time(len(data))
+        self._tx_queue.append((self._air_free_at, handle, bytes(data)))
+
+    def wait_for_send_complete(self, timeout=2):
+        if self._completed == 0 and self._tx_queue and self._tx_queue[0][0] <= self.elapsed + timeout:
+            self._advance_to(self._tx_queue[0][0])
+            self._deliver_until(self.elapsed)
+
+        completed = self._completed
+        self._completed = 0
+        return completed
+
+    def _notify(self, values):
+        if self.notifications_enabled:
+            self._notifications.extend(values)
+
+    def wait_for_notification(self, timeout=2):
+        deadline = self.elapsed + timeout
+        while not self._notifications and self._tx_queue and self._tx_queue[0][0] <= deadline:
+            self._advance_to(self._tx_queue[0][0])
+            self._deliver_until(self.elapsed)
+
+        if not self._notifications:
+            self._advance_to(deadline)
+            return None
+
+        self._advance(self.link.interval)
+        return self._notifications.popleft()
+
+    def is_alive(self):
+        return self._connected()
+
+    def read_rssi(self):
+        if not self._connected():
+            return None
+        return self.device.rssi
+
+    def request_connection_parameters(self, params):
+        if not self._connected():
+            return None
+
+        self._flush()
+        self._advance(self.PARAM_UPDATE_EVENTS * self.link.interval)
+
+        if params.interval_max < self.device.min_interval:
+            return None
+
+        achieved = params.replace(interval_min=max(params.interval_min, self.device.min_interval),
+                                  interval_max=max(params.interval_max, self.device.min_interval))
+        if params.phy == "2M" and not self.device.supports_2m:
+            achieved = achieved.replace(phy="1M")
+
+        self.link = LinkModel(achieved, self.link.max_packets_per_event)
+        return achieved
+
+    def clock(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self._advance(seconds)
+
+
+def crc32(data):
+    return binascii.crc32(bytes(data)) & 0xffffffff
@@ -0,0 +1,129 @@
+"""
+------------------------------------------------------------------------------
+ Per-session statistics, collected from the controller's events.
+------------------------------------------------------------------------------
+"""
+from ota_dfu_python.events import PhaseEvent, ObjectCommittedEvent, RetransmitEvent, ErrorEvent, RetryEvent, Phases
+
+
+class SessionStats(object):
+
+    # Events the stats subscribe to. Progress updates are deliberately left
+    # out so collecting stats costs nothing in the send loop.
+    EVENT_TYPES = (PhaseEvent, ObjectCommittedEvent, RetransmitEvent, ErrorEvent, RetryEvent)
+
+    def __init__(self):
+        self.image_size = 0
+        self.phase_started = {}
+        self.phase_durations = {}
+        self.current_phase = None
+        self.bytes_committed = 0
+        self.objects_committed = 0
+        self.retransmits = 0
+        self.write_stalls = 0
+        self.errors = []
+
+        # Attempts made, the failures that were retried and the time lost to
+        # them: work after the last committed object, plus the backoff
+        self.attempts = 1
+        self.retries = []
+        self.time_lost = 0.0
+
+        # Why the transfer was skipped, None if it was not
+        self.skipped = None
+
+        # Profiling report, if the session was profiled
+        self.profile = None
+
+        # Calibration profile applied, if any
+        self.calibration = None
+
+        # Name of the package sent (its variant when routed)
+        self.package = None
+
+        # Connection parameters requested/achieved for the image transfer
+        self.connection_requested = None
+        self.connection_achieved = None
+        self.connection_fallbacks = 0
+
+        # Adaptive timeout estimators by kind of wait, set by the controller
+        self.timeouts = {}
+
+        self._phase_entered = None
+        self._last_timestamp = None
+        self._last_commit = None
+
+    def __call__(self, event):
+        if isinstance(event, PhaseEvent):
+            self._close_phase(event.timestamp)
+            self.current_phase = event.phase
+            self._phase_entered = event.timestamp
+            self.phase_started.setdefault(event.phase, event.timestamp)
+        elif isinstance(event, ObjectCommittedEvent):
+            self.objects_committed += 1
+            self.bytes_committed = max(self.bytes_committed, event.offset + event.size)
+            self._last_commit = event.timestamp
+        elif isinstance(event, RetransmitEvent):
+            self.retransmits += 1
+        elif isinstance(event, ErrorEvent):
+            self.errors.append(str(event.error))
+        elif isinstance(event, RetryEvent):
+            attempt_start = event.timestamp - event.elapsed
+            progress = max(attempt_start, self._last_commit or attempt_start)
+            lost = event.timestamp - progress + event.delay
+            self.attempts += 1
+            self.time_lost += lost
+            self.retries.append({"attempt": event.attempt, "kind": event.kind, "error": str(event.error),
+                                 "elapsed": event.elapsed, "delay": event.delay, "lost": lost})
+        self._last_timestamp = event.timestamp
+
+    def _close_phase(self, timestamp):
+        if self.current_phase is None:
+            return
+        elapsed = timestamp - self._phase_entered
+        self.phase_durations[self.current_phase] = self.phase_durations.get(self.current_phase, 0.0) + elapsed
+
+    def record_connection(self, requested, achieved, fallbacks):
+        self.connection_requested = requested
+        self.connection_achieved = achieved
+        self.connection_fallbacks = fallbacks
+
+    @property
+    def duration(self):
+        if not self.phase_started or self._last_timestamp is None:
+            return 0.0
+        return self._last_timestamp - min(self.phase_started.values())
+
+    @property
+    def throughput(self):
+        """Image bytes per second during the image phase"""
+        duration = self.phase_durations.get(Phases.IMAGE, 0.0)
+        if duration <= 0:
+            return 0.0
+        return self.bytes_committed / duration
+
+    def as_dict(self):
+        return {
+            "image_size": self.image_size,
+            "duration": self.duration,
+            "phase_durations": dict(self.phase_durations),
+            "bytes_committed": self.bytes_committed,
+            "objects_committed": self.objects_committed,
+            "retransmits": self.retransmits,
+            "write_stalls": self.write_stalls,
+            "throughput": self.throughput,
+            "errors": list(self.errors),
+            "attempts": self.attempts,
+            "retries": list(self.retries),
+            "time_lost": self.time_lost,
+            "skipped": self.skipped,
+            "connection": {
+                "requested": self.connection_requested.as_dict() if self.connection_requested else None,
+                "achieved": self.connection_achieved.as_dict() if self.connection_achieved else None,
+                "fallbacks": self.connection_fallbacks,
+            },
+            "timeouts": {kind: estimator.as_dict() for kind, estimator in self.timeouts.items()},
+            "profile": self.profile,
+            "calibration": self.calibration,
+            "package": self.package,
+        }
@@ -0,0 +1,271 @@
+"""
+------------------------------------------------------------------------------
+ Opportunistic DFU of devices passing by.
+
+ Tracked assets only come within range now and then, so a campaign cannot
+ be a fixed list worked through in order. StreamingUpdater consumes a
+ stream of sightings (scan results, or JSON lines from another scanner),
+ queues a job for every device matching its address or name patterns and
+ starts a session as soon as a matching device that still needs the update
+ is heard well enough. Sessions send the image under an RssiGuard, which
+ gives way before a fading link drops. The bootloader keeps the objects it
+ executed and the job store records the offset, so the next sighting
+ resumes the transfer where it stopped instead of starting over.
+------------------------------------------------------------------------------
+"""
+import fnmatch
+import json
+import logging
+import threading
+import time
+
+from ota_dfu_python.addresses import offset_address
+from ota_dfu_python.jobs import JobStates
+from ota_dfu_python.retry import PreemptedError
+
+# Transports are built for an address; scanning does not connect to it
+SCAN_ADDRESS = "00:00:00:00:00:00"
+
+# Weakest RSSI (dBm) a session starts at, and how far below that the guard's
+# floor is by default: more than a link fades and recovers from moment to
+# moment, so sessions do not give way as soon as they start
+MIN_RSSI = -85
+RSSI_HYSTERESIS = 8
+
+
+class Sighting(object):
+    __slots__ = ("address", "rssi", "name", "timestamp")
+
+    def __init__(self, address, rssi=None, name=None, timestamp=None):
+        self.address = address.upper()
+        self.rssi = rssi
+        self.name = name
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "Sighting(%s, %r, %r)" % (self.address, self.rssi, self.name)
+
+
+def scan_sightings(transport, interval=2.0, stop=None):
+    """Sightings of every device transport hears, scanning `interval` seconds at a time until stop is set"""
+    while stop is None or not stop.is_set():
+        heard = transport.scan(None, interval)
+        if heard is None:
+            raise Exception("The transport cannot scan")
+        for address, rssi in heard.items():
+            yield Sighting(address, rssi)
+
+
+# ------------------------------------------------------------------------------
+#  Sightings from JSON lines, e.g. {"address": "C0:...", "rssi": -70, "name":
+#  "tag-12"}, as a gateway's own scanner might write them to a pipe
+# ------------------------------------------------------------------------------
+def read_sightings(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            yield Sighting(record["address"], record.get("rssi"), record.get("name"))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning("Ignoring sighting %r: %s", line, e)
+
+
+class RssiGuard(object):
+    """
+    Preempts a session (PreemptedError) whose link is fading: once its RSSI,
+    read every `interval` seconds and smoothed (EWMA, weight `smoothing`),
+    falls below `floor` dBm or more than `drop` dB below the best it was in
+    the session. Set as the controllers' link_guard. Transports that cannot
+    read the RSSI are never preempted. The floor defaults to RSSI_HYSTERESIS
+    below the MIN_RSSI sessions start at.
+    """
+
+    def __init__(self, floor=MIN_RSSI - RSSI_HYSTERESIS, drop=25, interval=1.0, smoothing=0.5):
+        self.floor = floor
+        self.drop = drop
+        self.interval = interval
+        self.smoothing = smoothing
+
+    def start(self, transport):
+        return RssiMonitor(self, transport)
+
+
+class RssiMonitor(object):
+    """The RssiGuard state of one session"""
+    __slots__ = ("guard", "transport", "rssi", "peak", "checked")
+
+    def __init__(self, guard, transport):
+        self.guard = guard
+        self.transport = transport
+        self.rssi = None
+        self.peak = None
+        self.checked = None
+
+    def check(self):
+        now = self.transport.clock()
+        if self.checked is not None and now - self.checked < self.guard.interval:
+            return
+        self.checked = now
+
+        rssi = self.transport.read_rssi()
+        if rssi is None:
+            return
+        if self.rssi is None:
+            self.rssi = float(rssi)
+        else:
+            self.rssi += self.guard.smoothing * (rssi - self.rssi)
+        self.peak = self.rssi if self.peak is None else max(self.peak, self.rssi)
+
+        if self.rssi < self.guard.floor:
+            raise PreemptedError("RSSI {:.0f} dBm below {} dBm".format(self.rssi, self.guard.floor))
+        if self.peak - self.rssi > self.guard.drop:
+            raise PreemptedError("RSSI {:.0f} dBm, {:.0f} dB below {:.0f} dBm".format(
+                self.rssi, self.peak - self.rssi, self.peak))
+
+
+class StreamingUpdater(object):
+    """
+    Runs a JobWorker's sessions for devices as they are sighted. A device
+    matching one of `patterns` (shell-style, against its address or name)
+    gets a job for the package on its first sighting. Sessions start while
+    the worker has a free slot (up to its concurrency) for devices sighted
+    within `max_age` seconds at `min_rssi` or better, resumed transfers
+    first, then the strongest. After a session that did not finish the
+    device waits `cooldown` seconds and for a fresh sighting. Devices whose
+    job is done, skipped or failed are left alone, also across runs with
+    the same job database.
+
+    Sightings of a bootloader (at an address learned in the worker's
+    address map, or the default offsets) count for its application.
+    `package_hash` is passed on to JobStore.add.
+    """
+
+    def __init__(self, worker, firmware_path, datfile_path, patterns=("*",), min_rssi=MIN_RSSI, max_age=10.0,
+                 cooldown=30.0, clock=time.monotonic, package_hash=None):
+        self.worker = worker
+        self.firmware_path = firmware_path
+        self.datfile_path = datfile_path
+        self.package_hash = package_hash
+        self.patterns = [pattern.upper() for pattern in patterns]
+        self.min_rssi = min_rssi
+        self.max_age = max_age
+        self.cooldown = cooldown
+        self.clock = clock
+
+        self.results = []
+        self.sightings = {}     # app address -> latest Sighting
+        self._jobs = {}         # app address -> job id
+        self._bootloaders = {}  # bootloader address -> app address
+        self._active = {}       # app address -> session thread
+        self._waiting = {}      # app address -> time the device may be tried again
+        self._finished = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def matches(self, sighting):
+        names = [sighting.address] + ([sighting.name.upper()] if sighting.name else [])
+        return any(fnmatch.fnmatchcase(name, pattern) for name in names for pattern in self.patterns)
+
+    def run(self, sightings):
+        """Update devices as `sightings` come in, until they end or stop() is called.
+        Returns per-session result dicts."""
+        self.worker.store.recover()
+        try:
+            for sighting in sightings:
+                self.observe(sighting)
+                self._start_due()
+                if self._stop.is_set():
+                    break
+        finally:
+            self._stop.set()
+            while True:
+                with self._lock:
+                    threads = list(self._active.values())
+                if not threads:
+                    break
+                for thread in threads:
+                    thread.join()
+        return self.results
+
+    def stop(self):
+        self._stop.set()
+
+    def observe(self, sighting):
+        with self._lock:
+            address = sighting.address
+            if address not in self._jobs:
+                address = self._bootloaders.get(address, address)
+            if address not in self._jobs:
+                if not self.matches(sighting):
+                    return
+                self._add(address)
+            self.sightings[address] = Sighting(address, sighting.rssi, sighting.name, self.clock())
+
+    def _add(self, address):
+        self._jobs[address] = self.worker.store.add(address, self.firmware_path, self.datfile_path,
+                                                   self.package_hash)
+        for offset in self.worker.address_map.offsets(address):
+            if offset != 0:
+                self._bootloaders[offset_address(address, offset)] = address
+        logging.info("Tracking %s (job %d)", address, self._jobs[address])
+
+    # --------------------------------------------------------------------------
+    #  Start sessions for the devices in range best worth it, while there
+    #  are free slots
+    # --------------------------------------------------------------------------
+    def _start_due(self):
+        with self._lock:
+            if self._stop.is_set():
+                return
+            free = self.worker.concurrency - len(self._active)
+            if free <= 0:
+                return
+
+            now = self.clock()
+            candidates = []
+            for address, sighting in self.sightings.items():
+                if address in self._active or address in self._finished or self._waiting.get(address, 0) > now:
+                    continue
+                if now - sighting.timestamp > self.max_age:
+                    continue
+                if sighting.rssi is not None and sighting.rssi < self.min_rssi:
+                    continue
+                job = self.worker.store.get(self._jobs[address])
+                if job.state != JobStates.PENDING:
+                    if job.state != JobStates.IN_PROGRESS:
+                        self._finished.add(address)
+                    continue
+                candidates.append((job.offset == 0, -(sighting.rssi if sighting.rssi is not None else self.min_rssi),
+                                   job.id, address))
+
+            for (_, _, job_id, address) in sorted(candidates)[:free]:
+                job = self.worker.store.take(job_id)
+                if job is None:
+                    continue
+                thread = threading.Thread(target=self._session, args=(job,), name=f"dfu-stream-{address}",
+                                          daemon=True)
+                self._active[address] = thread
+                thread.start()
+
+    def _session(self, job):
+        if job.offset:
+            logging.info("Resuming %s at offset %d", job.address, job.offset)
+        else:
+            logging.info("Updating %s", job.address)
+        result = {"state": JobStates.FAILED}
+        try:
+            result = self.worker.run_job(job)
+            result["resumed_from"] = job.offset
+        finally:
+            with self._lock:
+                del self._active[job.address]
+                self.results.append(result)
+                if result["state"] in (JobStates.DONE, JobStates.SKIPPED, JobStates.FAILED):
+                    self._finished.add(job.address)
+                else:
+                    # Wait for the device to be heard again after the session
+                    self._waiting[job.address] = self.clock() + self.cooldown
+                    self.sightings.pop(job.address, None)
+            self._start_due()
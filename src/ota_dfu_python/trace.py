@@ -0,0 +1,328 @@
+"""
+------------------------------------------------------------------------------
+ Record and replay of transport traffic.
+
+ RecordingTransport wraps any transport and writes every call (connect,
+ discovery, writes, notifications, connection updates, sleeps) with its
+ start time and duration to a compact binary trace. ReplayTransport plays
+ a trace back to a controller, with the original or scaled timing, so slow
+ field sessions can be reproduced offline and controller versions compared
+ on identical link behaviour.
+
+ Trace format: MAGIC, <B flags>, then records of
+   <B type> <f start> <f duration> <H payload length> <payload>
+ with times in seconds relative to the start of the recording. The flags
+ describe the recorded transport (FLAG_SEND_COMPLETE). Version 1 traces
+ have no flags and replay as a transport with send-complete events.
+------------------------------------------------------------------------------
+"""
+import bisect
+import logging
+import struct
+import time
+
+from ota_dfu_python.transport import Transport, ConnectionParameters
+
+MAGIC = b"DFUTRACE\x02"
+MAGIC_V1 = b"DFUTRACE\x01"
+
+FLAG_SEND_COMPLETE = 0x01
+
+HEADER = struct.Struct('<BffH')
+HANDLE = struct.Struct('<H')
+HANDLES = struct.Struct('<HHH')
+PARAMS = struct.Struct('<ffHHB')
+
+
+class Records:
+    CONNECT         = 1
+    DISCONNECT      = 2
+    SET_TARGET      = 3
+    FIND            = 4
+    WRITE_REQUEST   = 5
+    WRITE_COMMAND   = 6
+    NOTIFICATION    = 7
+    SEND_COMPLETE   = 8
+    CONN_PARAMS     = 9
+    SLEEP           = 10
+    READ            = 11
+    SCAN            = 12
+
+
+PHYS = ["1M", "2M", "Coded"]
+
+
+def _pack_params(params):
+    return PARAMS.pack(params.interval_min, params.interval_max, params.latency,
+                       params.supervision_timeout // 10, PHYS.index(params.phy))
+
+
+def _unpack_params(data):
+    (interval_min, interval_max, latency, timeout, phy) = PARAMS.unpack(data)
+    return ConnectionParameters(interval_min, interval_max, latency, timeout * 10, PHYS[phy])
+
+
+def _read_flags(f, path):
+    magic = f.read(len(MAGIC))
+    if magic == MAGIC_V1:
+        return FLAG_SEND_COMPLETE
+    flags = f.read(1)
+    if magic != MAGIC or not flags:
+        raise Exception("Not a DFU trace: {}".format(path))
+    return flags[0]
+
+
+def read_trace_flags(path):
+    """The FLAG_* bits of a trace file"""
+    with open(path, 'rb') as f:
+        return _read_flags(f, path)
+
+
+def read_trace(path):
+    """Yield (type, start, duration, payload) for each record of a trace file"""
+    with open(path, 'rb') as f:
+        _read_flags(f, path)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            (record, start, duration, length) = HEADER.unpack(header)
+            yield record, start, duration, f.read(length)
+
+
+class RecordingTransport(Transport):
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._file.write(bytes([FLAG_SEND_COMPLETE if transport.supports_send_complete else 0]))
+        self._epoch = transport.clock()
+
+    @property
+    def supports_send_complete(self):
+        return self.transport.supports_send_complete
+
+    def _record(self, record, start, payload=b''):
+        if self._file is None:
+            return
+        now = self.transport.clock()
+        self._file.write(HEADER.pack(record, start - self._epoch, now - start, len(payload)))
+        self._file.write(payload)
+
+    def close(self):
+        try:
+            self.transport.close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def connect(self, timeout=2):
+        start = self.transport.clock()
+        res = self.transport.connect(timeout)
+        self._record(Records.CONNECT, start, bytes([res]))
+        return res
+
+    def disconnect(self):
+        start = self.transport.clock()
+        self.transport.disconnect()
+        self._record(Records.DISCONNECT, start)
+        if self._file is not None:
+            self._file.flush()
+
+    def set_target(self, target_mac):
+        start = self.transport.clock()
+        self.transport.set_target(target_mac)
+        self._record(Records.SET_TARGET, start, target_mac.encode())
+
+    def scan(self, addresses, timeout=1.0):
+        start = self.transport.clock()
+        seen = self.transport.scan(addresses, timeout)
+        payload = b'\x00' if seen is None else b'\x01' + ",".join(seen).encode()
+        self._record(Records.SCAN, start, payload)
+        return seen
+
+    def find_characteristic(self, uuid, timeout=10):
+        start = self.transport.clock()
+        handles = self.transport.find_characteristic(uuid, timeout)
+        payload = uuid.encode()
+        if handles is not None:
+            payload = HANDLES.pack(*handles) + payload
+        self._record(Records.FIND, start, bytes([handles is not None]) + payload)
+        return handles
+
+    def read_characteristic(self, uuid, timeout=10):
+        start = self.transport.clock()
+        value = self.transport.read_characteristic(uuid, timeout)
+        self._record(Records.READ, start, b'\x00' if value is None else b'\x01' + value)
+        return value
+
+    def write_request(self, handle, data, timeout=10):
+        start = self.transport.clock()
+        res = self.transport.write_request(handle, data, timeout)
+        self._record(Records.WRITE_REQUEST, start, HANDLE.pack(handle) + bytes([res]) + bytes(data))
+        return res
+
+    def write_command(self, handle, data):
+        start = self.transport.clock()
+        self.transport.write_command(handle, data)
+        self._record(Records.WRITE_COMMAND, start, HANDLE.pack(handle) + bytes(data))
+
+    def wait_for_notification(self, timeout=2):
+        start = self.transport.clock()
+        value = self.transport.wait_for_notification(timeout)
+        # A leading flag byte tells a timeout from an empty notification
+        self._record(Records.NOTIFICATION, start, b'\x00' if value is None else b'\x01' + value)
+        return value
+
+    def wait_for_send_complete(self, timeout=2):
+        start = self.transport.clock()
+        completed = self.transport.wait_for_send_complete(timeout)
+        self._record(Records.SEND_COMPLETE, start, HANDLE.pack(min(completed, 0xffff)))
+        return completed
+
+    def request_connection_parameters(self, params):
+        start = self.transport.clock()
+        achieved = self.transport.request_connection_parameters(params)
+        payload = _pack_params(params)
+        if achieved is not None:
+            payload += _pack_params(achieved)
+        self._record(Records.CONN_PARAMS, start, payload)
+        return achieved
+
+    def is_alive(self):
+        return self.transport.is_alive()
+
+    def clock(self):
+        return self.transport.clock()
+
+    def sleep(self, seconds):
+        start = self.transport.clock()
+        self.transport.sleep(seconds)
+        self._record(Records.SLEEP, start)
+
+
+class ReplayTransport(Transport):
+    """
+    Answers a controller from a recorded trace. Each call consumes the next
+    record of its kind; records the controller no longer asks for are skipped
+    and counted in `divergences`, as are writes whose data differs from the
+    recording. Durations are multiplied by time_scale on a virtual clock;
+    with realtime=True the replay also sleeps for them. Send-complete events
+    are supported if the recorded transport supported them.
+    """
+
+    def __init__(self, path, time_scale=1.0, realtime=False):
+        self.path = path
+        self.time_scale = time_scale
+        self.realtime = realtime
+
+        self.supports_send_complete = bool(read_trace_flags(path) & FLAG_SEND_COMPLETE)
+        self.records = list(read_trace(path))
+        self.position = 0
+        self.elapsed = 0.0
+        self.divergences = 0
+
+        # Record type -> indexes of its records, to find the next one without
+        # scanning the rest of the trace
+        self._indexes = {}
+        for (i, (record, _, _, _)) in enumerate(self.records):
+            self._indexes.setdefault(record, []).append(i)
+
+    def _next(self, record):
+        indexes = self._indexes.get(record, ())
+        n = bisect.bisect_left(indexes, self.position)
+        if n == len(indexes):
+            return None
+
+        i = indexes[n]
+        skipped = i - self.position
+        if skipped:
+            self.divergences += skipped
+            logging.debug(f"Replay skipped {skipped} record(s) to find record type {record}")
+        self.position = i + 1
+        (_, _, duration, payload) = self.records[i]
+        self._advance(duration)
+        return payload
+
+    def _advance(self, duration):
+        duration *= self.time_scale
+        self.elapsed += duration
+        if self.realtime and duration > 0:
+            time.sleep(duration)
+
+    @property
+    def finished(self):
+        return self.position >= len(self.records)
+
+    def connect(self, timeout=2):
+        payload = self._next(Records.CONNECT)
+        return bool(payload and payload[0])
+
+    def disconnect(self):
+        self._next(Records.DISCONNECT)
+
+    def set_target(self, target_mac):
+        payload = self._next(Records.SET_TARGET)
+        if payload is not None and payload.decode() != target_mac:
+            self.divergences += 1
+
+    def scan(self, addresses, timeout=1.0):
+        payload = self._next(Records.SCAN)
+        if not payload or not payload[0]:
+            return None
+        return {address: None for address in payload[1:].decode().split(',') if address}
+
+    def find_characteristic(self, uuid, timeout=10):
+        payload = self._next(Records.FIND)
+        if payload is None or not payload[0]:
+            return None
+        return HANDLES.unpack_from(payload, 1)
+
+    def read_characteristic(self, uuid, timeout=10):
+        payload = self._next(Records.READ)
+        if not payload or not payload[0]:
+            return None
+        return payload[1:]
+
+    def write_request(self, handle, data, timeout=10):
+        payload = self._next(Records.WRITE_REQUEST)
+        if payload is None:
+            return False
+        if HANDLE.unpack_from(payload)[0] != handle or payload[3:] != bytes(data):
+            self.divergences += 1
+        return bool(payload[2])
+
+    def write_command(self, handle, data):
+        payload = self._next(Records.WRITE_COMMAND)
+        if payload is not None and payload[2:] != bytes(data):
+            self.divergences += 1
+
+    def wait_for_notification(self, timeout=2):
+        payload = self._next(Records.NOTIFICATION)
+        if not payload or not payload[0]:
+            return None
+        return payload[1:]
+
+    def wait_for_send_complete(self, timeout=2):
+        payload = self._next(Records.SEND_COMPLETE)
+        if payload is None:
+            return 0
+        return HANDLE.unpack(payload)[0]
+
+    def request_connection_parameters(self, params):
+        payload = self._next(Records.CONN_PARAMS)
+        if payload is None or len(payload) < 2 * PARAMS.size:
+            return None
+        return _unpack_params(payload[PARAMS.size:])
+
+    def is_alive(self):
+        return not self.finished
+
+    def clock(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self._next(Records.SLEEP)
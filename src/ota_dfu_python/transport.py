@@ -0,0 +1,699 @@
+"""
+------------------------------------------------------------------------------
+ BLE transports used by the DFU controllers.
+
+ A transport owns the link to one peripheral: connecting, GATT handle
+ discovery, characteristic writes and notifications. The controllers only
+ speak the DFU protocol on top of it.
+------------------------------------------------------------------------------
+"""
+import binascii
+import logging
+import re
+import struct
+import time
+
+from abc import ABCMeta, abstractmethod
+
+from ota_dfu_python import resources
+from ota_dfu_python.util import array_to_hex_string
+
+
+class ConnectionParameters(object):
+    """Connection interval/timeout in milliseconds, PHY as "1M", "2M" or "Coded" (as read back) """
+    __slots__ = ("interval_min", "interval_max", "latency", "supervision_timeout", "phy")
+
+    def __init__(self, interval_min, interval_max, latency=0, supervision_timeout=4000, phy="1M"):
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.latency = latency
+        self.supervision_timeout = supervision_timeout
+        self.phy = phy
+
+    def replace(self, **kwargs):
+        values = self.as_dict()
+        values.update(kwargs)
+        return ConnectionParameters(**values)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, ConnectionParameters) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return "ConnectionParameters(%s)" % ", ".join("%s=%r" % item for item in self.as_dict().items())
+
+
+# Requested for the image transfer, in order of preference
+FAST_CONNECTION_CANDIDATES = [
+    ConnectionParameters(7.5, 15, phy="2M"),
+    ConnectionParameters(7.5, 15, phy="1M"),
+    ConnectionParameters(15, 30, phy="1M"),
+]
+
+# Restored once the transfer is over
+CONSERVATIVE_CONNECTION = ConnectionParameters(30, 50, phy="1M")
+
+
+class CreditWindow(object):
+    """
+    Write commands in flight, bounded by a window of credits. A credit is
+    consumed per write command and returned when the transport reports the
+    packet sent, or all at once when the peripheral answers on the control
+    point (which it only does after processing everything sent before).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.outstanding = 0
+        self.stalls = 0
+
+    def full(self):
+        return self.size is not None and self.outstanding >= self.size
+
+    def consume(self):
+        self.outstanding += 1
+
+    def release(self, count=None):
+        if count is None:
+            self.outstanding = 0
+        else:
+            self.outstanding = max(0, self.outstanding - count)
+
+
+class RttEstimator(object):
+    """
+    Timeout for one kind of wait, derived from measured round trip times the
+    way TCP computes its retransmission timeout (RFC 6298): the smoothed RTT
+    plus four times its variation, kept between floor and ceiling. Until the
+    first sample the initial value is used. Each expired wait doubles the
+    timeout until the next sample.
+    """
+
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+    K = 4
+
+    def __init__(self, initial, floor, ceiling):
+        self.initial = initial
+        self.floor = floor
+        self.ceiling = ceiling
+
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.samples = 0
+        self.expirations = 0
+        self.max_timeout = 0.0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+        self.backoff = 1
+
+    def expired(self):
+        self.expirations += 1
+        self.backoff = min(self.backoff * 2, 64)
+
+    def _estimate(self):
+        if self.srtt is None:
+            return self.initial
+        return self.srtt + self.K * self.rttvar
+
+    def timeout(self):
+        value = min(max(self._estimate() * self.backoff, self.floor), self.ceiling)
+        self.max_timeout = max(self.max_timeout, value)
+        return value
+
+    def as_dict(self):
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "timeout": min(max(self._estimate(), self.floor), self.ceiling),
+            "max_timeout": self.max_timeout,
+            "samples": self.samples,
+            "expirations": self.expirations,
+        }
+
+
+class Transport(object, metaclass=ABCMeta):
+
+    # Whether wait_for_send_complete() reports packets leaving the local
+    # controller. Without it flow control can only rely on PRN notifications.
+    supports_send_complete = False
+
+    # --------------------------------------------------------------------------
+    #  Connect to the current target address.
+    #  Returns True if a connection was established, False otherwise
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def connect(self, timeout=2):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Drop the connection and release the underlying resources
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def disconnect(self):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Point the transport at a new address (e.g. the bootloader address).
+    #  Any existing connection is dropped.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def set_target(self, target_mac):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Listen for advertisements from any of the given addresses (any
+    #  device with None). Returns a dict {address: rssi or None} of those
+    #  heard within the timeout, or None if the transport cannot scan.
+    # --------------------------------------------------------------------------
+    def scan(self, addresses, timeout=1.0):
+        return None
+
+    # --------------------------------------------------------------------------
+    #  RSSI of the current connection in dBm, or None if not connected or
+    #  the transport cannot tell
+    # --------------------------------------------------------------------------
+    def read_rssi(self):
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Fetch handles for a given UUID.
+    #  Returns a three-tuple (char handle, value handle, CCCD handle) or
+    #  None if the characteristic was not found within the timeout.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def find_characteristic(self, uuid, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Read a characteristic by UUID. Returns its value as bytes, or None if
+    #  it is not present or the transport cannot read.
+    # --------------------------------------------------------------------------
+    def read_characteristic(self, uuid, timeout=10):
+        return None
+
+    # --------------------------------------------------------------------------
+    #  Write with response. Returns True once the write was acknowledged.
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def write_request(self, handle, data, timeout=10):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Write without response
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def write_command(self, handle, data):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Wait for a notification. Returns its value as bytes or None on timeout
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def wait_for_notification(self, timeout=2):
+        pass
+
+    # --------------------------------------------------------------------------
+    #  Block until write commands have left the local controller. Returns the
+    #  number of packets completed since the last call (0 on timeout).
+    # --------------------------------------------------------------------------
+    def wait_for_send_complete(self, timeout=2):
+        return 0
+
+    # --------------------------------------------------------------------------
+    #  Ask for new connection parameters. Returns the ConnectionParameters in
+    #  effect afterwards, or None if the request was rejected altogether.
+    # --------------------------------------------------------------------------
+    def request_connection_parameters(self, params):
+        return None
+
+    def is_alive(self):
+        return True
+
+    # --------------------------------------------------------------------------
+    #  Disconnect and release everything the transport holds, for good. Also
+    #  called when it is used as a context manager.
+    # --------------------------------------------------------------------------
+    def close(self):
+        self.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Time source and sleep, overridden by transports with a simulated clock
+    def clock(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+def _close_child(child):
+    # Also waits for the process, so it does not linger as a zombie
+    child.close(force=True)
+
+
+class HcitoolSupport(object):
+    """
+    Scanning and connection parameter updates through hcitool, for
+    transports without a way of their own. Needs target_mac and adapter.
+    """
+
+    PHY_MASK = {"1M": 0x01, "2M": 0x02, "Coded": 0x04}
+
+    # --------------------------------------------------------------------------
+    #  Scan with hcitool for the whole timeout. Its output is block buffered
+    #  on a pipe, so it is read once hcitool exits (SIGINT, which also turns
+    #  scanning off again). Needs the privileges hcitool lescan needs.
+    # --------------------------------------------------------------------------
+    def scan(self, addresses, timeout=1.0):
+        import signal
+        import subprocess
+
+        cmd = ["hcitool"]
+        if self.adapter is not None:
+            cmd += ["-i", self.adapter]
+        cmd += ["lescan", "--duplicates"]
+
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError as e:
+            logging.debug(f"hcitool lescan failed: {e}")
+            return None
+
+        # Leaving the block closes the pipes and waits for hcitool
+        with proc:
+            try:
+                try:
+                    proc.wait(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    proc.send_signal(signal.SIGINT)
+
+                try:
+                    output, errors = proc.communicate(timeout=2)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    output, errors = proc.communicate()
+            except BaseException:
+                proc.kill()
+                raise
+
+        if proc.returncode not in (0, -signal.SIGINT):
+            logging.debug(f"hcitool lescan failed: {errors.strip()}")
+            return None
+
+        wanted = None if addresses is None else {address.upper() for address in addresses}
+        seen = {}
+        for line in output.splitlines():
+            address = line.split(' ', 1)[0].upper()
+            if re.match(r'([0-9A-F]{2}:){5}[0-9A-F]{2}$', address) and (wanted is None or address in wanted):
+                seen[address] = None
+        return seen
+
+    # --------------------------------------------------------------------------
+    #  HCI Read RSSI on the connection handle. The Command Complete event
+    #  carries the command's opcode, status, handle and the RSSI (int8).
+    # --------------------------------------------------------------------------
+    def read_rssi(self):
+        conn_handle = self._connection_handle()
+        if conn_handle is None:
+            return None
+
+        values = self._command_complete(self._hcitool("cmd", "0x05", "0x0005", *self._handle_args(conn_handle)))
+        if values is None or len(values) < 7 or values[3] != 0:
+            return None
+        return values[6] - 256 if values[6] > 127 else values[6]
+
+    # --------------------------------------------------------------------------
+    #  The update is requested through hcitool on the connection handle
+    #  BlueZ assigned. hcitool only reports that the controller accepted the
+    #  commands, so what the link ended up with is read back: the interval
+    #  from the LE Connection Update Complete event (on a raw HCI socket,
+    #  which needs the privileges hcitool lecup needs anyway) and the PHY
+    #  with LE Read PHY. An update that cannot be confirmed counts as
+    #  rejected.
+    # --------------------------------------------------------------------------
+    def request_connection_parameters(self, params):
+        conn_handle = self._connection_handle()
+        if conn_handle is None:
+            logging.debug("No HCI connection handle, cannot update connection parameters")
+            return None
+
+        events = self._le_events()
+        if events is None:
+            return None
+        try:
+            output = self._hcitool("lecup", "--handle", str(conn_handle),
+                                   "--min", str(int(round(params.interval_min / 1.25))),
+                                   "--max", str(int(round(params.interval_max / 1.25))),
+                                   "--latency", str(params.latency),
+                                   "--timeout", str(int(params.supervision_timeout / 10)))
+            if output is None:
+                return None
+
+            # Status, handle, interval (1.25 ms), latency, supervision timeout (10 ms)
+            update = self._wait_le_event(events, self.LE_CONNECTION_UPDATE_COMPLETE, conn_handle)
+            if update is None or update[0] != 0 or len(update) < 9:
+                logging.debug("Connection parameter update not completed")
+                return None
+            (interval, latency, timeout) = struct.unpack_from('<HHH', bytes(update), 3)
+
+            if params.phy != "1M":
+                # HCI LE Set PHY: handle, all_phys, tx_phys, rx_phys, phy_options
+                mask = "0x%02x" % self.PHY_MASK[params.phy]
+                output = self._hcitool("cmd", "0x08", "0x0032", *self._handle_args(conn_handle),
+                                       "0x00", mask, mask, "0x00", "0x00")
+                status = re.search(r'HCI Event: 0x0f plen \d+\s+([0-9A-Fa-f]{2})', output or "")
+                if status is not None and int(status.group(1), 16) == 0:
+                    self._wait_le_event(events, self.LE_PHY_UPDATE_COMPLETE, conn_handle)
+                else:
+                    logging.debug(f"PHY update to {params.phy} rejected")
+        finally:
+            events.close()
+
+        return ConnectionParameters(interval * 1.25, interval * 1.25, latency, timeout * 10,
+                                    self._read_phy(conn_handle))
+
+    # LE Meta event subevents
+    LE_CONNECTION_UPDATE_COMPLETE = 0x03
+    LE_PHY_UPDATE_COMPLETE        = 0x0c
+
+    PHYS = {0x01: "1M", 0x02: "2M", 0x03: "Coded"}
+
+    def _read_phy(self, conn_handle):
+        """PHY the link transmits on, from HCI LE Read PHY. Assumes 1M if it cannot be read."""
+        values = self._command_complete(self._hcitool("cmd", "0x08", "0x0030", *self._handle_args(conn_handle)))
+        if values is None or len(values) < 7 or values[3] != 0:
+            return "1M"
+        return self.PHYS.get(values[6], "1M")
+
+    @staticmethod
+    def _handle_args(conn_handle):
+        return ("0x%02x" % (conn_handle & 0xff), "0x%02x" % (conn_handle >> 8))
+
+    @staticmethod
+    def _command_complete(output):
+        """Parameters of the Command Complete event hcitool cmd printed, None if there is none"""
+        event = re.search(r'HCI Event: 0x0e plen \d+\s+((?:[0-9A-Fa-f]{2}\s*)+)', output or "")
+        if event is None:
+            return None
+        return [int(value, 16) for value in event.group(1).split()]
+
+    # --------------------------------------------------------------------------
+    #  A raw HCI socket on the adapter receiving LE Meta events, or None if it
+    #  cannot be opened (no privileges, or no Bluetooth sockets)
+    # --------------------------------------------------------------------------
+    def _le_events(self):
+        import socket
+
+        try:
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        except (AttributeError, OSError) as e:
+            logging.debug(f"No HCI socket for connection events: {e}")
+            return None
+        try:
+            # SOL_HCI, HCI_FILTER: event packets (type 0x04), LE Meta event (0x3e) only
+            sock.setsockopt(0, 2, struct.pack('<IIIH2x', 1 << 0x04, 0, 1 << (0x3e - 32), 0))
+            sock.bind((int((self.adapter or "hci0")[3:]),))
+        except (OSError, ValueError, TypeError) as e:
+            logging.debug(f"No HCI socket for connection events: {e}")
+            sock.close()
+            return None
+        return sock
+
+    def _wait_le_event(self, sock, subevent, conn_handle, timeout=2.0):
+        """Parameters (from the status on) of the next LE Meta subevent for the connection, None on timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+            try:
+                packet = sock.recv(260)
+            except OSError:
+                return None
+            # Packet type, event code, length, subevent, status, handle
+            if len(packet) < 7 or packet[3] != subevent:
+                continue
+            if struct.unpack_from('<H', packet, 5)[0] & 0x0fff == conn_handle:
+                return list(packet[4:])
+
+    def _connection_handle(self):
+        output = self._hcitool("con")
+        if output is None:
+            return None
+
+        match = re.search(r'LE %s handle (\d+)' % re.escape(self.target_mac.upper()), output)
+        if match is None:
+            return None
+
+        return int(match.group(1))
+
+    def _hcitool(self, *args):
+        import subprocess
+
+        cmd = ["hcitool"]
+        if self.adapter is not None:
+            cmd += ["-i", self.adapter]
+        cmd += list(args)
+
+        try:
+            res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=5, universal_newlines=True)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.debug(f"hcitool {args[0]} failed: {e}")
+            return None
+
+        if res.returncode != 0:
+            logging.debug(f"hcitool {args[0]} failed: {res.stderr.strip()}")
+            return None
+
+        return res.stdout
+
+
+class HcitoolScanner(HcitoolSupport):
+    """Scanning through hcitool alone, without a connection or gatttool"""
+
+    def __init__(self, adapter=None):
+        self.target_mac = None
+        self.adapter = adapter
+
+    def close(self):
+        pass
+
+
+class GatttoolTransport(HcitoolSupport, Transport):
+    """
+    Drives BlueZ' interactive gatttool through pexpect.
+
+    Write commands are queued and sent to gatttool's terminal in one write
+    (of up to write_batch_size bytes) before the next request, read or
+    notification wait, so a whole PRN window costs one syscall. 0 sends
+    every command on its own. gatttool echoes each command line back;
+    expect only searches the last search_window bytes of its buffer, so the
+    echoes are not scanned again on every read (None searches everything).
+    """
+
+    def __init__(self, target_mac, adapter=None, write_batch_size=2048, search_window=4096):
+        # pexpect is only needed once a gatttool session is actually started
+        import pexpect
+
+        self.pexpect = pexpect
+        self.target_mac = target_mac
+        self.adapter = adapter
+        self.write_batch_size = write_batch_size
+        self.search_window = search_window
+        self._link_lost = False
+        self._child = None
+        self._pending = []
+        self._pending_size = 0
+        self._command_prefixes = {}
+        self._spawn()
+
+    def _spawn(self):
+        if self._child is not None:
+            self._child.release()
+
+        cmd = "gatttool -b '%s' -t random --interactive" % self.target_mac
+        if self.adapter is not None:
+            cmd += " -i %s" % self.adapter
+        # Matches end in the newest read (at most maxread bytes), which the
+        # search window must cover
+        self.ble_conn = self.pexpect.spawn(cmd, searchwindowsize=self.search_window)
+        self.ble_conn.delaybeforesend = 0
+        self._child = resources.track(self, "gatttool", _close_child, self.ble_conn)
+        self._discard_pending()
+
+    def _flush(self):
+        """Send the queued write commands"""
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._discard_pending()
+        self.ble_conn.send(data)
+
+    def _discard_pending(self):
+        self._pending = []
+        self._pending_size = 0
+
+    def connect(self, timeout=2):
+        # After a disconnect (e.g. between retries) start a fresh gatttool
+        if not self.ble_conn.isalive():
+            self._spawn()
+        self._link_lost = False
+        self._discard_pending()
+
+        try:
+            self.ble_conn.expect(r'\[LE\]>', timeout=timeout)
+        except self.pexpect.TIMEOUT as e:
+            logging.warning(f"Timeout during scan: {e}")
+            return False
+
+        self.ble_conn.sendline('connect')
+
+        try:
+            res = self.ble_conn.expect('.*Connection successful.*', timeout=timeout)
+        except self.pexpect.TIMEOUT as e:
+            logging.warning(f"Timeout during connect: {e}")
+            return False
+
+        return True
+
+    def disconnect(self):
+        # Nothing queued is worth sending on a link being dropped
+        self._discard_pending()
+        if self.ble_conn.isalive():
+            try:
+                self.ble_conn.sendline('exit')
+            except OSError as e:
+                logging.debug(f"gatttool exit failed: {e}")
+        self._child.release()
+
+    def set_target(self, target_mac):
+        self.target_mac = target_mac
+
+        # Re-start gatttool with the new address
+        self.disconnect()
+        self._spawn()
+
+    def find_characteristic(self, uuid, timeout=10):
+        self._flush()
+        self.ble_conn.before = ""
+        self.ble_conn.sendline('characteristics')
+
+        try:
+            self.ble_conn.expect([uuid], timeout=timeout)
+        except self.pexpect.TIMEOUT as e:
+            return None
+
+        handles = re.findall(b'.*handle: (0x....),.*char value handle: (0x....)', self.ble_conn.before)
+        (handle, value_handle) = handles[-1]
+
+        return (int(handle, 16), int(value_handle, 16), int(value_handle, 16)+1)
+
+    # --------------------------------------------------------------------------
+    #  Example format: "handle: 0x0016 	 value: 31 2e 30 2e 30"
+    # --------------------------------------------------------------------------
+    def read_characteristic(self, uuid, timeout=10):
+        self._flush()
+        self.ble_conn.sendline('char-read-uuid %s' % uuid)
+
+        try:
+            res = self.ble_conn.expect([r'handle: 0x[0-9a-fA-F]+\s+value: ([0-9a-fA-F ]*?)\s*\r\n',
+                                        'Read characteristics by UUID failed'], timeout=timeout)
+        except self.pexpect.TIMEOUT as e:
+            logging.debug(f"Timeout reading {uuid}: {e}")
+            return None
+
+        if res != 0:
+            return None
+
+        return bytes.fromhex(self.ble_conn.match.group(1).decode('UTF-8').replace(' ', ''))
+
+    def write_request(self, handle, data, timeout=10):
+        cmd = 'char-write-req 0x%04x %s' % (handle, array_to_hex_string(data))
+
+        logging.debug(f"Sending command {cmd}")
+
+        self._flush()
+        self.ble_conn.sendline(cmd)
+
+        # Verify that command was successfully written. The pattern must not
+        # extend past the confirmation: pexpect matches with DOTALL, so a
+        # trailing '.*' would swallow notifications already in the buffer.
+        try:
+            res = self.ble_conn.expect('Characteristic value was written successfully', timeout=timeout)
+        except self.pexpect.TIMEOUT as e:
+            logging.error(f"State timeout when writing characteristic: {e}")
+            return False
+
+        return True
+
+    def write_command(self, handle, data):
+        prefix = self._command_prefixes.get(handle)
+        if prefix is None:
+            prefix = self._command_prefixes[handle] = b'char-write-cmd 0x%04x ' % handle
+        line = prefix + binascii.hexlify(bytes(data)) + b'\n'
+
+        if not self.write_batch_size:
+            self.ble_conn.send(line)
+            return
+
+        self._pending.append(line)
+        self._pending_size += len(line)
+        if self._pending_size >= self.write_batch_size:
+            self._flush()
+
+    # --------------------------------------------------------------------------
+    #  Example format: "Notification handle = 0x0019 value: 10 01 01"
+    # --------------------------------------------------------------------------
+    def wait_for_notification(self, timeout=2):
+        if not self.ble_conn.isalive():
+            logging.warning("Connection not alive")
+            return None
+
+        try:
+            self._flush()
+        except OSError as e:
+            logging.warning(f"Writing to gatttool failed: {e}")
+            self._link_lost = True
+            return None
+
+        try:
+            self.ble_conn.expect('Notification handle = .*? \r\n', timeout=timeout)
+
+        except self.pexpect.TIMEOUT as e:
+            #
+            # The gatttool does not report link-lost directly.
+            # The only way found to detect it is monitoring the prompt '[CON]'
+            # and if it goes to '[   ]' this indicates the connection has
+            # been broken.
+            # In order to get a updated prompt string, issue an empty
+            # sendline('').  If it contains the '[   ]' string, the link
+            # has been lost.
+            #
+            self.ble_conn.sendline('')
+            string = self.ble_conn.before
+            if '[   ]' in str(string):
+                logging.warning('Connection lost!')
+                self._link_lost = True
+            return None
+
+        hxstr = self.ble_conn.after.split()[3:]
+        return bytes.fromhex(b''.join(hxstr[2:]).decode('UTF-8'))
+
+    def is_alive(self):
+        return self.ble_conn.isalive() and not self._link_lost
@@ -8,7 +8,22 @@ import re
 
 from os.path  import basename
 
+from ota_dfu_python import resources
+
 class Unpacker(object):
+   """
+   Unpacks DFU zip packages into temporary directories, removed by delete(),
+   on leaving a with block, or at the latest once the Unpacker is collected.
+   """
+   def __init__(self):
+       self._dirs = []
+
+   def __enter__(self):
+       return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+       self.delete()
+
    #--------------------------------------------------------------------------
    # 
    #--------------------------------------------------------------------------
@@ -24,15 +39,16 @@ class Unpacker(object):
             raise Exception("Error: file, not found!")
 
         # Create unique working direction into which the zip file is expanded
-        self.unzip_dir = "{0}/{1}_{2}".format(tempfile.gettempdir(), os.path.splitext(basename(file))[0], self.entropy(6))
+        self.unzip_dir = tempfile.mkdtemp(prefix="{0}_".format(os.path.splitext(basename(file))[0]))
+        self._dirs.append(resources.track(self, "package directory", shutil.rmtree, self.unzip_dir, True))
 
         datfilename = ""
         binfilename = ""
 
         with zipfile.ZipFile(file, 'r') as zip:
             files = [item.filename for item in zip.infolist()]
-            datfilename = [m.group(0) for f in files for m in [re.search('.*\.dat', f)] if m].pop()
-            binfilename = [m.group(0) for f in files for m in [re.search('.*\.bin', f)] if m].pop()
+            datfilename = [m.group(0) for f in files for m in [re.search(r'.*\.dat', f)] if m].pop()
+            binfilename = [m.group(0) for f in files for m in [re.search(r'.*\.bin', f)] if m].pop()
 
             zip.extractall(r'{0}'.format(self.unzip_dir))
 
@@ -48,5 +64,7 @@ class Unpacker(object):
    # 
    #--------------------------------------------------------------------------
    def delete(self):
-       # delete self.unzip_dir and its contents
-       shutil.rmtree(self.unzip_dir)
+       # delete the unpacked directories and their contents
+       for directory in self._dirs:
+           directory.release()
+       self._dirs = []
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def _varint(value):
+    out = b''
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out += bytes([byte | 0x80])
+        else:
+            return out + bytes([byte])
+
+
+def _field(number, wire_type, payload):
+    key = _varint(number << 3 | wire_type)
+    if wire_type == 0:
+        return key + _varint(payload)
+    return key + _varint(len(payload)) + payload
+
+
+def init_packet(image, hw_version=52, sd_req=(0xB7,), fw_type=0, signed=True):
+    """An application init packet for image as nrfutil writes it (the signature is not checked)"""
+    digest = hashlib.sha256(image).digest()[::-1]
+    init = (_field(1, 0, 1) + _field(2, 0, hw_version) + _field(3, 2, b''.join(_varint(sd) for sd in sd_req))
+            + _field(4, 0, fw_type) + _field(7, 0, len(image)) + _field(8, 2, _field(1, 0, 3) + _field(2, 2, digest)))
+    command = _field(1, 0, 1) + _field(2, 2, init)
+    if not signed:
+        return _field(1, 2, command)
+    return _field(2, 2, _field(1, 2, command) + _field(2, 0, 0) + _field(3, 2, b'\x11' * 64))
+
+
+@pytest.fixture
+def make_init_packet():
+    return init_packet
+
+
+@pytest.fixture
+def package(tmp_path):
+    """(firmware path, init packet path) of a 10 kB application"""
+    image = bytes(random.Random(1).getrandbits(8) for _ in range(10000))
+    binfile = tmp_path / "app.bin"
+    datfile = tmp_path / "app.dat"
+    binfile.write_bytes(image)
+    datfile.write_bytes(init_packet(image))
+    return str(binfile), str(datfile)
@@ -0,0 +1,55 @@
+import struct
+
+import pytest
+
+from ota_dfu_python.codec import (ChecksumResponse, CodecError, DfuResponseError, ExtendedErrors, Procedures, Response,
+                                  Results, SelectResponse, decode_response, encode_create, encode_select,
+                                  encode_set_prn)
+
+
+def response(opcode, result=Results.SUCCESS, payload=b''):
+    return bytes([Procedures.RESPONSE, opcode, result]) + payload
+
+
+def test_requests():
+    assert encode_create(Procedures.PARAM_DATA, 4096) == b'\x01\x02\x00\x10\x00\x00'
+    assert encode_set_prn(12) == b'\x02\x0c\x00'
+    assert encode_select(Procedures.PARAM_COMMAND) == b'\x06\x01'
+
+
+def test_select_round_trip():
+    decoded = decode_response(response(Procedures.SELECT, payload=struct.pack('<III', 4096, 8192, 0xdeadbeef)))
+    assert isinstance(decoded, SelectResponse)
+    assert decoded.success
+    assert (decoded.max_size, decoded.offset, decoded.crc32) == (4096, 8192, 0xdeadbeef)
+
+
+def test_checksum_ignores_trailing_bytes():
+    decoded = decode_response(response(Procedures.CALC_CHECKSUM, payload=struct.pack('<II', 100, 7) + b'\x00'))
+    assert isinstance(decoded, ChecksumResponse)
+    assert (decoded.offset, decoded.crc32) == (100, 7)
+
+
+def test_extended_error():
+    decoded = decode_response(response(Procedures.EXECUTE, Results.EXT_ERROR, bytes([ExtendedErrors.HASH_FAILED])))
+    assert not decoded.success
+    assert decoded.extended_error == ExtendedErrors.HASH_FAILED
+    assert decoded.error_string() == "EXTENDED_ERROR (HASH_FAILED)"
+    assert "EXECUTE" in str(DfuResponseError(decoded))
+
+
+def test_unknown_opcode_and_result():
+    decoded = decode_response(response(0x42, payload=b'\x01\x02'))
+    assert type(decoded) is Response
+    assert decoded.success
+    assert "UNKNOWN(0x42)" in repr(decoded)
+
+    decoded = decode_response(response(Procedures.CREATE, 0x33))
+    assert not decoded.success
+    assert decoded.error_string() == "UNKNOWN(0x33)"
+
+
+@pytest.mark.parametrize("data", [b'', b'\x60\x06', b'\x01\x06\x01', response(Procedures.SELECT, payload=b'\x00' * 11)])
+def test_malformed(data):
+    with pytest.raises(CodecError):
+        decode_response(data)
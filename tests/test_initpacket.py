@@ -0,0 +1,71 @@
+import hashlib
+
+import pytest
+
+from ota_dfu_python.initpacket import (FwTypes, HashTypes, InitPacketError, SD_REQ_ANY, decode_init_packet,
+                                       load_init_packet, validate_package)
+
+
+def test_decode(make_init_packet):
+    image = b'\x5a' * 1000
+    packet = decode_init_packet(make_init_packet(image, hw_version=52, sd_req=(0xB7, 0x101)))
+    assert packet.signed
+    assert packet.fw_version == 1
+    assert packet.hw_version == 52
+    assert packet.sd_req == [0xB7, 0x101]
+    assert packet.fw_type == FwTypes.APPLICATION
+    assert packet.image_size == 1000
+    assert packet.hash_type == HashTypes.SHA256
+    assert packet.hash == hashlib.sha256(image).digest()[::-1]
+
+
+def test_decode_unsigned(make_init_packet):
+    packet = decode_init_packet(make_init_packet(b'\x00' * 10, signed=False))
+    assert not packet.signed
+    assert packet.image_size == 10
+
+
+@pytest.mark.parametrize("data", [b'', b'\x08\x01', b'\x12\x05\x0a\x03', b'\x12\x02\x0a\x80', b'\x0b'])
+def test_decode_malformed(data):
+    with pytest.raises(InitPacketError):
+        decode_init_packet(data)
+
+
+def test_validate(package):
+    (binfile, datfile) = package
+    with open(binfile, 'rb') as f:
+        image = f.read()
+    packet = validate_package(datfile, binfile, image, hw_version=52, sd_version=0xB7)
+    assert packet == load_init_packet(datfile)
+
+
+@pytest.mark.parametrize("options, problem", [
+    ({"hw_version": 53}, "hw_version 52"),
+    ({"sd_version": 0x100}, "SoftDevice 0x00b7"),
+])
+def test_validate_device_mismatch(package, options, problem):
+    (binfile, datfile) = package
+    with open(binfile, 'rb') as f:
+        image = f.read()
+    with pytest.raises(InitPacketError, match=problem):
+        validate_package(datfile, binfile, image, **options)
+
+
+def test_validate_image_mismatch(tmp_path, make_init_packet):
+    binfile = tmp_path / "app.bin"
+    datfile = tmp_path / "app.dat"
+    binfile.write_bytes(b'\x01' * 100)
+    datfile.write_bytes(make_init_packet(b'\x02' * 99))
+    with pytest.raises(InitPacketError) as error:
+        validate_package(str(datfile), str(binfile), b'\x01' * 100)
+    assert "describes 99 bytes" in str(error.value)
+    assert "SHA-256" in str(error.value)
+
+
+def test_validate_any_softdevice(tmp_path, make_init_packet):
+    image = b'\x03' * 64
+    binfile = tmp_path / "app.bin"
+    datfile = tmp_path / "app.dat"
+    binfile.write_bytes(image)
+    datfile.write_bytes(make_init_packet(image, sd_req=(SD_REQ_ANY,)))
+    assert validate_package(str(datfile), str(binfile), image, sd_version=0x100).sd_req == [SD_REQ_ANY]
@@ -0,0 +1,101 @@
+import pytest
+
+from ota_dfu_python.jobs import JobStates, JobStore
+
+
+@pytest.fixture
+def store():
+    store = JobStore(":memory:")
+    yield store
+    store.close()
+
+
+def add(store, address):
+    return store.add(address, "app.bin", "app.dat", digest="d1")
+
+
+def test_add_once(store):
+    job_id = add(store, "aa:bb:cc:dd:ee:01")
+    assert add(store, "AA:BB:CC:DD:EE:01") == job_id
+    assert store.add("AA:BB:CC:DD:EE:01", "app.bin", "app.dat", digest="d2") != job_id
+    assert store.get(job_id).address == "AA:BB:CC:DD:EE:01"
+
+
+def test_claim_order(store):
+    ids = [add(store, "AA:BB:CC:DD:EE:%02X" % i) for i in range(4)]
+    assert store.claim().id == ids[0]
+    assert store.claim(prefer=[ids[3]]).id == ids[3]
+    assert store.claim(exclude=[ids[1]]).id == ids[2]
+    assert store.claim(exclude=[ids[1]]) is None
+
+    job = store.claim()
+    assert (job.id, job.state, job.attempts) == (ids[1], JobStates.IN_PROGRESS, 1)
+    assert store.claim() is None
+
+
+def test_claim_rank(store):
+    ids = [add(store, "AA:BB:CC:DD:EE:%02X" % i) for i in range(3)]
+    assert store.claim(rank=lambda job: -job.id).id == ids[2]
+    assert store.claim(prefer=[ids[0]], rank=lambda job: -job.id).id == ids[0]
+
+
+def test_take(store):
+    job_id = add(store, "AA:BB:CC:DD:EE:01")
+    assert store.take(job_id).state == JobStates.IN_PROGRESS
+    assert store.take(job_id) is None
+
+
+def test_fail(store):
+    job_id = add(store, "AA:BB:CC:DD:EE:01")
+    store.claim()
+    assert store.fail(job_id, "link lost", max_attempts=2) == JobStates.PENDING
+    assert store.get(job_id).error == "link lost"
+
+    assert store.claim().attempts == 2
+    assert store.fail(job_id, "link lost", max_attempts=2) == JobStates.FAILED
+    assert store.claim() is None
+
+
+def test_fail_not_retriable(store):
+    job_id = add(store, "AA:BB:CC:DD:EE:01")
+    store.claim()
+    assert store.fail(job_id, "wrong hardware", max_attempts=5, retriable=False) == JobStates.FAILED
+
+
+def test_release_keeps_attempts(store):
+    job_id = add(store, "AA:BB:CC:DD:EE:01")
+    store.claim()
+    store.update_offset(job_id, 4096)
+    assert store.release(job_id, "preempted") == JobStates.PENDING
+
+    job = store.get(job_id)
+    assert (job.state, job.attempts, job.offset) == (JobStates.PENDING, 0, 4096)
+
+
+def test_recover(store):
+    ids = [add(store, "AA:BB:CC:DD:EE:%02X" % i) for i in range(3)]
+    store.claim()
+    store.claim()
+    store.complete(ids[1], 12.0)
+    assert store.recover() == 1
+    assert [job.state for job in store.jobs()] == [JobStates.PENDING, JobStates.DONE, JobStates.PENDING]
+
+    summary = store.summary()
+    assert summary["states"][JobStates.DONE] == 1
+    assert summary["states"][JobStates.PENDING] == 2
+    assert summary["attempts"] == 2
+
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    store = JobStore(path)
+    job_id = add(store, "AA:BB:CC:DD:EE:01")
+    store.claim()
+    store.close()
+
+    store = JobStore(path)
+    try:
+        assert store.recover() == 1
+        assert store.claim().id == job_id
+    finally:
+        store.close()
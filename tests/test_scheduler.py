@@ -0,0 +1,69 @@
+import threading
+
+from ota_dfu_python.scheduler import AdaptiveConcurrency
+
+
+def test_acquire_waits_for_release():
+    limits = AdaptiveConcurrency(1)
+    limits.acquire("hci0")
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limits.acquire("hci0"), acquired.set()))
+    thread.start()
+    try:
+        assert not acquired.wait(0.1)
+        limits.release("hci0")
+        assert acquired.wait(5)
+    finally:
+        thread.join(5)
+    assert limits.active["hci0"] == 1
+
+
+def test_adapters_are_separate():
+    limits = AdaptiveConcurrency(1)
+    limits.acquire("hci0")
+    limits.acquire("hci1")
+    assert limits.active == {"hci0": 1, "hci1": 1}
+
+
+def test_cancel_does_not_adapt():
+    limits = AdaptiveConcurrency(3, window=1)
+    for _ in range(5):
+        limits.acquire("hci0")
+        limits.cancel("hci0")
+    assert limits.active["hci0"] == 0
+    assert limits.limit("hci0") == 3
+    assert limits.changes == []
+
+
+def test_lowers_and_raises():
+    limits = AdaptiveConcurrency(3, window=2, high=0.5, low=0.1)
+    for _ in range(2):
+        limits.acquire("hci0")
+        limits.release("hci0", retransmits=8, objects=10)
+    assert limits.limit("hci0") == 2
+
+    for _ in range(2):
+        limits.acquire("hci0")
+        limits.release("hci0", retransmits=0, objects=10)
+    assert limits.limit("hci0") == 3
+    assert [(adapter, limit) for (adapter, limit, _) in limits.changes] == [("hci0", 2), ("hci0", 3)]
+
+
+def test_bounds():
+    limits = AdaptiveConcurrency(2, minimum=1, window=1)
+    for _ in range(4):
+        limits.acquire("hci0")
+        limits.release("hci0", retransmits=10, objects=1)
+    assert limits.limit("hci0") == 1
+
+    for _ in range(4):
+        limits.acquire("hci0")
+        limits.release("hci0", retransmits=0, objects=1)
+    assert limits.limit("hci0") == 2
+
+
+def test_sessions_without_objects_do_not_count():
+    limits = AdaptiveConcurrency(3, window=1)
+    limits.acquire("hci0")
+    limits.release("hci0", retransmits=5, objects=0)
+    assert limits.limit("hci0") == 3
@@ -0,0 +1,16 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+import soak
+
+
+def test_soak(capsys):
+    # A few short batches: descriptors, processes, threads, temp directories
+    # and tracked resources stay flat, Python objects within the bound the
+    # init packet caches allow
+    status = soak.main(["--sessions", "30", "--batch", "10", "--gatttool", "2", "--image-size", "2048"])
+    output = capsys.readouterr().out
+    assert "LEAK" not in output
+    assert status == 0
@@ -0,0 +1,79 @@
+import pytest
+
+from ota_dfu_python.dfu import SecureDfu
+from ota_dfu_python.simulator import SimulatedAir, SimulatedDevice, SimulatedTransport
+from ota_dfu_python.trace import MAGIC, MAGIC_V1, RecordingTransport, ReplayTransport, read_trace_flags
+
+ADDRESS = "AA:BB:CC:DD:EE:01"
+
+
+class NoSendCompleteTransport(SimulatedTransport):
+    supports_send_complete = False
+
+
+def record(path, package, transport_class=SimulatedTransport):
+    air = SimulatedAir()
+    device = air.add(SimulatedDevice(ADDRESS))
+    transport = RecordingTransport(transport_class(ADDRESS, air), path)
+    try:
+        SecureDfu(ADDRESS, package[0], package[1], transport=transport).perform_dfu()
+    finally:
+        transport.close()
+    with open(package[0], 'rb') as f:
+        assert device.firmware == f.read()
+
+
+def replay(path, package, **options):
+    transport = ReplayTransport(path, **options)
+    dfu = SecureDfu(ADDRESS, package[0], package[1], transport=transport)
+    dfu.perform_dfu()
+    assert transport.divergences == 0
+    assert transport.finished
+    return transport, dfu
+
+
+@pytest.mark.parametrize("transport_class, send_complete", [(SimulatedTransport, True),
+                                                            (NoSendCompleteTransport, False)])
+def test_record_replay(tmp_path, package, transport_class, send_complete):
+    path = str(tmp_path / "session.trace")
+    record(path, package, transport_class)
+    assert bool(read_trace_flags(path)) == send_complete
+
+    (transport, dfu) = replay(path, package)
+    assert transport.supports_send_complete == send_complete
+    assert dfu.ble_dfu.stats.bytes_committed == 10000
+
+    (scaled, _) = replay(path, package, time_scale=0.5)
+    assert scaled.elapsed == pytest.approx(transport.elapsed / 2)
+
+
+def test_replay_v1(tmp_path, package):
+    path = str(tmp_path / "session.trace")
+    record(path, package)
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Version 1: no flags byte after the magic
+    with open(path, 'wb') as f:
+        f.write(MAGIC_V1 + data[len(MAGIC) + 1:])
+
+    (transport, _) = replay(path, package)
+    assert transport.supports_send_complete
+
+
+def test_replay_divergence(tmp_path, package):
+    path = str(tmp_path / "session.trace")
+    record(path, package)
+    transport = ReplayTransport(path)
+    dfu = SecureDfu(ADDRESS, package[0], package[1], transport=transport, pkt_payload_size=40)
+    try:
+        dfu.perform_dfu()
+    except Exception:
+        pass
+    assert transport.divergences > 0
+
+
+def test_not_a_trace(tmp_path):
+    path = tmp_path / "other.trace"
+    path.write_bytes(b"something else")
+    with pytest.raises(Exception, match="Not a DFU trace"):
+        ReplayTransport(str(path))